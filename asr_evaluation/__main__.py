@@ -18,19 +18,16 @@
 Contains the main method for the CLI.
 """
 
+import sys
 import argparse
 
-# For some reason Python 2 and Python 3 disagree about how to import this.
-try:
-    from asr_evaluation.asr_evaluation import main as other_main
-except Exception:
-    from asr_evaluation import main as other_main
-
 def get_parser():
     """Parse the CLI args."""
     parser = argparse.ArgumentParser(description='Evaluate an ASR transcript against a reference transcript.')
-    parser.add_argument('ref', type=argparse.FileType('r'), help='Reference transcript filename')
-    parser.add_argument('hyp', type=argparse.FileType('r'), help='ASR hypothesis filename')
+    parser.add_argument('ref', type=argparse.FileType('r'), help='Reference transcript filename (- for stdin)')
+    parser.add_argument('hyp', type=argparse.FileType('r'), nargs='+',
+                        help='ASR hypothesis filename (- for stdin). With several, they are all scored in one pass '
+                        'and compared in a table.')
     print_args = parser.add_mutually_exclusive_group()
     print_args.add_argument('-i', '--print-instances', action='store_true',
                             help='Print all individual sentences and their errors.')
@@ -40,23 +37,204 @@ def get_parser():
                         help='Hypothesis and reference files have ids in the first token? (Kaldi format)')
     parser.add_argument('-id', '--tail-ids', '--has-ids', action='store_true',
                         help='Hypothesis and reference files have ids in the last token? (Sphinx format)')
+    parser.add_argument('--join-ids', action='store_true',
+                        help='Pair up reference and hypothesis lines by their IDs instead of by line number. '
+                        'The hypothesis file may then be in any order and be missing utterances. '
+                        'Needs --head-ids or --tail-ids, and files rather than stdin.')
+    parser.add_argument('--timed', action='store_true',
+                        help='The reference is an STM file and the hypothesis a CTM file. Each hypothesis word is '
+                        'scored in the reference segment that contains its middle, and words between segments '
+                        'as insertions.')
+    parser.add_argument('--follow', action='store_true',
+                        help='Keep scoring the lines appended to the hypothesis file(s) as they are written, '
+                        'printing the running WER every --interval seconds, until every reference utterance has '
+                        'a hypothesis (or Ctrl-C). With IDs, several hypothesis files are scored as shards of '
+                        'one system.')
+    parser.add_argument('--interval', type=float, default=10.0, metavar='seconds',
+                        help='How often --follow prints the running WER (default 10 seconds).')
     parser.add_argument('-c', '--confusions', action='store_true', help='Print tables of which words were confused.')
     parser.add_argument('-p', '--print-wer-vs-length', action='store_true',
                         help='Print table of average WER grouped by reference sentence length.')
     parser.add_argument('-m', '--min-word-count', type=int, default=1, metavar='count',
                         help='Minimum word count to show a word in confusions (default 1).')
+    parser.add_argument('--top-confusions', type=int, metavar='K',
+                        help='Print only the K most frequent insertions, deletions and substitutions.')
+    parser.add_argument('--confusion-capacity', type=int, metavar='N',
+                        help='Keep at most N entries in each confusion table (approximately the most frequent), '
+                        'to bound memory. The counts printed are then upper bounds.')
+    parser.add_argument('--groups', metavar='file',
+                        help='Metadata file (tab-separated, or CSV for a .csv file) with a header row and a row per '
+                        'utterance ID, to print the WER per group of each column (e.g. per speaker or domain) and '
+                        'per reference length bucket. Needs IDs.')
+    parser.add_argument('--group-by', metavar='columns',
+                        help='Comma-separated columns of --groups to group by, or length for reference length '
+                        'buckets (default: all of them).')
     parser.add_argument('-a', '--case-insensitive', action='store_true',
                         help='Down-case the text before running the evaluation.')
+    parser.add_argument('--normalize', metavar='config',
+                        help='JSON file of normalization rules (lowercasing, regex rewrites, token mappings and '
+                        'tokens to ignore) to apply to each token before scoring. See the README.')
+    parser.add_argument('--cer', action='store_true',
+                        help='Score characters (ignoring whitespace) instead of words, for the character error rate.')
     parser.add_argument('-e', '--remove-empty-refs', action='store_true',
                         help='Skip over any examples where the reference is empty.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='Number of worker processes to score with (default 1).')
+    parser.add_argument('-b', '--batch-size', type=int, default=0, metavar='N',
+                        help='Align N line pairs at a time with the vectorized NumPy aligner. '
+                        'Only used when no instances or confusions are printed.')
+    parser.add_argument('--max-wer', type=float, metavar='rate',
+                        help='Stop aligning sentences as soon as their WER is known to be above this (e.g. 1.0), '
+                        'and report them as capped. Their errors are still exact, but their matches are a lower '
+                        'bound and they are left out of confusions and printed instances.')
+    parser.add_argument('--bootstrap', type=int, default=0, metavar='N',
+                        help='Print a bootstrap confidence interval for the WER from N resamples (needs NumPy).')
+    parser.add_argument('--compare-hyp', type=argparse.FileType('r'), metavar='file',
+                        help='A second hypothesis file to compare against the first, with a paired bootstrap and '
+                        'an approximate randomization test of the difference in WER (needs NumPy).')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='Confidence level of the bootstrap intervals (default 0.95).')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for --bootstrap and --compare-hyp.')
+    parser.add_argument('--output', metavar='file',
+                        help='Write the counts of each sentence, the summary and (with -c) the confusions to a file '
+                        'for analysis tools: JSON lines, CSV, or NumPy columns (see --output-format).')
+    parser.add_argument('--output-format', choices=['jsonl', 'csv', 'columnar'],
+                        help='Format of --output: jsonl, csv or columnar (a NumPy .npz file). By default it is '
+                        'csv for a .csv file, columnar for a .npz file and jsonl otherwise.')
+    parser.add_argument('--output-alignments', action='store_true',
+                        help='Include the alignment of each sentence in --output, as one letter per position '
+                        '(e, r, i or d for equal, replace, insert or delete).')
+    parser.add_argument('--cache', metavar='path',
+                        help='SQLite file in which to cache alignments, so re-scoring only aligns changed utterances.')
+    parser.add_argument('--cache-size', type=int, default=1000000, metavar='N',
+                        help='Maximum number of alignments to keep in the cache (default 1000000).')
+    parser.add_argument('--dedup', type=int, default=0, metavar='N',
+                        help='Keep the alignments of the N most recently seen distinct sentence pairs in memory, '
+                        'so repeated pairs (e.g. in command-and-control test sets) are only aligned once. The '
+                        'summary shows how many alignments were reused.')
+    parser.add_argument('--timings', metavar='file',
+                        help='Write the time spent in each stage (reading, tokenizing, aligning, confusions, '
+                        'printing) and counts of lines, tokens and nominal alignment cells (the sum of the ref length '
+                        'times the hyp length of each pair, however it was aligned) as JSON to a file (- for stdout).')
+    parser.add_argument('--profile', metavar='file',
+                        help='Run under cProfile and save the profile to a file, for use with pstats.')
+    parser.add_argument('-s', '--streaming', action='store_true',
+                        help='Keep only running totals per sentence length, so memory does not grow with the input.')
+    parser.add_argument('--reservoir-size', type=int, default=0, metavar='N',
+                        help='In streaming mode, sample N error rates per sentence length to print the median '
+                        'and 90th percentile WER with -p (implies --streaming).')
 
     return parser
 
+def is_regular_file(file_arg):
+    """Return true if a file from the command line can be seeked in, i.e.
+    it's a regular file rather than a pipe or a terminal."""
+    seekable = getattr(file_arg, 'seekable', None)
+    if seekable is not None:
+        return seekable()
+    # Python 2 files have no seekable()
+    try:
+        file_arg.tell()
+    except IOError:
+        return False
+    return True
+
 def main():
     """Run the program."""
+    if sys.argv[1:2] == ['serve']:
+        if sys.version_info < (3, 7):
+            sys.exit('wer serve needs Python 3.7 or later')
+        # Only the service needs asyncio, so it's imported here
+        try:
+            from asr_evaluation.server import main as serve_main
+        except Exception:
+            from server import main as serve_main
+        return serve_main(sys.argv[2:])
     parser = get_parser()
     args = parser.parse_args()
-    other_main(args)
+    if args.join_ids:
+        if not (args.head_ids or args.tail_ids):
+            parser.error('--join-ids needs --head-ids or --tail-ids')
+        if not all(is_regular_file(file_arg) for file_arg in [args.ref] + args.hyp):
+            parser.error('--join-ids needs regular files, not stdin')
+    if args.dedup < 0:
+        parser.error('--dedup must not be negative')
+    if args.max_wer is not None and args.max_wer < 0:
+        parser.error('--max-wer must not be negative')
+    if args.bootstrap < 0:
+        parser.error('--bootstrap must not be negative')
+    if not 0 < args.confidence < 1:
+        parser.error('--confidence must be between 0 and 1')
+    if args.confusion_capacity is not None and args.confusion_capacity < 1:
+        parser.error('--confusion-capacity must be at least 1')
+    if args.timed and (args.head_ids or args.tail_ids or args.join_ids):
+        parser.error('--timed takes the IDs from the STM segments, so --head-ids, --tail-ids and --join-ids '
+                     "don't apply")
+    if args.timed and args.compare_hyp:
+        # The gaps with insertions differ between systems, so the sentences wouldn't pair up
+        parser.error("--compare-hyp doesn't work with --timed")
+    if args.groups and not (args.head_ids or args.tail_ids or args.timed):
+        parser.error('--groups needs --head-ids or --tail-ids')
+    if args.group_by and not args.groups and args.group_by != 'length':
+        parser.error('--group-by needs --groups, except for length')
+    if args.follow:
+        if not all(is_regular_file(file_arg) for file_arg in [args.ref] + args.hyp):
+            parser.error('--follow needs regular files, not stdin')
+        if len(args.hyp) > 1 and not (args.head_ids or args.tail_ids):
+            parser.error('--follow with several hypothesis files needs --head-ids or --tail-ids')
+        if args.join_ids or args.timed or args.compare_hyp:
+            parser.error("--join-ids, --timed and --compare-hyp don't work with --follow")
+    single_hyp_options = [args.print_instances, args.print_errors, args.batch_size, args.compare_hyp, args.output,
+                          args.timed, args.groups, args.group_by]
+    if len(args.hyp) > 1 and not args.follow and any(single_hyp_options):
+        parser.error('-i, -r, -b, --compare-hyp, --output, --timed and --groups only work with one hypothesis file')
+    if args.normalize:
+        try:
+            from asr_evaluation.normalize import load_normalizer
+        except Exception:
+            from normalize import load_normalizer
+        try:
+            args.normalizer = load_normalizer(args.normalize)
+        except (IOError, ValueError) as e:
+            parser.error('--normalize: {}'.format(e))
+    if args.cache:
+        import sqlite3
+        try:
+            from asr_evaluation.cache import AlignmentCache
+        except Exception:
+            from cache import AlignmentCache
+        args.alignment_cache = AlignmentCache(args.cache, args.cache_size)
+        try:
+            args.alignment_cache.check()
+        except sqlite3.Error as e:
+            parser.error('--cache: {}: {}'.format(args.cache, e))
+    if args.output_alignments and not args.output:
+        parser.error('--output-alignments needs --output')
+    if args.output and not args.output_format:
+        try:
+            from asr_evaluation.writers import guess_format
+        except Exception:
+            from writers import guess_format
+        args.output_format = guess_format(args.output)
+    if args.batch_size or args.bootstrap or args.compare_hyp or args.output_format == 'columnar':
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            parser.error('-b, --bootstrap, --compare-hyp and --output-format columnar need NumPy')
+        if args.compare_hyp and not is_regular_file(args.ref):
+            parser.error('--compare-hyp needs a regular reference file, not stdin')
+    # The evaluation code is imported after the arguments are parsed, so
+    # --help and usage errors don't wait for it
+    # For some reason Python 2 and Python 3 disagree about how to import this.
+    try:
+        from asr_evaluation.asr_evaluation import main as other_main
+    except Exception:
+        from asr_evaluation import main as other_main
+    if args.profile:
+        import cProfile
+        cProfile.runctx('other_main(args)', globals(), {'args': args, 'other_main': other_main}, args.profile)
+    else:
+        other_main(args)
 
 if __name__ == "__main__":
     main()
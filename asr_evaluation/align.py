@@ -0,0 +1,486 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Alignment engines that only compute counts, for when no opcodes are needed,
+a linear memory engine for long alignments that do need opcodes, and the
+Alignment class for alignments that don't come from a SequenceMatcher.
+
+edit_counts returns exactly the distance and match count that
+edit_distance.SequenceMatcher would give (including how it breaks ties
+between equally cheap alignments), without building the backpointer table
+or the opcode list.
+"""
+
+
+# edit_counts uses the banded dynamic program when both sequences are at
+# least this long, after removing the common prefix and suffix
+banded_min_length = 64
+
+# Alignments with opcodes use linear_space_alignment rather than a
+# SequenceMatcher (with its full backpointer table) at this many cells
+linear_space_min_cells = 1 << 20
+
+# linear_space_alignment uses a full table of actions for regions of at most
+# this many cells
+region_max_cells = 1 << 16
+
+# encode_opcodes writes opcode tags one letter per aligned token
+_tag_letters = {'equal': 'e', 'replace': 'r', 'insert': 'i', 'delete': 'd'}
+
+
+def intern_pair(ref, hyp):
+    """Map the tokens of a ref/hyp pair to small integer IDs, so the inner
+    loop compares ints instead of strings."""
+    ids = {}
+    ref_ids = [ids.setdefault(token, len(ids)) for token in ref]
+    hyp_ids = [ids.setdefault(token, len(ids)) for token in hyp]
+    return ref_ids, hyp_ids
+
+def strip_common_affixes(ref, hyp):
+    """Return (prefix length, suffix length) of the tokens shared by the
+    start and end of ref and hyp.  These always align as matches."""
+    limit = min(len(ref), len(hyp))
+    prefix = 0
+    while prefix < limit and ref[prefix] == hyp[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and ref[-1 - suffix] == hyp[-1 - suffix]:
+        suffix += 1
+    return prefix, suffix
+
+def edit_counts(ref, hyp):
+    """Return (errors, matches) for aligning the ref and hyp token lists.
+
+    This is a single-row version of the dynamic program in the edit_distance
+    package, using the same lowest cost action (ties broken in favor of
+    substitution, then insertion, then deletion).  It gives identical counts,
+    in O(len(hyp)) memory and without any per-cell function calls.  Long
+    pairs use the banded version, which is still exact."""
+    prefix, suffix = strip_common_affixes(ref, hyp)
+    if prefix or suffix:
+        ref = ref[prefix:len(ref) - suffix]
+        hyp = hyp[prefix:len(hyp) - suffix]
+    shared = prefix + suffix
+    if not ref:
+        return len(hyp), shared
+    if not hyp:
+        return len(ref), shared
+    if not isinstance(ref[0], int):
+        ref, hyp = intern_pair(ref, hyp)
+    if len(ref) >= banded_min_length and len(hyp) >= banded_min_length:
+        errors, matches = long_edit_counts(ref, hyp)
+        return errors, matches + shared
+    n = len(hyp)
+    prev_dist = list(range(n + 1))
+    prev_match = [0] * (n + 1)
+    for i, ref_token in enumerate(ref, 1):
+        dist = [i] * (n + 1)
+        match = [0] * (n + 1)
+        left_dist = i
+        left_match = 0
+        for j in range(1, n + 1):
+            if ref_token == hyp[j - 1]:
+                sub_dist = prev_dist[j - 1]
+                sub_match = prev_match[j - 1] + 1
+            else:
+                sub_dist = prev_dist[j - 1] + 1
+                sub_match = prev_match[j - 1]
+            del_dist = prev_dist[j] + 1
+            if sub_dist <= left_dist + 1 and sub_dist <= del_dist:
+                left_dist = sub_dist
+                left_match = sub_match
+            elif left_dist + 1 <= del_dist:
+                left_dist += 1
+            else:
+                left_dist = del_dist
+                left_match = prev_match[j]
+            dist[j] = left_dist
+            match[j] = left_match
+        prev_dist = dist
+        prev_match = match
+    return prev_dist[n], prev_match[n] + shared
+
+def long_edit_counts(ref, hyp):
+    """Return (errors, matches) for long sequences: the bit-parallel distance
+    gives the exact band width needed, and banded_edit_counts then fills in
+    the match count in O(distance * length) time rather than O(length ** 2).
+    (This saves the repeated passes of doubling the band until it fits.)"""
+    return banded_edit_counts(ref, hyp, levenshtein_distance(ref, hyp))
+
+def banded_edit_counts(ref, hyp, band):
+    """Return (errors, matches) like edit_counts, but only compute the cells
+    within band of the main diagonal (Ukkonen's cut-off).  Return None if the
+    distance is more than band, stopping as soon as a whole row of the band
+    is over it.
+
+    Any cell with a distance of at most band is in the band, and so are all
+    the cells on the way to it, so when the final distance is at most band
+    the counts (including the tie-broken match count) are exact."""
+    n = len(ref)
+    m = len(hyp)
+    if abs(n - m) > band:
+        return None
+    inf = n + m + band + 1
+    prev_dist = [inf] * (m + 2)
+    prev_match = [0] * (m + 2)
+    for j in range(min(m, band) + 1):
+        prev_dist[j] = j
+    dist = [inf] * (m + 2)
+    match = [0] * (m + 2)
+    for i in range(1, n + 1):
+        ref_token = ref[i - 1]
+        lo = max(0, i - band)
+        hi = min(m, i + band)
+        if lo == 0:
+            dist[0] = left_dist = i
+            match[0] = left_match = 0
+            lo = 1
+        else:
+            left_dist = inf
+            left_match = 0
+        row_min = left_dist
+        for j in range(lo, hi + 1):
+            if ref_token == hyp[j - 1]:
+                sub_dist = prev_dist[j - 1]
+                sub_match = prev_match[j - 1] + 1
+            else:
+                sub_dist = prev_dist[j - 1] + 1
+                sub_match = prev_match[j - 1]
+            del_dist = prev_dist[j] + 1
+            if sub_dist <= left_dist + 1 and sub_dist <= del_dist:
+                left_dist = sub_dist
+                left_match = sub_match
+            elif left_dist + 1 <= del_dist:
+                left_dist += 1
+            else:
+                left_dist = del_dist
+                left_match = prev_match[j]
+            dist[j] = left_dist
+            match[j] = left_match
+            if left_dist < row_min:
+                row_min = left_dist
+        if row_min > band:
+            return None
+        # The cells just outside the band are read by the next row
+        dist[hi + 1] = inf
+        if lo > 1:
+            dist[lo - 1] = inf
+        prev_dist, dist = dist, prev_dist
+        prev_match, match = match, prev_match
+    if prev_dist[m] > band:
+        return None
+    return prev_dist[m], prev_match[m]
+
+def capped_edit_counts(ref, hyp, ceiling):
+    """Return (errors, matches, capped).  If the distance is at most ceiling,
+    the counts are exact and capped is false.  Otherwise the banded dynamic
+    program is abandoned as soon as the distance is known to be over the
+    ceiling, errors is the exact distance from levenshtein_distance, and
+    matches is a lower bound on the match count."""
+    prefix, suffix = strip_common_affixes(ref, hyp)
+    if prefix or suffix:
+        ref = ref[prefix:len(ref) - suffix]
+        hyp = hyp[prefix:len(hyp) - suffix]
+    counts = banded_edit_counts(ref, hyp, ceiling)
+    if counts is not None:
+        return counts[0], counts[1] + prefix + suffix, False
+    errors = levenshtein_distance(ref, hyp)
+    return errors, min_matches(len(ref), len(hyp), errors) + prefix + suffix, True
+
+def min_matches(ref_length, hyp_length, errors):
+    """Return a lower bound on the matches in an alignment with the given
+    number of errors.  Matches = ref length - errors + insertions, and there
+    are at least hyp length - ref length insertions."""
+    return max(0, ref_length - errors + max(0, hyp_length - ref_length))
+
+def levenshtein_distance(ref, hyp):
+    """Return the edit distance between two token lists, using the
+    bit-parallel algorithm of Myers (1999) as formulated by Hyyro (2001).
+
+    Each column of the dynamic program is held in the bits of a Python int,
+    so this runs in O(len(hyp) * len(ref) / wordsize).  It only gives the
+    distance; the match count depends on how ties are broken, which needs
+    edit_counts."""
+    prefix, suffix = strip_common_affixes(ref, hyp)
+    ref = ref[prefix:len(ref) - suffix]
+    hyp = hyp[prefix:len(hyp) - suffix]
+    m = len(ref)
+    if m == 0:
+        return len(hyp)
+    # Bit vectors of the positions at which each token occurs in the ref
+    peq = {}
+    for i, token in enumerate(ref):
+        peq[token] = peq.get(token, 0) | (1 << i)
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv = mask
+    mv = 0
+    score = m
+    for token in hyp:
+        eq = peq.get(token, 0)
+        xv = eq | mv
+        xh = ((((eq & pv) + pv) & mask) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & mask
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+    return score
+
+def linear_space_alignment(ref, hyp):
+    """Return an Alignment with exactly the opcodes that
+    edit_distance.SequenceMatcher would give, in O(len(ref) + len(hyp))
+    memory instead of a full backpointer table.
+
+    This is Hirschberg's divide and conquer, adapted so the path is the one
+    SequenceMatcher's backtrace follows rather than any optimal one.  The
+    choice at each cell only depends on the distances above and to the left
+    of it, so a region of the table can be redone given just its top row and
+    left column.  A forward pass over a region carries along, for each cell
+    below the middle row, the column at which its backtrace leaves that row;
+    the region is then split at that cell into two smaller regions."""
+    n = len(ref)
+    m = len(hyp)
+    opcodes = []
+    align_region(ref, hyp, 0, n, 0, m, list(range(m + 1)), list(range(n + 1)), opcodes)
+    matches = sum(1 for opcode in opcodes if opcode[0] == 'equal')
+    return Alignment(len(opcodes) - matches, matches, opcodes)
+
+def align_region(ref, hyp, r0, r1, c0, c1, top, left, opcodes):
+    """Append the opcodes of the backtrace from (r1, c1) to (r0, c0), which
+    must be on it.  top and left are the distances in row r0 and column c0
+    of the region."""
+    if r1 - r0 < 2 or (r1 - r0) * (c1 - c0) <= region_max_cells:
+        opcodes.extend(region_opcodes(ref, hyp, r0, r1, c0, c1, top, left))
+        return
+    mid = (r0 + r1) // 2
+    hyp_tokens = hyp[c0:c1]
+    prev = list(top)
+    for i in range(r0 + 1, mid + 1):
+        prev = next_row(ref[i - 1], hyp_tokens, prev, left[i - r0])
+    mid_row = prev
+    # The column at which the backtrace from each cell leaves row mid
+    prev_label = list(range(c0, c1 + 1))
+    for i in range(mid + 1, r1 + 1):
+        ref_token = ref[i - 1]
+        left_dist = left[i - r0]
+        left_label = c0
+        dist = [left_dist]
+        label = [c0]
+        for j, hyp_token in enumerate(hyp_tokens):
+            sub_dist = prev[j] if ref_token == hyp_token else prev[j] + 1
+            del_dist = prev[j + 1] + 1
+            if sub_dist <= left_dist + 1 and sub_dist <= del_dist:
+                left_dist = sub_dist
+                left_label = prev_label[j]
+            elif left_dist + 1 <= del_dist:
+                left_dist += 1
+            else:
+                left_dist = del_dist
+                left_label = prev_label[j + 1]
+            dist.append(left_dist)
+            label.append(left_label)
+        prev = dist
+        prev_label = label
+    k = prev_label[-1]
+    # Redo the rows below mid up to column k, for the lower region's left column
+    column = [mid_row[k - c0]]
+    prev = mid_row[:k - c0 + 1]
+    for i in range(mid + 1, r1 + 1):
+        prev = next_row(ref[i - 1], hyp_tokens[:k - c0], prev, left[i - r0])
+        column.append(prev[-1])
+    align_region(ref, hyp, r0, mid, c0, k, top[:k - c0 + 1], left[:mid - r0 + 1], opcodes)
+    align_region(ref, hyp, mid, r1, k, c1, mid_row[k - c0:], column, opcodes)
+
+def next_row(ref_token, hyp_tokens, prev, left_dist):
+    """Return the next row of distances after prev, starting from left_dist."""
+    dist = [left_dist]
+    for j, hyp_token in enumerate(hyp_tokens):
+        sub_dist = prev[j] if ref_token == hyp_token else prev[j] + 1
+        del_dist = prev[j + 1] + 1
+        if sub_dist <= left_dist + 1 and sub_dist <= del_dist:
+            left_dist = sub_dist
+        elif left_dist + 1 <= del_dist:
+            left_dist += 1
+        else:
+            left_dist = del_dist
+        dist.append(left_dist)
+    return dist
+
+def banded_alignment(ref, hyp, band):
+    """Return an Alignment with exactly the opcodes that
+    edit_distance.SequenceMatcher would give, given a band at least the edit
+    distance (e.g. from levenshtein_distance).  Only the actions within band
+    of the main diagonal are stored, so this takes O(band * len(ref)) time
+    and memory; as in banded_edit_counts, the cells outside the band can't
+    be on the path or tie with a choice made on it."""
+    n = len(ref)
+    m = len(hyp)
+    inf = n + m + band + 1
+    # actions[i][j - i + band] for the cells within the band of row i
+    width = 2 * band + 1
+    actions = [[1] * width]
+    prev_dist = [inf] * (m + 2)
+    for j in range(min(m, band) + 1):
+        prev_dist[j] = j
+    dist = [inf] * (m + 2)
+    for i in range(1, n + 1):
+        ref_token = ref[i - 1]
+        lo = max(0, i - band)
+        hi = min(m, i + band)
+        row = [2] * width
+        if lo == 0:
+            dist[0] = left_dist = i
+            lo = 1
+        else:
+            left_dist = inf
+        offset = band - i
+        for j in range(lo, hi + 1):
+            sub_dist = prev_dist[j - 1] if ref_token == hyp[j - 1] else prev_dist[j - 1] + 1
+            del_dist = prev_dist[j] + 1
+            if sub_dist <= left_dist + 1 and sub_dist <= del_dist:
+                left_dist = sub_dist
+                row[j + offset] = 0
+            elif left_dist + 1 <= del_dist:
+                left_dist += 1
+                row[j + offset] = 1
+            else:
+                left_dist = del_dist
+            dist[j] = left_dist
+        dist[hi + 1] = inf
+        if lo > 1:
+            dist[lo - 1] = inf
+        actions.append(row)
+        prev_dist, dist = dist, prev_dist
+    opcodes = []
+    matches = 0
+    i = n
+    j = m
+    while i != 0 or j != 0:
+        action = actions[i][j - i + band] if i > 0 and j > 0 else (1 if i == 0 else 2)
+        if action == 0:
+            if ref[i - 1] == hyp[j - 1]:
+                opcodes.append(['equal', i - 1, i, j - 1, j])
+                matches += 1
+            else:
+                opcodes.append(['replace', i - 1, i, j - 1, j])
+            i -= 1
+            j -= 1
+        elif action == 1:
+            opcodes.append(['insert', i, i, j - 1, j])
+            j -= 1
+        else:
+            opcodes.append(['delete', i - 1, i, j, j])
+            i -= 1
+    opcodes.reverse()
+    return Alignment(len(opcodes) - matches, matches, opcodes)
+
+def region_opcodes(ref, hyp, r0, r1, c0, c1, top, left):
+    """Return the opcodes of the backtrace from (r1, c1) to (r0, c0) using a
+    table of the actions in the region."""
+    # 0 = substitution or match, 1 = insertion, 2 = deletion
+    actions = [[1] * (c1 - c0 + 1)]
+    hyp_tokens = hyp[c0:c1]
+    prev = list(top)
+    for i in range(r0 + 1, r1 + 1):
+        ref_token = ref[i - 1]
+        left_dist = left[i - r0]
+        dist = [left_dist]
+        row = [2]
+        for j, hyp_token in enumerate(hyp_tokens):
+            sub_dist = prev[j] if ref_token == hyp_token else prev[j] + 1
+            del_dist = prev[j + 1] + 1
+            if sub_dist <= left_dist + 1 and sub_dist <= del_dist:
+                left_dist = sub_dist
+                row.append(0)
+            elif left_dist + 1 <= del_dist:
+                left_dist += 1
+                row.append(1)
+            else:
+                left_dist = del_dist
+                row.append(2)
+            dist.append(left_dist)
+        actions.append(row)
+        prev = dist
+    opcodes = []
+    i = r1
+    j = c1
+    while i != r0 or j != c0:
+        action = actions[i - r0][j - c0]
+        if action == 0:
+            tag = 'equal' if ref[i - 1] == hyp[j - 1] else 'replace'
+            opcodes.append([tag, i - 1, i, j - 1, j])
+            i -= 1
+            j -= 1
+        elif action == 1:
+            opcodes.append(['insert', i, i, j - 1, j])
+            j -= 1
+        else:
+            opcodes.append(['delete', i - 1, i, j, j])
+            i -= 1
+    opcodes.reverse()
+    return opcodes
+
+
+class Alignment(object):
+    """A finished alignment, with the parts of the edit_distance.SequenceMatcher
+    interface that the printing and confusion code uses.  This is what comes
+    back from the alignment cache and the alternative alignment backends."""
+    __slots__ = ('dist', 'match_count', 'opcodes')
+
+    def __init__(self, dist, match_count, opcodes=None):
+        self.dist = dist
+        self.match_count = match_count
+        self.opcodes = opcodes
+
+    def distance(self):
+        return self.dist
+
+    def matches(self):
+        return self.match_count
+
+    def get_opcodes(self):
+        return self.opcodes
+
+    def get_matching_blocks(self):
+        return [[i1, j1, i2 - i1] for tag, i1, i2, j1, j2 in self.opcodes if tag == 'equal']
+
+
+def encode_opcodes(opcodes):
+    """Encode opcodes as a string with one letter per aligned position."""
+    return ''.join(_tag_letters[tag] * max(i2 - i1, j2 - j1) for tag, i1, i2, j1, j2 in opcodes)
+
+def decode_opcodes(letters):
+    """Rebuild SequenceMatcher style opcodes (one per position) from encode_opcodes output."""
+    opcodes = []
+    i = j = 0
+    for letter in letters:
+        if letter == 'e' or letter == 'r':
+            opcodes.append(['equal' if letter == 'e' else 'replace', i, i + 1, j, j + 1])
+            i += 1
+            j += 1
+        elif letter == 'i':
+            opcodes.append(['insert', i, i, j, j + 1])
+            j += 1
+        else:
+            opcodes.append(['delete', i, i + 1, j, j])
+            i += 1
+    return opcodes
@@ -18,41 +18,358 @@ Primary code for computing word error rate and other metrics from ASR output.
 """
 from __future__ import division
 
-from functools import reduce
-from collections import defaultdict
-from edit_distance import SequenceMatcher
-
-from termcolor import colored
-
-# Some defaults
-print_instances_p = False
-print_errors_p = False
-files_head_ids = False
-files_tail_ids = False
-confusions = False
-min_count = 0
-wer_vs_length_p = True
-
-# For keeping track of the total number of tokens, errors, and matches
-ref_token_count = 0
-error_count = 0
-match_count = 0
-counter = 0
-sent_error_count = 0
-
-# For keeping track of word error rates by sentence length
-# this is so we can see if performance is better/worse for longer
-# and/or shorter sentences
-lengths = []
-error_rates = []
-wer_bins = defaultdict(list)
-wer_vs_length = defaultdict(list)
-# Tables for keeping track of which words get confused with one another
-insertion_table = defaultdict(int)
-deletion_table = defaultdict(int)
-substitution_table = defaultdict(int)
+import io
+import sys
+import heapq
+from array import array
+from itertools import islice
+from functools import reduce, partial
+from collections import defaultdict, deque
+
+# For some reason Python 2 and Python 3 disagree about how to import this.
+try:
+    from asr_evaluation import align
+    from asr_evaluation.align import Alignment, capped_edit_counts, edit_counts, encode_opcodes, levenshtein_distance
+    from asr_evaluation.align import min_matches
+    from asr_evaluation.streaming import RunningStats
+    from asr_evaluation.reader import JoinStats, join_by_id, join_all_by_id
+    from asr_evaluation.vocab import Vocabulary
+    from asr_evaluation.timings import Timings
+    from asr_evaluation.sketch import SpaceSaving
+    from asr_evaluation.groups import GroupCounts, Metadata
+    from asr_evaluation.writers import utterance_record
+except Exception:
+    import align
+    from align import Alignment, capped_edit_counts, edit_counts, encode_opcodes, levenshtein_distance
+    from align import min_matches
+    from streaming import RunningStats
+    from reader import JoinStats, join_by_id, join_all_by_id
+    from vocab import Vocabulary
+    from timings import Timings
+    from sketch import SpaceSaving
+    from groups import GroupCounts, Metadata
+    from writers import utterance_record
+
+# To keep startup fast, modules that only some options need are imported
+# where they're used: edit_distance (opcodes), termcolor and threading
+# (printing instances), multiprocessing (--jobs), json (--timings), and
+# sqlite3 with the alignment cache (--cache and --dedup).
+
 # These are the editdistance opcodes that are condsidered 'errors'
 error_codes = ['replace', 'delete', 'insert']
+# Number of line pairs handed to a worker process at a time with --jobs
+shard_size = 1000
+# Seconds to wait for more lines when following growing hypothesis files
+follow_poll_interval = 0.5
+# The AlignmentMemos of a worker process (one per system), kept across the
+# shards it scores so that --dedup reuses repeats from earlier shards
+worker_memos = {}
+
+
+class Evaluation(object):
+    """Accumulates the counts and tables for one evaluation.
+
+    Each instance holds its own options and results, so several evaluations
+    can run side by side in one process, and partial results (e.g. from
+    worker processes) can be combined with merge().
+
+    With streaming=True the per-sentence lengths and error rates aren't
+    kept; wer_bins holds a RunningStats per reference length instead of a
+    list, so memory doesn't grow with the number of sentences.  A positive
+    reservoir_size keeps a sample of that many error rates per length for
+    quantiles.
+
+    If an AlignmentCache is given as cache, alignments are looked up there
+    before being computed.  A positive dedup_size keeps the alignments of
+    that many distinct recent sentence pairs in memory too (an AlignmentMemo,
+    in memo), so repeated pairs are only aligned once; the counts,
+    confusions and printing of a repeat work from the remembered alignment.
+
+    Tokens are interned in the evaluation's Vocabulary, so sentences are
+    aligned as arrays of integer IDs and the confusion tables are keyed on
+    IDs; confusion_tables() gives them back with the tokens.  Evaluations of
+    several systems against the same reference can share a vocabulary (see
+    score_systems).
+
+    If max_wer is set, sentences with a WER above it are "capped": their
+    alignment is abandoned as soon as that is known.  Their errors are still
+    counted exactly, but their matches are a lower bound, and they're left
+    out of confusions and printed instances.
+
+    If a Timings object is given as timings, the time spent in each stage
+    and counts of lines, tokens and nominal alignment cells are recorded in it.
+
+    With cer=True sentences are scored as sequences of characters (Unicode
+    code points, ignoring whitespace) instead of words, for the character
+    error rate.  Characters are interned like words, so all the reporting
+    works the same way; the labels say CER and CRR.
+
+    If confusion_capacity is set, each confusion table is a SpaceSaving
+    summary (see asr_evaluation.sketch) of at most that many entries, so
+    memory is bounded on large, noisy corpora.  The most frequent
+    confusions are still found, but their counts are upper bounds.
+
+    If records is given (a list, or a writer from asr_evaluation.writers),
+    a record of each sentence's counts is appended to it, with its
+    alignment if record_alignments is set.
+
+    A Normalizer (see asr_evaluation.normalize) given as normalizer is
+    applied to each token, after the IDs are removed and before alignment.
+
+    If metadata is given (a Metadata from asr_evaluation.groups), the
+    counts are also added up per group of utterances (e.g. per speaker) in
+    group_counts, a GroupCounts; group_results() gives the rates.
+
+    With keep_utterances=True the reference length and error count of each
+    sentence are kept, in order, in utterance_lengths and utterance_errors,
+    for bootstrap intervals and significance tests.
+    """
+    __slots__ = ('head_ids', 'tail_ids', 'case_insensitive', 'remove_empty_refs',
+                 'confusions', 'print_instances', 'print_errors', 'streaming', 'reservoir_size',
+                 'cache', 'dedup_size', 'timings', 'max_wer', 'keep_utterances', 'cer', 'normalizer',
+                 'confusion_capacity', 'records', 'record_alignments', 'color', 'renderer', 'metadata',
+                 'ref_token_count', 'error_count', 'match_count', 'counter', 'sent_error_count', 'capped_count',
+                 'lengths', 'error_rates', 'wer_bins', 'utterance_lengths', 'utterance_errors',
+                 'vocab', 'insertion_table', 'deletion_table', 'substitution_table', 'group_counts', 'memo')
+
+    def __init__(self, head_ids=False, tail_ids=False, case_insensitive=False, remove_empty_refs=False,
+                 confusions=False, print_instances=False, print_errors=False, streaming=False,
+                 reservoir_size=0, cache=None, timings=None, max_wer=None, keep_utterances=False, vocab=None,
+                 cer=False, normalizer=None, confusion_capacity=None, records=None, record_alignments=False,
+                 color=None, metadata=None, dedup_size=0):
+        self.head_ids = head_ids
+        self.tail_ids = tail_ids
+        self.case_insensitive = case_insensitive
+        self.remove_empty_refs = remove_empty_refs
+        self.confusions = confusions
+        self.print_instances = print_instances
+        self.print_errors = print_errors
+        self.streaming = streaming or reservoir_size > 0
+        self.reservoir_size = reservoir_size
+        self.cache = cache
+        self.dedup_size = dedup_size
+        self.timings = timings
+        self.max_wer = max_wer
+        self.keep_utterances = keep_utterances
+        self.cer = cer
+        self.normalizer = normalizer
+        self.confusion_capacity = confusion_capacity
+        self.records = records
+        self.record_alignments = record_alignments
+        self.color = color
+        # Made when the first instance is printed
+        self.renderer = None
+        self.metadata = metadata
+        # For keeping track of the total number of tokens, errors, and matches
+        self.ref_token_count = 0
+        self.error_count = 0
+        self.match_count = 0
+        self.counter = 0
+        self.sent_error_count = 0
+        self.capped_count = 0
+        # For keeping track of word error rates by sentence length
+        # this is so we can see if performance is better/worse for longer
+        # and/or shorter sentences
+        self.lengths = []
+        self.error_rates = []
+        if self.streaming:
+            self.wer_bins = defaultdict(partial(RunningStats, reservoir_size))
+        else:
+            self.wer_bins = defaultdict(list)
+        self.utterance_lengths = array('i')
+        self.utterance_errors = array('i')
+        # Tables for keeping track of which words get confused with one another
+        self.vocab = vocab if vocab is not None else Vocabulary()
+        if confusion_capacity:
+            self.insertion_table = SpaceSaving(confusion_capacity)
+            self.deletion_table = SpaceSaving(confusion_capacity)
+            self.substitution_table = SpaceSaving(confusion_capacity)
+        else:
+            self.insertion_table = defaultdict(int)
+            self.deletion_table = defaultdict(int)
+            self.substitution_table = defaultdict(int)
+        self.group_counts = GroupCounts() if metadata is not None else None
+        self.memo = None
+        if dedup_size > 0:
+            try:
+                from asr_evaluation.cache import AlignmentMemo
+            except Exception:
+                from cache import AlignmentMemo
+            self.memo = AlignmentMemo(dedup_size)
+
+    @classmethod
+    def from_args(cls, args):
+        """Create an empty evaluation with the options given on the command line."""
+        # The CLI opens the cache while checking the arguments
+        cache = getattr(args, 'alignment_cache', None)
+        if cache is None and args.cache:
+            try:
+                from asr_evaluation.cache import AlignmentCache
+            except Exception:
+                from cache import AlignmentCache
+            cache = AlignmentCache(args.cache, args.cache_size)
+        # The CLI also loads the normalizer while checking the arguments
+        normalizer = getattr(args, 'normalizer', None)
+        if normalizer is None and args.normalize:
+            try:
+                from asr_evaluation.normalize import load_normalizer
+            except Exception:
+                from normalize import load_normalizer
+            normalizer = load_normalizer(args.normalize)
+        records = None
+        if args.output:
+            try:
+                from asr_evaluation.writers import open_writer
+            except Exception:
+                from writers import open_writer
+            records = open_writer(args.output, args.output_format, args.output_alignments)
+        metadata = None
+        if args.groups or args.group_by:
+            metadata = Metadata(args.groups, args.group_by.split(',') if args.group_by else None)
+        # Timed (STM/CTM) input is scored as pairs with the segment IDs first
+        return cls(head_ids=args.head_ids or args.timed, tail_ids=args.tail_ids, case_insensitive=args.case_insensitive,
+                   remove_empty_refs=args.remove_empty_refs, confusions=args.confusions,
+                   print_instances=args.print_instances, print_errors=args.print_errors,
+                   streaming=args.streaming, reservoir_size=args.reservoir_size,
+                   cache=cache,
+                   timings=Timings() if args.timings else None, max_wer=args.max_wer,
+                   keep_utterances=bool(args.bootstrap or args.compare_hyp), cer=args.cer,
+                   normalizer=normalizer, confusion_capacity=args.confusion_capacity,
+                   records=records, record_alignments=args.output_alignments, metadata=metadata,
+                   dedup_size=args.dedup)
+
+    def options(self):
+        """Return the options of this evaluation as keyword arguments for the constructor."""
+        return {'head_ids': self.head_ids, 'tail_ids': self.tail_ids,
+                'case_insensitive': self.case_insensitive, 'remove_empty_refs': self.remove_empty_refs,
+                'confusions': self.confusions, 'print_instances': self.print_instances,
+                'print_errors': self.print_errors, 'streaming': self.streaming,
+                'reservoir_size': self.reservoir_size, 'cache': self.cache, 'dedup_size': self.dedup_size,
+                'timings': Timings() if self.timings is not None else None, 'max_wer': self.max_wer,
+                'keep_utterances': self.keep_utterances, 'cer': self.cer, 'normalizer': self.normalizer,
+                'confusion_capacity': self.confusion_capacity,
+                # Worker processes collect their records in a list for merge()
+                'records': [] if self.records is not None else None,
+                'record_alignments': self.record_alignments, 'metadata': self.metadata,
+                # Decided here, since worker processes print to a buffer
+                'color': self.printing_color()}
+
+    def add_pair(self, ref_line, hyp_line):
+        """Score a reference/hypothesis line pair and add it to the counts.
+
+        Return true if the pair was counted, false if it was skipped due to an
+        empty reference string."""
+        if not process_line_pair(ref_line, hyp_line, self):
+            return False
+        self.counter += 1
+        return True
+
+    def add_batch(self, line_pairs):
+        """Score a list of (ref line, hyp line) pairs and add them to the counts.
+        When only counts are needed the pairs are aligned together with the
+        vectorized batch aligner.  Returns the number of pairs counted."""
+        if self.needs_opcodes() or self.cache is not None or self.max_wer is not None:
+            return sum(1 for ref_line, hyp_line in line_pairs if self.add_pair(ref_line, hyp_line))
+        counted = process_line_batch(line_pairs, self)
+        self.counter += counted
+        return counted
+
+    def printing_color(self):
+        """Return whether printed instances are in color: the color option,
+        or if that's None, whether stdout is a terminal."""
+        if self.color is not None or not (self.print_instances or self.print_errors):
+            return self.color
+        try:
+            from asr_evaluation.render import color_enabled
+        except Exception:
+            from render import color_enabled
+        return color_enabled()
+
+    def needs_opcodes(self):
+        """Return true if the options need full alignments rather than just counts."""
+        return self.confusions or self.print_instances or self.print_errors or self.record_alignments
+
+    def merge(self, other):
+        """Add the counts and tables of another evaluation to this one.
+
+        Merging the partial results of consecutive chunks of a corpus, in
+        order, gives exactly the same state as scoring the whole corpus with
+        a single evaluation."""
+        self.ref_token_count += other.ref_token_count
+        self.error_count += other.error_count
+        self.match_count += other.match_count
+        self.counter += other.counter
+        self.sent_error_count += other.sent_error_count
+        self.capped_count += other.capped_count
+        if self.timings is not None and other.timings is not None:
+            self.timings.merge(other.timings)
+        self.lengths.extend(other.lengths)
+        self.error_rates.extend(other.error_rates)
+        self.utterance_lengths.extend(other.utterance_lengths)
+        self.utterance_errors.extend(other.utterance_errors)
+        if self.records is not None and other.records:
+            self.records.extend(other.records)
+        if self.group_counts is not None and other.group_counts is not None:
+            self.group_counts.merge(other.group_counts)
+        if self.memo is not None and other.memo is not None:
+            self.memo.merge(other.memo)
+        for length, rates in other.wer_bins.items():
+            if self.streaming:
+                self.wer_bins[length].merge(rates)
+            else:
+                self.wer_bins[length].extend(rates)
+        # Merging in order keeps the tables in first-seen order, so ties in
+        # print_confusions come out the same as in a sequential run.
+        ids = self.vocab.translate(other.vocab)
+        if self.confusion_capacity:
+            self.insertion_table.merge(other.insertion_table, ids.__getitem__)
+            self.deletion_table.merge(other.deletion_table, ids.__getitem__)
+            self.substitution_table.merge(other.substitution_table, lambda pair: (ids[pair[0]], ids[pair[1]]))
+            return self
+        for word, count in other.insertion_table.items():
+            self.insertion_table[ids[word]] += count
+        for word, count in other.deletion_table.items():
+            self.deletion_table[ids[word]] += count
+        for (w1, w2), count in other.substitution_table.items():
+            self.substitution_table[ids[w1], ids[w2]] += count
+        return self
+
+    def confusion_tables(self):
+        """Return the insertion, deletion and substitution tables as lists of
+        (word, count) and ((ref word, hyp word), count) items, in the order
+        the confusions were first seen.  With confusion_capacity set, these
+        are the most frequent confusions, with upper bounds on their counts."""
+        tokens = self.vocab.tokens
+        return ([(tokens[word], count) for word, count in self.insertion_table.items()],
+                [(tokens[word], count) for word, count in self.deletion_table.items()],
+                [((tokens[w1], tokens[w2]), count) for (w1, w2), count in self.substitution_table.items()])
+
+    def group_results(self):
+        """Return a list of dicts with the counts and rates of each group, like
+        result() with the group's column and value added, or [] without
+        metadata."""
+        if self.group_counts is None:
+            return []
+        return self.group_counts.results(self.metadata.sort_key)
+
+    def result(self):
+        """Return a dict with the summary counts and the WER, WRR and SER."""
+        if self.ref_token_count > 0:
+            wrr = self.match_count / self.ref_token_count
+            wer = self.error_count / self.ref_token_count
+        else:
+            wrr = 0.0
+            wer = 0.0
+        ser = self.sent_error_count / self.counter if self.counter > 0 else 0.0
+        return {'sentence_count': self.counter,
+                'ref_token_count': self.ref_token_count,
+                'error_count': self.error_count,
+                'match_count': self.match_count,
+                'sent_error_count': self.sent_error_count,
+                'capped_count': self.capped_count,
+                'wer': wer,
+                'wrr': wrr,
+                'ser': ser}
 
 
 # TODO - rename this function.  Move some of it into evaluate.py?
@@ -65,116 +382,868 @@ def main(args):
     This function doesn't not check to ensure that the reference and
     hypothesis file have the same number of lines.  It will stop after the
     shortest one runs out of lines.  This should be easy to fix...
+
+    Returns the Evaluation holding the results.  With several hypothesis
+    files, main_systems is used instead.
     """
-    global counter
-    set_global_variables(args)
-
-    counter = 0
-    # Loop through each line of the reference and hyp file
-    for ref_line, hyp_line in zip(args.ref, args.hyp):
-        processed_p = process_line_pair(ref_line, hyp_line, case_insensitive=args.case_insensitive,
-                                        remove_empty_refs=args.remove_empty_refs)
-        if processed_p:
-            counter += 1
-    if confusions:
-        print_confusions()
-    if wer_vs_length_p:
-        print_wer_vs_length()
-    # Compute WER and WRR
-    if ref_token_count > 0:
-        wrr = match_count / ref_token_count
-        wer = error_count / ref_token_count
+    if len(args.hyp) > 1 and not args.follow:
+        return main_systems(args)
+    evaluation = Evaluation.from_args(args)
+    timings = evaluation.timings
+    follower = None
+    if args.follow:
+        # Several hypothesis files are shards of one system here
+        join_stats = None
+        follower = follow_files(evaluation, args.ref, args.hyp, args)
+    else:
+        join_stats = score_files(evaluation, args.ref, args.hyp[0], args)
+    other = None
+    if args.compare_hyp:
+        # Score the second system with the same options, but without printing
+        options = evaluation.options()
+        options.update(confusions=False, print_instances=False, print_errors=False, timings=timings, records=None,
+                       record_alignments=False)
+        other = Evaluation(**options)
+        args.ref.seek(0)
+        score_files(other, args.ref, args.compare_hyp, args)
+    if timings is not None:
+        start = timings.start()
+    if evaluation.confusions:
+        print_confusions(evaluation, args.min_word_count, args.top_confusions)
+    if args.print_wer_vs_length:
+        print_wer_vs_length(evaluation)
+    if evaluation.group_counts is not None:
+        print_groups(evaluation)
+    if evaluation.cache is not None:
+        evaluation.cache.close()
+    if join_stats is not None:
+        print_join_stats(join_stats)
+    if follower is not None:
+        print_follow_stats(follower)
+    print_summary(evaluation)
+    if evaluation.records is not None:
+        evaluation.records.finish(evaluation)
+    if other is not None:
+        print_comparison(evaluation, other, args)
+    elif args.bootstrap:
+        print_bootstrap(evaluation, args)
+    if timings is not None:
+        timings.stop('report', start)
+        write_timings(evaluation, args.timings)
+    return evaluation
+
+
+def main_systems(args):
+    """main() for several hypothesis files: score them all against the
+    reference in one pass, print the confusions, WER vs. length and join
+    stats (as asked for) of each one, then a table comparing them.
+    Returns the list of Evaluations."""
+    first = Evaluation.from_args(args)
+    timings = first.timings
+    options = first.options()
+    options['timings'] = timings
+    evaluations = [first] + [Evaluation(vocab=first.vocab, **options) for _ in args.hyp[1:]]
+    join_stats = score_systems(evaluations, args.ref, args.hyp, args.jobs, args.join_ids)
+    if timings is not None:
+        start = timings.start()
+    if first.cache is not None:
+        first.cache.close()
+    names = [hyp_file.name for hyp_file in args.hyp]
+    for i, (name, evaluation) in enumerate(zip(names, evaluations)):
+        if not (evaluation.confusions or args.print_wer_vs_length or join_stats):
+            break
+        print('System: {}'.format(name))
+        if evaluation.confusions:
+            print_confusions(evaluation, args.min_word_count, args.top_confusions)
+        if args.print_wer_vs_length:
+            print_wer_vs_length(evaluation)
+        if join_stats:
+            print_join_stats(join_stats[i])
+        print('')
+    print_systems_table(names, evaluations, args)
+    if timings is not None:
+        timings.stop('report', start)
+        write_timings(first, args.timings)
+    return evaluations
+
+def print_systems_table(names, evaluations, args):
+    """Print a table of the counts, WER, WRR and SER of each system, with a
+    bootstrap interval for the WER if args.bootstrap is set."""
+    width = max(len('System'), max(len(name) for name in names))
+    header = '{0:{width}s} {1:>10s} {2:>10s} {3:>10s} {4:>9s} {5:>9s} {6:>9s}'.format(
+        'System', 'Sentences', 'Tokens', 'Errors', rate_names(evaluations[0])[0], rate_names(evaluations[0])[1],
+        'SER', width=width)
+    if args.bootstrap:
+        header += '  {} {:.0%} CI'.format(rate_names(evaluations[0])[0], args.confidence)
+        try:
+            from asr_evaluation.significance import bootstrap_wer
+        except Exception:
+            from significance import bootstrap_wer
+    print(header)
+    for name, evaluation in zip(names, evaluations):
+        result = evaluation.result()
+        row = '{0:{width}s} {1:10d} {2:10d} {3:10d} {4:9.3%} {5:9.3%} {6:9.3%}'.format(
+            name, result['sentence_count'], result['ref_token_count'], result['error_count'],
+            result['wer'], result['wrr'], result['ser'], width=width)
+        if args.bootstrap and evaluation.utterance_lengths:
+            low, high = bootstrap_wer(evaluation.utterance_lengths, evaluation.utterance_errors, args.bootstrap,
+                                      args.confidence, args.seed, args.jobs)
+            row += '  {:.3%} to {:.3%}'.format(low, high)
+        print(row)
+
+def score_files(evaluation, ref_file, hyp_file, args):
+    """Score the lines of a ref and hyp file into an evaluation, the way the
+    command line options say to.  Returns the JoinStats if the lines are
+    joined by ID, otherwise None."""
+    timings = evaluation.timings
+    join_stats = None
+    if args.timed:
+        # Pair up STM segments with the CTM words within them
+        try:
+            from asr_evaluation.timed import timed_pairs
+        except Exception:
+            from timed import timed_pairs
+        pairs = timed_pairs(ref_file, hyp_file)
+    elif args.join_ids:
+        # Pair up the lines by utterance ID rather than line number
+        join_stats = JoinStats()
+        pairs = join_by_id(ref_file, hyp_file, head_ids=args.head_ids, stats=join_stats)
     else:
-        wrr = 0.0
-        wer = 0.0
-    # Compute SER
-    ser = sent_error_count / counter if counter > 0 else 0.0
-    print('Sentence count: {}'.format(counter))
-    print('WER: {:10.3%} ({:10d} / {:10d})'.format(wer, error_count, ref_token_count))
-    print('WRR: {:10.3%} ({:10d} / {:10d})'.format(wrr, match_count, ref_token_count))
-    print('SER: {:10.3%} ({:10d} / {:10d})'.format(ser, sent_error_count, counter))
+        pairs = zip(ref_file, hyp_file)
+    if timings is not None:
+        pairs = timings.timed('read', pairs)
+    output = None
+    if evaluation.print_instances or evaluation.print_errors:
+        # Printed instances are collected in large chunks, which a background
+        # thread writes while the next sentences are aligned
+        try:
+            from asr_evaluation.render import OutputBuffer
+        except Exception:
+            from render import OutputBuffer
+        output = sys.stdout = OutputBuffer(sys.stdout, threaded=True)
+    try:
+        if args.jobs > 1:
+            process_parallel(pairs, evaluation, args.jobs, args.batch_size)
+        elif args.batch_size > 0:
+            while evaluation.add_batch(list(islice(pairs, args.batch_size))):
+                pass
+        else:
+            # Loop through each line of the reference and hyp file
+            for ref_line, hyp_line in pairs:
+                evaluation.add_pair(ref_line, hyp_line)
+    finally:
+        if output is not None:
+            sys.stdout = output.stream
+            output.close()
+    return join_stats
 
+def follow_files(evaluation, ref_file, hyp_files, args):
+    """Score the lines appended to hypothesis files that are still being
+    written, as they're written, and print the running totals every
+    args.interval seconds.  Stops when every reference utterance has been
+    scored, or on Ctrl-C.  Returns the Follower (see asr_evaluation.follow)."""
+    import time
+    try:
+        from asr_evaluation.follow import Follower
+    except Exception:
+        from follow import Follower
+    follower = Follower(ref_file, hyp_files, args.head_ids, args.tail_ids)
+    last_report = time.time()
+    reported = 0
+    try:
+        while not follower.done():
+            pairs = follower.poll()
+            if pairs:
+                score_pairs(evaluation, pairs, args)
+            if time.time() - last_report >= args.interval and evaluation.counter != reported:
+                print_progress(evaluation, follower)
+                last_report = time.time()
+                reported = evaluation.counter
+            if not pairs:
+                time.sleep(follow_poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        follower.close()
+    return follower
+
+def score_pairs(evaluation, pairs, args):
+    """Score a list of (ref line, hyp line) pairs into an evaluation, with
+    the worker processes (if there are enough pairs for them) or the batch
+    size given on the command line."""
+    if args.jobs > 1 and len(pairs) >= args.jobs * shard_size:
+        process_parallel(pairs, evaluation, args.jobs, args.batch_size)
+    elif args.batch_size > 0:
+        for start in range(0, len(pairs), args.batch_size):
+            evaluation.add_batch(pairs[start:start + args.batch_size])
+    else:
+        for ref_line, hyp_line in pairs:
+            evaluation.add_pair(ref_line, hyp_line)
+
+def print_progress(evaluation, follower):
+    """Print a line with the running totals of an evaluation being scored
+    with follow_files."""
+    import time
+    result = evaluation.result()
+    print('{} {:d}/{:d} sentences  {}: {:.3%} ({:d} / {:d})  SER: {:.3%}'.format(
+        time.strftime('%H:%M:%S'), follower.paired, follower.total, rate_names(evaluation)[0], result['wer'],
+        result['error_count'], result['ref_token_count'], result['ser']))
+    sys.stdout.flush()
+
+def print_bootstrap(evaluation, args):
+    """Print a bootstrap confidence interval for the WER."""
+    try:
+        from asr_evaluation.significance import bootstrap_wer
+    except Exception:
+        from significance import bootstrap_wer
+    if not evaluation.utterance_lengths:
+        return
+    low, high = bootstrap_wer(evaluation.utterance_lengths, evaluation.utterance_errors, args.bootstrap,
+                              args.confidence, args.seed, args.jobs)
+    print('{} {:.0%} CI: {:.3%} to {:.3%} (bootstrap, {} resamples)'.format(
+        rate_names(evaluation)[0], args.confidence, low, high, args.bootstrap))
+
+def print_comparison(evaluation, other, args):
+    """Print the summary of a second system scored on the same references,
+    with a paired bootstrap interval for the difference in WER and the p
+    values of paired bootstrap and approximate randomization tests."""
+    try:
+        from asr_evaluation.significance import paired_bootstrap, approximate_randomization
+    except Exception:
+        from significance import paired_bootstrap, approximate_randomization
+    print('Comparison with {}:'.format(args.compare_hyp.name))
+    print_summary(other)
+    if len(evaluation.utterance_errors) != len(other.utterance_errors):
+        print('Cannot test the difference: the hypotheses have {} and {} sentences'.format(
+            len(evaluation.utterance_errors), len(other.utterance_errors)))
+        return
+    if not evaluation.utterance_lengths:
+        return
+    resamples = args.bootstrap or 1000
+    low, high, bootstrap_p = paired_bootstrap(evaluation.utterance_lengths, evaluation.utterance_errors,
+                                              other.utterance_errors, resamples, args.confidence, args.seed,
+                                              args.jobs)
+    randomization_p = approximate_randomization(evaluation.utterance_errors, other.utterance_errors,
+                                                resamples, args.seed, args.jobs)
+    difference = other.result()['wer'] - evaluation.result()['wer']
+    print('{} difference: {:+.3%} ({:.0%} CI: {:+.3%} to {:+.3%})'.format(rate_names(evaluation)[0], difference,
+                                                                          args.confidence, low, high))
+    print('Paired bootstrap p-value:          {:.4f} ({} resamples)'.format(bootstrap_p, resamples))
+    print('Approximate randomization p-value: {:.4f} ({} shuffles)'.format(randomization_p, resamples))
+
+def write_timings(evaluation, path):
+    """Write the evaluation's timings and summary as JSON to a file, or to
+    stdout if path is '-'."""
+    import json
+    report = evaluation.timings.report()
+    report['result'] = evaluation.result()
+    if path == '-':
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        with open(path, 'w') as timings_file:
+            json.dump(report, timings_file, indent=2, sort_keys=True)
 
-def process_line_pair(ref_line, hyp_line, case_insensitive=False, remove_empty_refs=False):
+
+def print_groups(evaluation):
+    """Print the sentence count, reference length, error rate and SER of
+    each group of sentences."""
+    error_name = rate_names(evaluation)[0]
+    print('{:15s} {:20s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('GROUP', 'VALUE', 'SENTENCES', 'TOKENS', error_name,
+                                                                 'SER'))
+    for group in evaluation.group_results():
+        value = group['value'] if group['value'] is not None else '(missing)'
+        print('{:15s} {:20s} {:10d} {:10d} {:10.3%} {:10.3%}'.format(
+            group['column'], value, group['sentence_count'], group['ref_token_count'], group['wer'],
+            group['ser']))
+    print('')
+
+
+def print_follow_stats(follower):
+    """Print how many reference utterances have no hypothesis yet, and how
+    many hypotheses were skipped, if any."""
+    if follower.paired < follower.total:
+        print('Sentences without a hypothesis yet (not scored): {}'.format(follower.total - follower.paired))
+    if follower.extra_hyps:
+        print('Hypotheses without a reference (skipped): {}'.format(follower.extra_hyps))
+    if follower.duplicate_ids:
+        print('Duplicate IDs (first one used): {}'.format(follower.duplicate_ids))
+
+
+def print_join_stats(join_stats):
+    """Print how many utterances couldn't be joined by ID, if any."""
+    if join_stats.missing_hyps:
+        print('Missing hypotheses (scored as deletions): {}'.format(join_stats.missing_hyps))
+    if join_stats.extra_hyps:
+        print('Hypotheses without a reference (skipped): {}'.format(join_stats.extra_hyps))
+    if join_stats.duplicate_ids:
+        print('Duplicate IDs (first one used): {}'.format(join_stats.duplicate_ids))
+
+
+def rate_names(evaluation):
+    """Return the names of the error and recognition rates: ('WER', 'WRR'),
+    or ('CER', 'CRR') when scoring characters."""
+    return ('CER', 'CRR') if evaluation.cer else ('WER', 'WRR')
+
+def print_summary(evaluation):
+    """Print the sentence count, WER, WRR and SER of an evaluation."""
+    result = evaluation.result()
+    error_name, recognition_name = rate_names(evaluation)
+    print('Sentence count: {}'.format(result['sentence_count']))
+    print('{}: {:10.3%} ({:10d} / {:10d})'.format(error_name, result['wer'], result['error_count'],
+                                                  result['ref_token_count']))
+    print('{}: {:10.3%} ({:10d} / {:10d})'.format(recognition_name, result['wrr'], result['match_count'],
+                                                  result['ref_token_count']))
+    print('SER: {:10.3%} ({:10d} / {:10d})'.format(result['ser'], result['sent_error_count'],
+                                                   result['sentence_count']))
+    if result['capped_count']:
+        print('Capped sentences: {} (WER above the maximum; their matches are lower bounds)'.format(
+            result['capped_count']))
+    memo = evaluation.memo
+    if memo is not None and memo.hits + memo.misses > 0:
+        print('Repeated pairs: {:10.3%} ({:10d} / {:10d} alignments reused)'.format(
+            memo.hits / (memo.hits + memo.misses), memo.hits, memo.hits + memo.misses))
+
+
+def process_line_pair(ref_line, hyp_line, evaluation):
     """Given a pair of strings corresponding to a reference and hypothesis,
     compute the edit distance, print if desired, and keep track of results
-    in global variables.
+    in the given Evaluation.
 
     Return true if the pair was counted, false if the pair was not counted due
-    to an empty reference string."""
-    # I don't believe these all need to be global.  In any case, they shouldn't be.
-    global error_count
-    global match_count
-    global ref_token_count
-    global sent_error_count
+    to an empty reference string.  This does not increment the evaluation's
+    sentence counter; Evaluation.add_pair does that."""
+    timings = evaluation.timings
+    if timings is not None:
+        start = timings.start()
+    tokens = split_line_pair(ref_line, hyp_line, evaluation)
+    if timings is not None:
+        timings.stop('tokenize', start)
+    if tokens is None:
+        return False
+    process_tokens(tokens[0], tokens[1], tokens[2], evaluation)
+    return True
+
+def process_tokens(ref, hyp, id_, evaluation):
+    """Align a ref/hyp pair of token ID arrays, print if desired, and keep
+    track of the results in the given Evaluation.  id_ is the utterance ID,
+    if any, for printing."""
+    timings = evaluation.timings
+    if timings is not None:
+        start = timings.start()
+    capped_count = evaluation.capped_count
+    sm, errors, matches = align_pair(ref, hyp, evaluation)
+    record_counts(evaluation, len(ref), errors, matches, id_)
+    if evaluation.records is not None:
+        record = utterance_record(id_, evaluation.counter + 1, len(ref), len(hyp), errors, matches,
+                                  evaluation.capped_count > capped_count)
+        if evaluation.record_alignments:
+            record += (encode_opcodes(sm.get_opcodes()) if sm is not None else None,)
+        evaluation.records.append(record)
+    if timings is not None:
+        start = timings.stop('align', start)
+        count_pair(timings, ref, hyp)
 
+    # If we're keeping track of which words get mixed up with which others, call track_confusions
+    # (capped sentences don't have an alignment)
+    if evaluation.confusions and sm is not None:
+        track_confusions(sm, ref, hyp, evaluation)
+        if timings is not None:
+            start = timings.stop('confusions', start)
+
+    # If we're printing instances, do it here (in roughly the align.c format)
+    if sm is not None and (evaluation.print_instances or (evaluation.print_errors and errors != 0)):
+        if evaluation.renderer is None:
+            evaluation.renderer = new_renderer(evaluation.printing_color())
+        vocab = evaluation.vocab
+        sys.stdout.write(evaluation.renderer.instance(vocab.decode(ref), vocab.decode(hyp), sm, id_,
+                                                      evaluation.counter))
+        if timings is not None:
+            timings.stop('print', start)
+
+def count_pair(timings, ref, hyp):
+    """Count a scored pair in the lines, tokens and cells counters.  The
+    cells are the size of the full dynamic programming table, not the cells
+    actually computed (which can be none, e.g. for a repeated pair)."""
+    timings.count('lines')
+    timings.count('ref_tokens', len(ref))
+    timings.count('hyp_tokens', len(hyp))
+    timings.count('nominal_cells', len(ref) * len(hyp))
+
+def align_pair(ref, hyp, evaluation):
+    """Align a pair of token ID arrays.  Return (sm, errors, matches), where sm is
+    a SequenceMatcher (or an object with the same interface) if the
+    evaluation needs opcodes, and None otherwise."""
+    memo = evaluation.memo
+    if memo is None:
+        return compute_alignment(ref, hyp, evaluation)
+    key = memo.key(ref, hyp)
+    entry = memo.get(key)
+    if entry is not None:
+        alignment, errors, matches, capped = entry
+        if capped:
+            evaluation.capped_count += 1
+        if evaluation.timings is not None:
+            evaluation.timings.count('memo_hits')
+        return alignment, errors, matches
+    capped_count = evaluation.capped_count
+    sm, errors, matches = compute_alignment(ref, hyp, evaluation)
+    # Only the counts and opcodes are kept, not the whole SequenceMatcher
+    alignment = Alignment(errors, matches, sm.get_opcodes()) if sm is not None else None
+    memo.put(key, (alignment, errors, matches, evaluation.capped_count > capped_count))
+    return sm, errors, matches
+
+def compute_alignment(ref, hyp, evaluation):
+    """Align a pair of token ID arrays for align_pair, looking it up in the
+    evaluation's AlignmentCache first if it has one."""
+    need_opcodes = evaluation.needs_opcodes()
+    cache = evaluation.cache
+    if cache is not None:
+        # The cache is keyed on the tokens, since IDs differ from run to run
+        ref_tokens = evaluation.vocab.decode(ref)
+        hyp_tokens = evaluation.vocab.decode(hyp)
+        cached = cache.get(ref_tokens, hyp_tokens, need_opcodes)
+        if cached is not None:
+            if evaluation.timings is not None:
+                evaluation.timings.count('cache_hits')
+            # A cached pair over max_wer is capped just as it would be if it
+            # weren't in the cache (with the same counts)
+            max_wer = evaluation.max_wer
+            if max_wer is not None and len(ref) > 0 and cached.distance() > error_ceiling(max_wer, len(ref)):
+                return align_capped(ref.tolist(), hyp.tolist(), evaluation)
+            return (cached if need_opcodes else None), cached.distance(), cached.matches()
+    # If nothing needs the actual alignment, just count the errors and matches.
+    # Otherwise create an object to get the edit distance, and then retrieve
+    # the relevant counts that we need.
+    # Lists of int IDs are faster to index than the arrays they're stored in
+    ref = ref.tolist()
+    hyp = hyp.tolist()
+    if evaluation.max_wer is not None:
+        capped = align_capped(ref, hyp, evaluation)
+        if capped is not None:
+            return capped
+    if need_opcodes:
+        from edit_distance import SequenceMatcher
+        # Character sequences are long but mostly right, so they're aligned
+        # within a band around the diagonal as wide as the (bit-parallel)
+        # edit distance.  Long pairs (e.g. whole documents), and characters
+        # with too wide a band, are aligned in linear memory.
+        if evaluation.cer:
+            band = align.levenshtein_distance(ref, hyp)
+            if (2 * band + 1) * len(ref) < align.linear_space_min_cells:
+                sm = align.banded_alignment(ref, hyp, band)
+            else:
+                sm = align.linear_space_alignment(ref, hyp)
+        elif len(ref) * len(hyp) >= align.linear_space_min_cells:
+            sm = align.linear_space_alignment(ref, hyp)
+        else:
+            sm = SequenceMatcher(a=ref, b=hyp)
+        errors = get_error_count(sm)
+        matches = get_match_count(sm)
+    else:
+        sm = None
+        errors, matches = edit_counts(ref, hyp)
+    if cache is not None:
+        cache.put(ref_tokens, hyp_tokens, errors, matches, sm.get_opcodes() if sm is not None else None)
+    return sm, errors, matches
+
+def align_capped(ref, hyp, evaluation):
+    """If a pair's WER is over the evaluation's max_wer, count it as capped
+    and return (None, errors, matches) with the matches as a lower bound.
+    If it isn't, return None, unless only counts are needed, in which case
+    the (exact) counts are returned.  Empty refs are never capped."""
+    if not ref:
+        return None
+    ceiling = error_ceiling(evaluation.max_wer, len(ref))
+    if evaluation.needs_opcodes():
+        errors = levenshtein_distance(ref, hyp)
+        if errors <= ceiling:
+            return None
+        matches = min_matches(len(ref), len(hyp), errors)
+    else:
+        errors, matches, capped = capped_edit_counts(ref, hyp, ceiling)
+        if not capped:
+            return None, errors, matches
+    evaluation.capped_count += 1
+    return None, errors, matches
+
+def error_ceiling(max_wer, ref_length):
+    """Return the most errors a sentence of ref_length tokens can have
+    without its WER being above max_wer."""
+    # max_wer * ref_length can come out just under a whole number (e.g.
+    # 0.29 * 100 is 28.999...), which mustn't lower the ceiling
+    return int(max_wer * ref_length + 1e-9)
+
+def process_line_batch(line_pairs, evaluation):
+    """Score a list of (ref line, hyp line) pairs at once with the vectorized
+    aligner in asr_evaluation.batch (which needs NumPy).
+
+    This only updates the counts, so it can't be used when confusions or
+    instances are wanted; Evaluation.add_batch checks for that.  Returns the
+    number of pairs counted, without incrementing the sentence counter."""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        # Rather than the failed import of batch below hiding the reason
+        raise ImportError('Batch alignment (Evaluation.add_batch and -b) needs NumPy')
+    try:
+        from asr_evaluation.batch import align_batch
+    except Exception:
+        from batch import align_batch
+    timings = evaluation.timings
+    if timings is not None:
+        start = timings.start()
+    refs = []
+    hyps = []
+    ids = []
+    for ref_line, hyp_line in line_pairs:
+        tokens = split_line_pair(ref_line, hyp_line, evaluation)
+        if tokens is not None:
+            refs.append(tokens[0])
+            hyps.append(tokens[1])
+            ids.append(tokens[2])
+    if timings is not None:
+        start = timings.stop('tokenize', start)
+    if not refs:
+        return 0
+    if evaluation.memo is not None:
+        counts = align_batch_memo(refs, hyps, evaluation.memo, align_batch)
+    else:
+        counts = align_batch(refs, hyps)
+    records = evaluation.records
+    for i, (errors, matches) in enumerate(counts):
+        record_counts(evaluation, len(refs[i]), errors, matches, ids[i])
+        if records is not None:
+            records.append(utterance_record(ids[i], evaluation.counter + i + 1, len(refs[i]), len(hyps[i]),
+                                            errors, matches))
+    if timings is not None:
+        timings.stop('align', start)
+        for ref, hyp in zip(refs, hyps):
+            count_pair(timings, ref, hyp)
+    return len(refs)
+
+def align_batch_memo(refs, hyps, memo, align_batch):
+    """Return the (errors, matches) of each pair in a batch, aligning only
+    those (distinct) pairs that aren't in an AlignmentMemo with align_batch."""
+    keys = [memo.key(ref, hyp) for ref, hyp in zip(refs, hyps)]
+    counts = [None] * len(keys)
+    # The first of the pairs to align with each key
+    new_keys = {}
+    for i, key in enumerate(keys):
+        if key in new_keys:
+            # A repeat within the batch, filled in below
+            memo.hits += 1
+            continue
+        entry = memo.get(key)
+        if entry is None:
+            new_keys[key] = i
+        else:
+            counts[i] = entry[1:3]
+    first = sorted(new_keys.values())
+    for i, (errors, matches) in zip(first, align_batch([refs[i] for i in first], [hyps[i] for i in first])):
+        counts[i] = (errors, matches)
+        memo.put(keys[i], (None, errors, matches, False))
+    return [pair_counts if pair_counts is not None else counts[new_keys[keys[i]]]
+            for i, pair_counts in enumerate(counts)]
+
+def split_line_pair(ref_line, hyp_line, evaluation):
+    """Split a ref/hyp line pair into tokens, remove IDs and apply the
+    evaluation's options.  Return (ref token IDs, hyp token IDs, id), or None
+    if the pair should be skipped.  The token IDs are array('i') buffers of
+    IDs in the evaluation's vocabulary."""
     # Split into tokens by whitespace
     ref = ref_line.split()
     hyp = hyp_line.split()
     id_ = None
 
     # If the files have IDs, then split the ID off from the text
-    if files_head_ids:
+    if evaluation.head_ids:
         id_ = ref[0]
         ref, hyp = remove_head_id(ref, hyp)
-    elif files_tail_ids:
+    elif evaluation.tail_ids:
         id_ = ref[-1]
         ref, hyp = remove_tail_id(ref, hyp)
 
-    if case_insensitive:
-        ref = list(map(str.lower, ref))
-        hyp = list(map(str.lower, hyp))
-    if remove_empty_refs and len(ref) == 0:
+    # A reference is empty if nothing is left of it after normalization
+    ref = encode_tokens(ref, evaluation)
+    if evaluation.remove_empty_refs and len(ref) == 0:
+        return None
+    return ref, encode_tokens(hyp, evaluation), id_
+
+def encode_tokens(tokens, evaluation):
+    """Return an array('i') of the IDs of the normalized tokens (or
+    characters, in cer mode) of one side of a line pair."""
+    # Down-casing and normalization are done (once per distinct token) by the
+    # vocabulary
+    lower = evaluation.case_insensitive
+    normalizer = evaluation.normalizer
+    if evaluation.cer:
+        if normalizer is not None:
+            tokens = normalizer.normalize_all([token.lower() for token in tokens] if lower else tokens)
+        # The vocabulary encodes the characters of a string one by one
+        return evaluation.vocab.encode(''.join(tokens), lower)
+    return evaluation.vocab.encode(tokens, lower, normalizer)
+
+def process_line_group(ref_line, hyp_lines, evaluations):
+    """Score one reference line against the corresponding line of each of
+    several systems, one evaluation per system.  The evaluations must share
+    a vocabulary (and options), so the reference is only split, stripped of
+    its ID and interned once.  Return true if the line was counted (in every
+    evaluation), false if it was skipped due to an empty reference."""
+    first = evaluations[0]
+    timings = first.timings
+    if timings is not None:
+        start = timings.start()
+    ref = ref_line.split()
+    hyps = [hyp_line.split() for hyp_line in hyp_lines]
+    id_ = None
+    if first.head_ids:
+        id_ = ref[0]
+        hyps = [remove_head_id(ref, hyp)[1] for hyp in hyps]
+        ref = ref[1:]
+    elif first.tail_ids:
+        id_ = ref[-1]
+        hyps = [remove_tail_id(ref, hyp)[1] for hyp in hyps]
+        ref = ref[:-1]
+    ref = encode_tokens(ref, first)
+    if first.remove_empty_refs and len(ref) == 0:
         return False
+    hyps = [encode_tokens(hyp, first) for hyp in hyps]
+    if timings is not None:
+        timings.stop('tokenize', start)
+    for evaluation, hyp in zip(evaluations, hyps):
+        process_tokens(ref, hyp, id_, evaluation)
+        evaluation.counter += 1
+    return True
 
-    # Create an object to get the edit distance, and then retrieve the
-    # relevant counts that we need.
-    sm = SequenceMatcher(a=ref, b=hyp)
-    errors = get_error_count(sm)
-    matches = get_match_count(sm)
-    ref_length = len(ref)
+def new_systems(count, **options):
+    """Return a list of count empty Evaluations with the given options,
+    sharing one vocabulary (and Timings, if any), for score_systems."""
+    first = Evaluation(**options)
+    options['timings'] = first.timings
+    return [first] + [Evaluation(vocab=first.vocab, **options) for _ in range(count - 1)]
 
+def score_systems(evaluations, ref_file, hyp_files, jobs=1, join_ids=False):
+    """Score several hypothesis files against one reference file in a single
+    pass, into a list of evaluations made by new_systems.  With jobs > 1 the
+    lines are scored in a pool of worker processes.  If join_ids is set the
+    lines are paired up by utterance ID, and a list of a JoinStats per
+    hypothesis file is returned; otherwise None."""
+    first = evaluations[0]
+    join_stats = None
+    if join_ids:
+        join_stats = [JoinStats() for _ in hyp_files]
+        groups = join_all_by_id(ref_file, hyp_files, head_ids=first.head_ids, stats=join_stats)
+    else:
+        groups = ((lines[0], lines[1:]) for lines in zip(ref_file, *hyp_files))
+    if first.timings is not None:
+        groups = first.timings.timed('read', groups)
+    if jobs > 1:
+        run_shards(iter_shards(groups, first), process_group_shard,
+                   lambda result: merge_group_shard(evaluations, *result), jobs)
+    else:
+        for ref_line, hyp_lines in groups:
+            process_line_group(ref_line, hyp_lines, evaluations)
+    return join_stats
+
+def record_counts(evaluation, ref_length, errors, matches, id_=None):
+    """Add the counts for one aligned sentence to an evaluation.  id_ is the
+    utterance ID, for grouping by metadata."""
     # Increment the total counts we're tracking
-    error_count += errors
-    match_count += matches
-    ref_token_count += ref_length
+    evaluation.error_count += errors
+    evaluation.match_count += matches
+    evaluation.ref_token_count += ref_length
 
     if errors != 0:
-        sent_error_count += 1
-
-    # If we're keeping track of which words get mixed up with which others, call track_confusions
-    if confusions:
-        track_confusions(sm, ref, hyp)
-
-    # If we're printing instances, do it here (in roughly the align.c format)
-    if print_instances_p or (print_errors_p and errors != 0):
-        print_instances(ref, hyp, sm, id_=id_)
+        evaluation.sent_error_count += 1
+    if evaluation.keep_utterances:
+        evaluation.utterance_lengths.append(ref_length)
+        evaluation.utterance_errors.append(errors)
+    if evaluation.group_counts is not None:
+        evaluation.group_counts.add(evaluation.metadata.keys(id_, ref_length), ref_length, errors, matches)
 
     # Keep track of the individual error rates, and reference lengths, so we
     # can compute average WERs by sentence length
-    lengths.append(ref_length)
-    error_rate = errors * 1.0 / len(ref) if len(ref) > 0 else float("inf")
-    error_rates.append(error_rate)
-    wer_bins[len(ref)].append(error_rate)
-    return True
+    error_rate = errors * 1.0 / ref_length if ref_length > 0 else float("inf")
+    if evaluation.streaming:
+        evaluation.wer_bins[ref_length].add(error_rate)
+    else:
+        evaluation.lengths.append(ref_length)
+        evaluation.error_rates.append(error_rate)
+        evaluation.wer_bins[ref_length].append(error_rate)
+
+def process_parallel(pairs, evaluation, jobs, batch_size=0):
+    """Score an iterable of (ref line, hyp line) pairs with a pool of worker processes.
+
+    The pairs are cut into contiguous shards, each worker scores a shard
+    into a fresh Evaluation with the same options, and the shards are merged
+    into the given evaluation in file order.  This makes the totals and
+    printed tables identical to a single process run.  If batch_size is
+    set, the workers use Evaluation.add_batch on their shards."""
+    run_shards(iter_shards(pairs, evaluation, batch_size), process_shard,
+               lambda result: merge_shard(evaluation, *result), jobs)
 
-def set_global_variables(args):
-    """Copy argparse args into global variables."""
-    global print_instances_p
-    global print_errors_p
-    global files_head_ids
-    global files_tail_ids
-    global confusions
-    global min_count
-    global wer_vs_length_p
-    # Put the command line options into global variables.
-    print_instances_p = args.print_instances
-    print_errors_p = args.print_errors
-    files_head_ids = args.head_ids
-    files_tail_ids = args.tail_ids
-    confusions = args.confusions
-    min_count = args.min_word_count
-    wer_vs_length_p = args.print_wer_vs_length
+def run_shards(shards, worker, merge, jobs):
+    """Run worker on each shard in a pool of jobs processes, and call merge
+    on the results in shard order."""
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Only keep a few shards in flight, so the input is read as the
+        # workers need it rather than all at once.
+        pending = deque()
+        for shard in shards:
+            pending.append(pool.apply_async(worker, (shard,)))
+            if len(pending) >= 2 * jobs:
+                merge(pending.popleft().get())
+        while pending:
+            merge(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+
+def merge_shard(evaluation, shard_evaluation, output, exit_code):
+    """Print the output of a shard returned by process_shard and merge its counts."""
+    if output:
+        sys.stdout.write(output)
+    if exit_code is not None:
+        exit(exit_code)
+    evaluation.merge(shard_evaluation)
+
+def iter_shards(pairs, evaluation, batch_size=0):
+    """Yield (options, sentence offset, line pairs, batch size) tuples for
+    process_shard.  The pairs can also be (ref line, hyp lines) groups, for
+    process_group_shard.
+
+    The offset is the number of sentences counted before the shard, so the
+    SENTENCE numbers printed by the workers match a sequential run."""
+    options = evaluation.options()
+    pairs = iter(pairs)
+    offset = evaluation.counter
+    # The offset only shows in printed sentence numbers and output records,
+    # so without those the workers are left to find the empty references
+    numbered = evaluation.print_instances or evaluation.print_errors or evaluation.records is not None
+    while True:
+        shard = list(islice(pairs, shard_size))
+        if not shard:
+            return
+        yield options, offset, shard, batch_size
+        if evaluation.remove_empty_refs and numbered:
+            offset += sum(1 for ref_line, _ in shard if has_reference(ref_line, evaluation))
+        else:
+            offset += len(shard)
+
+def has_reference(ref_line, evaluation):
+    """Return true if anything is left of a reference line once its ID is
+    removed and it's normalized, the way split_line_pair decides whether
+    remove_empty_refs skips it.  Only tokens up to the first one that
+    isn't normalized away are looked at."""
+    ref = ref_line.split()
+    if evaluation.head_ids:
+        ref = ref[1:]
+    elif evaluation.tail_ids:
+        ref = ref[:-1]
+    normalizer = evaluation.normalizer
+    if normalizer is None:
+        return len(ref) > 0
+    if evaluation.case_insensitive:
+        return any(normalizer.normalize(token.lower()) for token in ref)
+    return any(normalizer.normalize(token) for token in ref)
+
+def process_shard(shard):
+    """Worker side of process_parallel: score one shard into a new
+    Evaluation and return it with any printed output and exit code."""
+    options, offset, pairs, batch_size = shard
+    evaluation = Evaluation(**options)
+    # Start counting at the offset so printed sentence numbers are global
+    evaluation.counter = offset
+    memo_state = attach_worker_memo(evaluation)
+    stdout = sys.stdout
+    sys.stdout = output = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    exit_code = None
+    try:
+        if batch_size > 0:
+            for start in range(0, len(pairs), batch_size):
+                evaluation.add_batch(pairs[start:start + batch_size])
+        else:
+            for ref_line, hyp_line in pairs:
+                evaluation.add_pair(ref_line, hyp_line)
+    except SystemExit as e:
+        # Mismatched IDs; let the parent print what we have and exit.
+        exit_code = e.code
+    finally:
+        sys.stdout = stdout
+        if evaluation.cache is not None:
+            evaluation.cache.close()
+        detach_worker_memo(evaluation, memo_state)
+    evaluation.counter -= offset
+    return evaluation, output.getvalue(), exit_code
+
+def attach_worker_memo(evaluation, system=0):
+    """Swap a shard's new AlignmentMemo (if it has one) for the worker
+    process's memo of the system, rekeyed to the shard's vocabulary.
+    Returns what detach_worker_memo needs to swap it back."""
+    memo = evaluation.memo
+    if memo is None:
+        return None
+    worker_memo = worker_memos.get(system)
+    if worker_memo is None or worker_memo.max_entries != memo.max_entries:
+        worker_memo = worker_memos[system] = type(memo)(memo.max_entries)
+    worker_memo.rekey(evaluation.vocab)
+    evaluation.memo = worker_memo
+    return memo, worker_memo.hits, worker_memo.misses
+
+def detach_worker_memo(evaluation, memo_state):
+    """Put a shard's own memo back after attach_worker_memo, with just the
+    shard's hits and misses, so the entries aren't sent to the parent."""
+    if memo_state is None:
+        return
+    memo, hits, misses = memo_state
+    worker_memo = evaluation.memo
+    memo.hits = worker_memo.hits - hits
+    memo.misses = worker_memo.misses - misses
+    evaluation.memo = memo
+
+def process_group_shard(shard):
+    """Worker side of score_systems with jobs: like process_shard, but the
+    shard is of (ref line, hyp lines) groups, scored into a new evaluation
+    per system."""
+    options, offset, groups, _ = shard
+    evaluations = new_systems(len(groups[0][1]), **options)
+    for evaluation in evaluations:
+        evaluation.counter = offset
+    memo_states = [attach_worker_memo(evaluation, system) for system, evaluation in enumerate(evaluations)]
+    stdout = sys.stdout
+    sys.stdout = output = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    exit_code = None
+    try:
+        for ref_line, hyp_lines in groups:
+            process_line_group(ref_line, hyp_lines, evaluations)
+    except SystemExit as e:
+        exit_code = e.code
+    finally:
+        sys.stdout = stdout
+        if evaluations[0].cache is not None:
+            evaluations[0].cache.close()
+        for evaluation, memo_state in zip(evaluations, memo_states):
+            detach_worker_memo(evaluation, memo_state)
+    for evaluation in evaluations:
+        evaluation.counter -= offset
+    return evaluations, output.getvalue(), exit_code
+
+def merge_group_shard(evaluations, shard_evaluations, output, exit_code):
+    """Print the output of a shard returned by process_group_shard and merge
+    its counts into the evaluation of each system."""
+    if output:
+        sys.stdout.write(output)
+    if exit_code is not None:
+        exit(exit_code)
+    # The systems share one Timings, so only merge it once
+    timings = evaluations[0].timings
+    if timings is not None:
+        timings.merge(shard_evaluations[0].timings)
+    for evaluation, shard_evaluation in zip(evaluations, shard_evaluations):
+        shard_evaluation.timings = None
+        evaluation.merge(shard_evaluation)
 
 def remove_head_id(ref, hyp):
     """Assumes that the ID is the begin token of the string which is common
@@ -204,62 +1273,72 @@ def remove_tail_id(ref, hyp):
     hyp = hyp[:-1]
     return ref, hyp
 
-def print_instances(ref, hyp, sm, id_=None):
-    """Print a single instance of a ref/hyp pair."""
-    print_diff(sm, ref, hyp)
-    if id_:
-        print(('SENTENCE {0:d}  {1!s}'.format(counter + 1, id_)))
-    else:
-        print('SENTENCE {0:d}'.format(counter + 1))
-    # Handle cases where the reference is empty without dying
-    if len(ref) != 0:
-        correct_rate = sm.matches() / len(ref)
-        error_rate = sm.distance() / len(ref)
-    elif sm.matches() == 0:
-        correct_rate = 1.0
-        error_rate = 0.0
-    else:
-        correct_rate = 0.0
-        error_rate = sm.matches()
-    print('Correct          = {0:6.1%}  {1:3d}   ({2:6d})'.format(correct_rate, sm.matches(), len(ref)))
-    print('Errors           = {0:6.1%}  {1:3d}   ({2:6d})'.format(error_rate, sm.distance(), len(ref)))
+def print_instances(ref, hyp, sm, id_=None, counter=0, renderer=None):
+    """Print a single instance of a ref/hyp pair.  counter is the number of
+    sentences that came before it.  renderer is the Renderer to format it
+    with (by default, one with color if stdout is a terminal)."""
+    if renderer is None:
+        renderer = new_renderer()
+    sys.stdout.write(renderer.instance(ref, hyp, sm, id_, counter))
+
+def new_renderer(color=None):
+    """Return a Renderer, with color if color is true, or if it's None and
+    stdout is a terminal."""
+    try:
+        from asr_evaluation.render import Renderer, color_enabled
+    except Exception:
+        from render import Renderer, color_enabled
+    return Renderer(color_enabled() if color is None else color)
 
-def track_confusions(sm, seq1, seq2):
-    """Keep track of the errors in a global variable, given a sequence matcher."""
+def track_confusions(sm, seq1, seq2, evaluation):
+    """Keep track of the errors in the tables of an Evaluation, given a sequence matcher."""
     opcodes = sm.get_opcodes()
     for tag, i1, i2, j1, j2 in opcodes:
         if tag == 'insert':
             for i in range(j1, j2):
                 word = seq2[i]
-                insertion_table[word] += 1
+                evaluation.insertion_table[word] += 1
         elif tag == 'delete':
             for i in range(i1, i2):
                 word = seq1[i]
-                deletion_table[word] += 1
+                evaluation.deletion_table[word] += 1
         elif tag == 'replace':
             for w1 in seq1[i1:i2]:
                 for w2 in seq2[j1:j2]:
                     key = (w1, w2)
-                    substitution_table[key] += 1
+                    evaluation.substitution_table[key] += 1
 
-def print_confusions():
+def print_confusions(evaluation, min_count=0, top=None):
     """Print the confused words that we found... grouped by insertions, deletions
-    and substitutions."""
+    and substitutions.  If top is given, only the top most frequent of each."""
+    insertion_table, deletion_table, substitution_table = evaluation.confusion_tables()
     if len(insertion_table) > 0:
-        print('INSERTIONS:')
-        for item in sorted(list(insertion_table.items()), key=lambda x: x[1], reverse=True):
-            if item[1] >= min_count:
-                print('{0:20s} {1:10d}'.format(*item))
+        print('INSERTIONS:' + approximate_note(evaluation.insertion_table))
+        for item in most_frequent(insertion_table, min_count, top):
+            print('{0:20s} {1:10d}'.format(*item))
     if len(deletion_table) > 0:
-        print('DELETIONS:')
-        for item in sorted(list(deletion_table.items()), key=lambda x: x[1], reverse=True):
-            if item[1] >= min_count:
-                print('{0:20s} {1:10d}'.format(*item))
+        print('DELETIONS:' + approximate_note(evaluation.deletion_table))
+        for item in most_frequent(deletion_table, min_count, top):
+            print('{0:20s} {1:10d}'.format(*item))
     if len(substitution_table) > 0:
-        print('SUBSTITUTIONS:')
-        for [w1, w2], count in sorted(list(substitution_table.items()), key=lambda x: x[1], reverse=True):
-            if count >= min_count:
-                print('{0:20s} -> {1:20s}   {2:10d}'.format(w1, w2, count))
+        print('SUBSTITUTIONS:' + approximate_note(evaluation.substitution_table))
+        for [w1, w2], count in most_frequent(substitution_table, min_count, top):
+            print('{0:20s} -> {1:20s}   {2:10d}'.format(w1, w2, count))
+
+def most_frequent(table, min_count=0, top=None):
+    """Return the (key, count) items of a table with at least min_count,
+    most frequent first (ties in table order), and only the top ones if
+    top is given.  Only those are sorted, with a heap."""
+    items = [item for item in table if item[1] >= min_count]
+    if top is not None:
+        return heapq.nlargest(top, items, key=lambda x: x[1])
+    return sorted(items, key=lambda x: x[1], reverse=True)
+
+def approximate_note(table):
+    """Return a note on how far off the counts of a SpaceSaving table may be,
+    or '' if they're exact."""
+    floor = getattr(table, 'floor', 0)
+    return ' (approximate; counts may be over by up to {})'.format(floor) if floor else ''
 
 # TODO - For some reason I was getting two different counts depending on how I count the matches,
 # so do an assertion in this code to make sure we're getting matching counts.
@@ -283,85 +1362,27 @@ def get_error_count(sm):
     error_lengths = [max(x[2] - x[1], x[4] - x[3]) for x in errors]
     return reduce(lambda x, y: x + y, error_lengths, 0)
 
-# TODO - This is long and ugly.  Perhaps we can break it up?
-# It would make more sense for this to just return the two strings...
 def print_diff(sm, seq1, seq2, prefix1='REF:', prefix2='HYP:', suffix1=None, suffix2=None):
     """Given a sequence matcher and the two sequences, print a Sphinx-style
     'diff' off the two."""
-    ref_tokens = []
-    hyp_tokens = []
-    opcodes = sm.get_opcodes()
-    for tag, i1, i2, j1, j2 in opcodes:
-        # If they are equal, do nothing except lowercase them
-        if tag == 'equal':
-            for i in range(i1, i2):
-                ref_tokens.append(seq1[i].lower())
-            for i in range(j1, j2):
-                hyp_tokens.append(seq2[i].lower())
-        # For insertions and deletions, put a filler of '***' on the other one, and
-        # make the other all caps
-        elif tag == 'delete':
-            for i in range(i1, i2):
-                ref_token = colored(seq1[i].upper(), 'red')
-                ref_tokens.append(ref_token)
-            for i in range(i1, i2):
-                hyp_token = colored('*' * len(seq1[i]), 'red')
-                hyp_tokens.append(hyp_token)
-        elif tag == 'insert':
-            for i in range(j1, j2):
-                ref_token = colored('*' * len(seq2[i]), 'red')
-                ref_tokens.append(ref_token)
-            for i in range(j1, j2):
-                hyp_token = colored(seq2[i].upper(), 'red')
-                hyp_tokens.append(hyp_token)
-        # More complicated logic for a substitution
-        elif tag == 'replace':
-            seq1_len = i2 - i1
-            seq2_len = j2 - j1
-            # Get a list of tokens for each
-            s1 = list(map(str.upper, seq1[i1:i2]))
-            s2 = list(map(str.upper, seq2[j1:j2]))
-            # Pad the two lists with False values to get them to the same length
-            if seq1_len > seq2_len:
-                for i in range(0, seq1_len - seq2_len):
-                    s2.append(False)
-            if seq1_len < seq2_len:
-                for i in range(0, seq2_len - seq1_len):
-                    s1.append(False)
-            assert len(s1) == len(s2)
-            # Pair up words with their substitutions, or fillers
-            for i in range(0, len(s1)):
-                w1 = s1[i]
-                w2 = s2[i]
-                # If we have two words, make them the same length
-                if w1 and w2:
-                    if len(w1) > len(w2):
-                        s2[i] = w2 + ' ' * (len(w1) - len(w2))
-                    elif len(w1) < len(w2):
-                        s1[i] = w1 + ' ' * (len(w2) - len(w1))
-                # Otherwise, create an empty filler word of the right width
-                if not w1:
-                    s1[i] = '*' * len(w2)
-                if not w2:
-                    s2[i] = '*' * len(w1)
-            s1 = map(lambda x: colored(x, 'red'), s1)
-            s2 = map(lambda x: colored(x, 'red'), s2)
-            ref_tokens += s1
-            hyp_tokens += s2
-    if prefix1: ref_tokens.insert(0, prefix1)
-    if prefix2: hyp_tokens.insert(0, prefix2)
-    if suffix1: ref_tokens.append(suffix1)
-    if suffix2: hyp_tokens.append(suffix2)
-    print(' '.join(ref_tokens))
-    print(' '.join(hyp_tokens))
+    ref_line, hyp_line = new_renderer().diff(sm.get_opcodes(), seq1, seq2, prefix1, prefix2, suffix1, suffix2)
+    sys.stdout.write(ref_line + '\n' + hyp_line + '\n')
 
 def mean(seq):
-    """Return the average of the elements of a sequence."""
+    """Return the average of the elements of a sequence, or of a RunningStats."""
+    if isinstance(seq, RunningStats):
+        return seq.mean()
     return float(sum(seq)) / len(seq) if len(seq) > 0 else float('nan')
 
-def print_wer_vs_length():
-    """Print the average word error rate for each length sentence."""
-    avg_wers = {length: mean(wers) for length, wers in wer_bins.items()}
+def print_wer_vs_length(evaluation):
+    """Print the average word error rate for each length sentence.  If the
+    evaluation keeps reservoir samples, also print the estimated median and
+    90th percentile."""
+    avg_wers = {length: mean(wers) for length, wers in evaluation.wer_bins.items()}
     for length, avg_wer in sorted(avg_wers.items(), key=lambda x: (x[1], x[0])):
-        print('{0:5d} {1:f}'.format(length, avg_wer))
+        if evaluation.reservoir_size > 0:
+            wers = evaluation.wer_bins[length]
+            print('{0:5d} {1:f} {2:f} {3:f}'.format(length, avg_wer, wers.quantile(0.5), wers.quantile(0.9)))
+        else:
+            print('{0:5d} {1:f}'.format(length, avg_wer))
     print('')
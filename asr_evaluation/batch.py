@@ -0,0 +1,219 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Vectorized alignment of many utterances at once with NumPy.
+
+The utterances are sorted by length and cut into buckets, each bucket is
+padded into 2d arrays, and the edit distance recurrence is run one
+anti-diagonal at a time for the whole bucket.  All cells on an
+anti-diagonal only depend on the two previous anti-diagonals, so each step
+is a handful of array operations instead of a Python loop over cells.
+
+The counts (and opcodes) are the same as edit_distance.SequenceMatcher
+gives, including how ties between equally cheap alignments are broken.
+
+This module needs NumPy (pip install asr_evaluation[batch]).
+"""
+from __future__ import division
+
+import numpy as np
+
+try:
+    from asr_evaluation.align import strip_common_affixes
+except Exception:
+    from align import strip_common_affixes
+
+# Actions stored in the backtrace arrays
+SUBSTITUTE = 0
+INSERT = 1
+DELETE = 2
+
+# Upper bound on the number of dynamic programming cells in one bucket
+max_bucket_cells = 1 << 22
+
+
+def align_batch(refs, hyps, backtrace=False):
+    """Align each refs[k] with hyps[k].  The sequences should be lists or
+    arrays of integer token IDs.
+
+    Returns a list with an (errors, matches) tuple per utterance, in the
+    order given, or (errors, matches, opcodes) tuples if backtrace is true.
+    The opcodes are in the same format as SequenceMatcher.get_opcodes()."""
+    if len(refs) != len(hyps):
+        raise ValueError('Got {} references but {} hypotheses'.format(len(refs), len(hyps)))
+    if not backtrace:
+        return align_batch_counts(refs, hyps)
+    results = [None] * len(refs)
+    for bucket in length_buckets(refs, hyps):
+        bucket_refs = [refs[k] for k in bucket]
+        bucket_hyps = [hyps[k] for k in bucket]
+        for k, result in zip(bucket, align_bucket(bucket_refs, bucket_hyps, backtrace)):
+            results[k] = result
+    return results
+
+def align_batch_counts(refs, hyps):
+    """The (errors, matches) of each pair, for align_batch.  As in
+    edit_counts, the tokens shared by the start and end of a pair always
+    align as matches, so only the rest is padded and aligned.  Identical
+    pairs, and pairs where one side is all shared tokens, aren't aligned at
+    all: with short utterances that's most of them."""
+    results = [None] * len(refs)
+    # Indices, trimmed refs and trimmed hyps of the pairs left to align
+    left = []
+    left_refs = []
+    left_hyps = []
+    shared = [0] * len(refs)
+    for k, (ref, hyp) in enumerate(zip(refs, hyps)):
+        if ref == hyp:
+            results[k] = (0, len(ref))
+            continue
+        prefix, suffix = strip_common_affixes(ref, hyp)
+        if prefix or suffix:
+            ref = ref[prefix:len(ref) - suffix]
+            hyp = hyp[prefix:len(hyp) - suffix]
+        if not ref or not hyp:
+            results[k] = (len(ref) + len(hyp), prefix + suffix)
+            continue
+        shared[k] = prefix + suffix
+        left.append(k)
+        left_refs.append(ref)
+        left_hyps.append(hyp)
+    for bucket in length_buckets(left_refs, left_hyps):
+        bucket_refs = [left_refs[k] for k in bucket]
+        bucket_hyps = [left_hyps[k] for k in bucket]
+        for k, (errors, matches) in zip(bucket, align_bucket(bucket_refs, bucket_hyps)):
+            k = left[k]
+            results[k] = (errors, matches + shared[k])
+    return results
+
+def length_buckets(refs, hyps):
+    """Sort the utterance indices by length and yield them in buckets whose
+    padded dynamic programming tables hold at most max_bucket_cells cells."""
+    order = sorted(range(len(refs)), key=lambda k: (len(refs[k]), len(hyps[k])))
+    bucket = []
+    max_ref = max_hyp = 0
+    for k in order:
+        new_ref = max(max_ref, len(refs[k]))
+        new_hyp = max(max_hyp, len(hyps[k]))
+        if bucket and (len(bucket) + 1) * (new_ref + 1) * (new_hyp + 1) > max_bucket_cells:
+            yield bucket
+            bucket = []
+            new_ref = len(refs[k])
+            new_hyp = len(hyps[k])
+        bucket.append(k)
+        max_ref = new_ref
+        max_hyp = new_hyp
+    if bucket:
+        yield bucket
+
+def pad(seqs, lengths, fill):
+    """Return a 2d int array holding the sequences, padded with fill."""
+    padded = np.full((len(seqs), max(int(lengths.max()), 1)), fill, dtype=np.int64)
+    mask = np.arange(padded.shape[1]) < lengths[:, None]
+    padded[mask] = [token for seq in seqs for token in seq]
+    return padded
+
+def align_bucket(refs, hyps, backtrace=False):
+    """Run the wavefront dynamic program over one bucket of utterances."""
+    batch = len(refs)
+    ref_lengths = np.array([len(ref) for ref in refs])
+    hyp_lengths = np.array([len(hyp) for hyp in hyps])
+    n = int(ref_lengths.max())
+    m = int(hyp_lengths.max())
+    # The padding values never equal each other or a real token ID.  The
+    # hypotheses are stored reversed, so that the hyp tokens along an
+    # anti-diagonal are a contiguous slice rather than a fancy index.
+    ref_ids = pad(refs, ref_lengths, -1)
+    hyp_rev = pad(hyps, hyp_lengths, -2)[:, ::-1].copy()
+    width = hyp_rev.shape[1]
+    # Anti-diagonal arrays are indexed by the reference position i, so the
+    # cell (i, j) of anti-diagonal d is stored at index i.
+    dist = [np.zeros((batch, n + 1), dtype=np.int32) for _ in range(3)]
+    match = [np.zeros((batch, n + 1), dtype=np.int32) for _ in range(3)]
+    actions = np.zeros((batch, n + 1, m + 1), dtype=np.int8) if backtrace else None
+    totals = ref_lengths + hyp_lengths
+    errors = np.zeros(batch, dtype=np.int64)
+    matches = np.zeros(batch, dtype=np.int64)
+    done = totals == 0
+    for d in range(1, n + m + 1):
+        cur_dist, prev_dist, prev2_dist = dist[d % 3], dist[(d - 1) % 3], dist[(d - 2) % 3]
+        cur_match, prev_match, prev2_match = match[d % 3], match[(d - 1) % 3], match[(d - 2) % 3]
+        # The edges of the table: all insertions or all deletions
+        if d <= m:
+            cur_dist[:, 0] = d
+            cur_match[:, 0] = 0
+            if backtrace:
+                actions[:, 0, d] = INSERT
+        if d <= n:
+            cur_dist[:, d] = d
+            cur_match[:, d] = 0
+            if backtrace:
+                actions[:, d, 0] = DELETE
+        lo = max(1, d - m)
+        hi = min(n, d - 1)
+        if lo <= hi:
+            # hyp position j - 1 = d - i - 1 is at width - d + i in hyp_rev
+            equal = ref_ids[:, lo - 1:hi] == hyp_rev[:, width - d + lo:width - d + hi + 1]
+            sub_dist = prev2_dist[:, lo - 1:hi] + ~equal
+            ins_dist = prev_dist[:, lo:hi + 1] + 1
+            del_dist = prev_dist[:, lo - 1:hi] + 1
+            # Ties go to substitution, then insertion, then deletion
+            take_ins = ins_dist <= del_dist
+            gap_dist = np.minimum(ins_dist, del_dist)
+            take_sub = sub_dist <= gap_dist
+            cur_dist[:, lo:hi + 1] = np.minimum(sub_dist, gap_dist)
+            gap_match = np.where(take_ins, prev_match[:, lo:hi + 1], prev_match[:, lo - 1:hi])
+            cur_match[:, lo:hi + 1] = np.where(take_sub, prev2_match[:, lo - 1:hi] + equal, gap_match)
+            if backtrace:
+                i = np.arange(lo, hi + 1)
+                actions[:, i, d - i] = np.where(take_sub, SUBSTITUTE, np.where(take_ins, INSERT, DELETE))
+        finished = totals == d
+        if finished.any():
+            ks = np.nonzero(finished)[0]
+            errors[ks] = cur_dist[ks, ref_lengths[ks]]
+            matches[ks] = cur_match[ks, ref_lengths[ks]]
+            done |= finished
+            if done.all():
+                break
+    if not backtrace:
+        return list(zip(errors.tolist(), matches.tolist()))
+    return [(int(errors[k]), int(matches[k]), backtrace_opcodes(actions[k], refs[k], hyps[k]))
+            for k in range(batch)]
+
+def backtrace_opcodes(actions, ref, hyp):
+    """Follow the stored actions back from the end of the table and return
+    the opcodes in SequenceMatcher.get_opcodes() format."""
+    i = len(ref)
+    j = len(hyp)
+    opcodes = []
+    while i != 0 or j != 0:
+        action = actions[i, j]
+        if i == 0:
+            action = INSERT
+        elif j == 0:
+            action = DELETE
+        if action == SUBSTITUTE:
+            tag = 'equal' if ref[i - 1] == hyp[j - 1] else 'replace'
+            opcodes.append([tag, i - 1, i, j - 1, j])
+            i -= 1
+            j -= 1
+        elif action == INSERT:
+            opcodes.append(['insert', i, i, j - 1, j])
+            j -= 1
+        else:
+            opcodes.append(['delete', i - 1, i, j, j])
+            i -= 1
+    opcodes.reverse()
+    return opcodes
@@ -0,0 +1,220 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A persistent, size-bounded cache of alignments in an SQLite file.
+
+Entries are keyed by a hash of the reference and hypothesis tokens after
+ID removal and normalization (e.g. down-casing with --case-insensitive), so
+a re-run only aligns the utterances whose text changed.  Each entry stores
+the error and match counts, and the opcodes if they were ever needed.
+When the file holds more than max_entries alignments, the least recently
+used ones are dropped.
+
+An AlignmentMemo is the in-memory counterpart, for corpora in which the
+same sentence pairs come up again and again within one run.
+"""
+import hashlib
+import sqlite3
+from array import array
+from collections import OrderedDict
+
+try:
+    from asr_evaluation.align import Alignment, encode_opcodes, decode_opcodes
+except Exception:
+    from align import Alignment, encode_opcodes, decode_opcodes
+
+# Bump this if the alignment itself changes, so old entries aren't reused
+CACHE_VERSION = b'1'
+
+# The bytes of an array (array.tobytes() is tostring() on Python 2)
+_array_bytes = getattr(array, 'tobytes', None) or array.tostring
+
+
+def pair_key(ref, hyp):
+    """Return the cache key for a pair of token lists."""
+    digest = hashlib.sha1(CACHE_VERSION)
+    for tokens in (ref, hyp):
+        digest.update(b'\x1e')
+        digest.update('\x1f'.join(tokens).encode('utf-8'))
+    return digest.digest()
+
+
+class AlignmentCache(object):
+    """An SQLite-backed alignment cache.  The database is opened lazily, so a
+    cache can be pickled and sent to worker processes, each of which opens
+    its own connection."""
+
+    # Commit (and write back recency updates) after this many changes
+    commit_interval = 10000
+
+    def __init__(self, path, max_entries=1000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = None
+        self.clock = 0
+        self.touched = {}
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __reduce__(self):
+        return (AlignmentCache, (self.path, self.max_entries))
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS alignments ('
+                                    'key BLOB PRIMARY KEY, errors INTEGER, matches INTEGER, '
+                                    'opcodes TEXT, last_used INTEGER)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used)')
+            row = self.connection.execute('SELECT MAX(last_used) FROM alignments').fetchone()
+            self.clock = row[0] or 0
+        return self.connection
+
+    def check(self):
+        """Open the database (creating it if needed) and make sure it can be
+        written to.  Raises sqlite3.Error if it can't."""
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        connection.rollback()
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def get(self, ref, hyp, need_opcodes=False):
+        """Return a cached Alignment for the pair, or None.  If need_opcodes is
+        true, entries that were stored without opcodes count as misses."""
+        key = pair_key(ref, hyp)
+        row = self.connect().execute('SELECT errors, matches, opcodes FROM alignments WHERE key = ?',
+                                     (key,)).fetchone()
+        if row is None or (need_opcodes and row[2] is None):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched[key] = self.tick()
+        self.changed()
+        opcodes = decode_opcodes(row[2]) if row[2] is not None else None
+        return Alignment(row[0], row[1], opcodes)
+
+    def put(self, ref, hyp, errors, matches, opcodes=None):
+        """Store the counts (and optionally opcodes) for a pair."""
+        key = pair_key(ref, hyp)
+        letters = encode_opcodes(opcodes) if opcodes is not None else None
+        self.connect().execute('INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?)',
+                               (key, errors, matches, letters, self.tick()))
+        self.touched.pop(key, None)
+        self.changed()
+
+    def changed(self):
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        """Write back the recency of cache hits, evict the least recently used
+        entries beyond max_entries, and commit."""
+        if self.connection is None:
+            return
+        connection = self.connection
+        if self.touched:
+            connection.executemany('UPDATE alignments SET last_used = ? WHERE key = ?',
+                                   [(used, key) for key, used in self.touched.items()])
+            self.touched = {}
+        count = connection.execute('SELECT COUNT(*) FROM alignments').fetchone()[0]
+        if count > self.max_entries:
+            connection.execute('DELETE FROM alignments WHERE key IN '
+                               '(SELECT key FROM alignments ORDER BY last_used LIMIT ?)',
+                               (count - self.max_entries,))
+        connection.commit()
+        self.pending = 0
+
+    def close(self):
+        """Commit and close the database."""
+        if self.connection is not None:
+            self.commit()
+            self.connection.close()
+            self.connection = None
+
+
+class AlignmentMemo(object):
+    """An in-memory cache of the alignments of the max_entries most recently
+    seen distinct sentence pairs, least recently used first out.
+
+    It's keyed on the arrays of token IDs (see key()), after ID removal and
+    normalization, so it's only valid along with the vocabulary that
+    assigned them, unless it's rekeyed (see rekey()).  Entries are whatever
+    the caller stores; hits and misses count the lookups."""
+    __slots__ = ('max_entries', 'entries', 'hits', 'misses', 'vocab', 'ids', 'token_ids')
+
+    def __init__(self, max_entries):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Set by rekey(): the vocabulary the pairs' IDs are from, a list
+        # mapping those IDs to the memo's own, and the memo's own IDs
+        self.vocab = None
+        self.ids = None
+        self.token_ids = None
+
+    def key(self, ref, hyp):
+        """Return the key for a pair of token ID arrays."""
+        ids = self.ids
+        if ids is None:
+            return _array_bytes(ref), _array_bytes(hyp)
+        tokens = self.vocab.tokens
+        if len(ids) < len(tokens):
+            token_ids = self.token_ids
+            ids.extend([token_ids.setdefault(token, len(token_ids)) for token in tokens[len(ids):]])
+        return tuple([ids[i] for i in ref]), tuple([ids[i] for i in hyp])
+
+    def rekey(self, vocab):
+        """Take the pairs' token IDs from another vocabulary from now on,
+        keeping the entries.  The keys are then in the memo's own IDs, so
+        one memo can be used with a vocabulary per shard of a corpus (as in
+        a worker process)."""
+        if self.token_ids is None:
+            if self.entries:
+                raise ValueError('Only an empty memo can be rekeyed the first time')
+            self.token_ids = {}
+        self.vocab = vocab
+        self.ids = []
+
+    def get(self, key):
+        """Return the entry for a key (making it the most recently used), or None."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """Store an entry, dropping the least recently used one if full."""
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def merge(self, other):
+        """Add the hit and miss counts of another memo (e.g. from a worker
+        process) to this one's."""
+        self.hits += other.hits
+        self.misses += other.misses
+        return self
@@ -0,0 +1,125 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Following hypothesis files that are still being written (e.g. by a
+decoding job), so they can be scored as they grow.
+
+A Follower remembers how far it has read each hypothesis file, and each
+call to poll() returns (ref line, hyp line) pairs for just the lines
+appended since the last call.  A line is only returned once it's complete
+(ends with a newline), so a line that's half written is picked up on a
+later poll.
+
+Without IDs there is one hypothesis file, and its lines are paired with
+the reference lines by line number, reading the reference along with it.
+With IDs, there can be several hypothesis files (e.g. one per decoding
+shard), and their lines are paired with the reference by ID through a
+MappedTranscript index of the reference, in the order they're written.
+"""
+try:
+    from asr_evaluation.reader import MappedTranscript
+except Exception:
+    from reader import MappedTranscript
+
+
+class LineTail(object):
+    """Reads the complete lines appended to a file since the last call."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        # The start of a line whose end hasn't been written yet
+        self.partial = ''
+
+    def read_lines(self):
+        """Return a list of the complete lines added since the last call."""
+        lines = []
+        readline = self.stream.readline
+        while True:
+            line = readline()
+            if not line:
+                return lines
+            if not line.endswith('\n'):
+                self.partial += line
+                return lines
+            if self.partial:
+                line = self.partial + line
+                self.partial = ''
+            lines.append(line)
+
+
+class Follower(object):
+    """Pairs the lines appended to one or more hypothesis files with their
+    reference lines (see the module docstring).  total is the number of
+    reference utterances, and paired the number paired up so far."""
+
+    def __init__(self, ref_file, hyp_files, head_ids=False, tail_ids=False):
+        self.head_ids = head_ids
+        self.by_id = head_ids or tail_ids
+        self.tails = [LineTail(hyp_file) for hyp_file in hyp_files]
+        self.paired = 0
+        # Hypotheses without a reference, and repeated IDs (skipped)
+        self.extra_hyps = 0
+        self.duplicate_ids = 0
+        if self.by_id:
+            self.encoding = getattr(ref_file, 'encoding', None) or 'utf-8'
+            self.ref = MappedTranscript(ref_file, head_ids, self.encoding)
+            self.total = len(self.ref)
+            self.seen = set()
+        else:
+            self.ref = ref_file
+            self.total = sum(1 for _ in ref_file)
+            ref_file.seek(0)
+
+    def poll(self):
+        """Return a list of (ref line, hyp line) pairs for the hypothesis
+        lines appended since the last call."""
+        pairs = []
+        for tail in self.tails:
+            lines = tail.read_lines()
+            if self.by_id:
+                self.pair_by_id(lines, pairs)
+            else:
+                for hyp_line in lines:
+                    ref_line = self.ref.readline()
+                    if ref_line:
+                        pairs.append((ref_line, hyp_line))
+                    else:
+                        self.extra_hyps += 1
+        self.paired += len(pairs)
+        return pairs
+
+    def pair_by_id(self, lines, pairs):
+        ref = self.ref
+        seen = self.seen
+        for hyp_line in lines:
+            tokens = hyp_line.split()
+            if not tokens:
+                continue
+            utt_id = (tokens[0] if self.head_ids else tokens[-1]).encode(self.encoding)
+            if utt_id not in ref:
+                self.extra_hyps += 1
+            elif utt_id in seen:
+                self.duplicate_ids += 1
+            else:
+                seen.add(utt_id)
+                pairs.append((ref.line(utt_id), hyp_line))
+
+    def done(self):
+        """Return true once every reference utterance has a hypothesis."""
+        return self.paired >= self.total
+
+    def close(self):
+        if self.by_id:
+            self.ref.close()
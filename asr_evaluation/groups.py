@@ -0,0 +1,199 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Error rates per group of utterances (per speaker, domain, audio condition,
+length bucket...), from a metadata sidecar file keyed by utterance ID.
+
+The sidecar is a tab-separated file (or comma-separated, if its name ends
+in .csv) with a header row; the first column is the utterance ID and each
+other column is something to group by:
+
+    id          speaker  domain   condition
+    utt-0001    spk1     news     clean
+    utt-0002    spk2     phone    noisy
+
+Besides the columns of the file, utterances can be grouped by "length",
+the length of their reference in buckets (see length_buckets).
+
+All the groups are counted in one pass: each utterance's counts are added
+to one entry per column it's grouped by, in a dict keyed on (column,
+value).  The counts of different parts of a corpus (e.g. from worker
+processes) are combined with GroupCounts.merge().
+"""
+from __future__ import division
+
+import csv
+import io
+from bisect import bisect_right
+
+# Lower bounds of the reference length buckets after the first (0)
+length_buckets = (1, 5, 10, 20, 40)
+
+# Metadata loaded in this process, by (path, columns), so that worker
+# processes (which inherit it when forked) don't read the file again
+loaded = {}
+
+
+def bucket_labels(bounds):
+    """Return the labels of the length buckets with the given lower bounds
+    (after 0): e.g. '0', '1-4', '5-9', ... '40+'."""
+    labels = ['0'] if bounds[0] > 0 else []
+    for low, high in zip(bounds, bounds[1:]):
+        labels.append(str(low) if high == low + 1 else '{}-{}'.format(low, high - 1))
+    labels.append('{}+'.format(bounds[-1]))
+    return labels
+
+
+class Metadata(object):
+    """The groups of each utterance, from a sidecar file, for the columns
+    to group by.  keys(id_, ref_length) returns the (column, value) keys
+    of an utterance; utterances missing from the file have the value None
+    for each of its columns."""
+    __slots__ = ('path', 'columns', 'by_length', 'keys_by_id', 'missing', 'length_keys')
+
+    def __init__(self, path=None, columns=None):
+        """Read the sidecar file at path (if any) and group by the given
+        columns: by default, all the columns of the file and length."""
+        self.path = path
+        header = []
+        rows = ()
+        if path is not None:
+            header, rows = read_metadata(path)
+        if columns is None:
+            columns = header[1:] + ([] if 'length' in header else ['length'])
+        unknown = [column for column in columns if column not in header[1:] and column != 'length']
+        if unknown:
+            raise ValueError('Unknown metadata columns: {}'.format(', '.join(unknown)))
+        self.columns = list(columns)
+        self.by_length = 'length' in columns and 'length' not in header
+        file_columns = [column for column in columns if column in header[1:]]
+        indexes = [header.index(column) for column in file_columns]
+        # Many utterances share the same groups, so each distinct tuple of
+        # keys is only stored once
+        distinct = {}
+        keys_by_id = self.keys_by_id = {}
+        for row in rows:
+            keys = tuple([(column, row[i]) for column, i in zip(file_columns, indexes)])
+            keys_by_id[row[0]] = distinct.setdefault(keys, keys)
+        self.missing = tuple((column, None) for column in file_columns)
+        self.length_keys = [('length', label) for label in bucket_labels(length_buckets)]
+        if path is not None:
+            loaded[path, tuple(self.columns)] = self
+
+    def __getstate__(self):
+        # Sent to worker processes as just the file name and columns
+        return self.path, self.columns
+
+    def __setstate__(self, state):
+        path, columns = state
+        metadata = loaded.get((path, tuple(columns))) if path is not None else None
+        if metadata is None:
+            metadata = Metadata(path, columns)
+        for name in Metadata.__slots__:
+            setattr(self, name, getattr(metadata, name))
+
+    def keys(self, id_, ref_length):
+        """Return the (column, value) group keys of an utterance."""
+        keys = self.keys_by_id.get(id_, self.missing)
+        if self.by_length:
+            return keys + (self.length_keys[bisect_right(length_buckets, ref_length)],)
+        return keys
+
+    def sort_key(self, key):
+        """Sort key for printing groups: by column, in the order they were
+        given, then by value (length buckets in order, missing values last)."""
+        column, value = key
+        if column == 'length' and self.by_length:
+            return self.columns.index(column), 0, self.length_keys.index(key), ''
+        return self.columns.index(column), value is None, 0, value or ''
+
+
+def read_metadata(path):
+    """Return (header, list of rows) for a sidecar file, with each row a list
+    of as many values as the header (the first being the utterance ID)."""
+    with io.open(path, encoding='utf-8', newline='') as metadata_file:
+        if path.lower().endswith('.csv'):
+            lines = csv.reader(metadata_file)
+        else:
+            # Tab-separated values don't need the csv module's quoting rules
+            lines = (line.rstrip('\r\n').split('\t') for line in metadata_file)
+        header = [name.strip() for name in next(lines, [])]
+        if not header or header == ['']:
+            raise ValueError('Empty metadata file: {}'.format(path))
+        width = len(header)
+        padding = [''] * width
+        rows = []
+        for row in lines:
+            if len(row) != width:
+                if row == [''] or not row:
+                    continue
+                row = (row + padding)[:width]
+            rows.append([value.strip() for value in row])
+    return header, rows
+
+
+class GroupCounts(object):
+    """Counts per group: for each (column, value) key, a list of the
+    sentence count, reference token count, error count, match count and
+    count of sentences with errors."""
+    __slots__ = ('counts',)
+
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, keys, ref_length, errors, matches):
+        """Add the counts of one sentence to each of its groups."""
+        counts = self.counts
+        sent_error = 1 if errors else 0
+        for key in keys:
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = [1, ref_length, errors, matches, sent_error]
+            else:
+                entry[0] += 1
+                entry[1] += ref_length
+                entry[2] += errors
+                entry[3] += matches
+                entry[4] += sent_error
+
+    def merge(self, other):
+        """Add the counts of another GroupCounts to this one."""
+        counts = self.counts
+        for key, other_entry in other.counts.items():
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = list(other_entry)
+            else:
+                for i, count in enumerate(other_entry):
+                    entry[i] += count
+        return self
+
+    def results(self, sort_key=None):
+        """Return a dict per group, with its column and value and the same
+        counts and rates as Evaluation.result(), sorted by sort_key (a
+        function of the (column, value) key)."""
+        results = []
+        for key in sorted(self.counts, key=sort_key):
+            sentences, ref_tokens, errors, matches, sent_errors = self.counts[key]
+            results.append({'column': key[0], 'value': key[1],
+                            'sentence_count': sentences,
+                            'ref_token_count': ref_tokens,
+                            'error_count': errors,
+                            'match_count': matches,
+                            'sent_error_count': sent_errors,
+                            'wer': errors / ref_tokens if ref_tokens > 0 else 0.0,
+                            'wrr': matches / ref_tokens if ref_tokens > 0 else 0.0,
+                            'ser': sent_errors / sentences if sentences > 0 else 0.0})
+        return results
@@ -0,0 +1,133 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Text normalization applied to each token before alignment, configured
+from a JSON file such as:
+
+    {
+        "lowercase": true,
+        "ignore": ["<unk>", "[noise]", "uh", "um"],
+        "regex": [["[.,!?;:\\"]", ""], ["^'|'$", ""]],
+        "map": {"colour": "color", "gonna": "going to"},
+        "map_files": ["spellings.txt"]
+    }
+
+Each token is down-cased (if "lowercase" is set), dropped if it's in the
+ignore list, and then rewritten by each regex rule in turn.  The result is
+split on whitespace, so a rule can also drop a token (by emptying it) or
+split it.  Each of the resulting tokens is then replaced by its entry in
+the mapping, if it has one (which may again be several tokens, or none),
+and any that are in the ignore list are dropped.
+
+The map files are extra mapping tables, one entry per line: a token and
+then what it maps to, separated by whitespace.  Relative paths are taken
+from the directory of the config file.
+
+Rules apply to single tokens, so the result for each distinct token is
+computed once and remembered.
+"""
+import io
+import os
+import re
+
+
+class Normalizer(object):
+    """Normalizes tokens as described in the module docstring.  Results are
+    memoized per distinct raw token."""
+    __slots__ = ('lowercase', 'ignore', 'rules', 'mapping', 'memo')
+
+    def __init__(self, lowercase=False, ignore=(), regex=(), mapping=None):
+        self.lowercase = lowercase
+        self.ignore = frozenset(ignore)
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in regex]
+        self.mapping = {token: tuple(value.split()) for token, value in (mapping or {}).items()}
+        # Raw token -> tuple of normalized tokens
+        self.memo = {}
+
+    @classmethod
+    def from_config(cls, config, directory='.'):
+        """Create a normalizer from a config dict (as in the module docstring).
+        Relative map file paths are taken from directory.  Raises a
+        ValueError for a config that isn't valid."""
+        if not isinstance(config, dict):
+            raise ValueError('The normalization config should be a JSON object')
+        unknown = sorted(set(config) - {'lowercase', 'ignore', 'regex', 'map', 'map_files'})
+        if unknown:
+            raise ValueError('Unknown normalization settings: {}'.format(', '.join(unknown)))
+        mapping = {}
+        for path in config.get('map_files', []):
+            mapping.update(read_map_file(os.path.join(directory, path)))
+        mapping.update(config.get('map', {}))
+        try:
+            return cls(lowercase=config.get('lowercase', False), ignore=config.get('ignore', []),
+                       regex=config.get('regex', []), mapping=mapping)
+        except re.error as e:
+            raise ValueError('Bad regex in the normalization config: {}'.format(e))
+
+    def __getstate__(self):
+        # The memo is left behind when sent to worker processes
+        return (self.lowercase, self.ignore, [(rule.pattern, replacement) for rule, replacement in self.rules],
+                self.mapping)
+
+    def __setstate__(self, state):
+        self.lowercase, self.ignore, regex, self.mapping = state
+        self.rules = [(re.compile(pattern), replacement) for pattern, replacement in regex]
+        self.memo = {}
+
+    def normalize(self, token):
+        """Return the tuple of tokens a raw token normalizes to."""
+        result = self.memo.get(token)
+        if result is None:
+            result = self.memo[token] = self.compute(token)
+        return result
+
+    def normalize_all(self, tokens):
+        """Return the list of normalized tokens for a list of raw tokens."""
+        normalize = self.normalize
+        return [normalized for token in tokens for normalized in normalize(token)]
+
+    def compute(self, token):
+        if self.lowercase:
+            token = token.lower()
+        ignore = self.ignore
+        if token in ignore:
+            return ()
+        for rule, replacement in self.rules:
+            token = rule.sub(replacement, token)
+        mapping = self.mapping
+        result = []
+        for part in token.split():
+            for mapped in mapping.get(part, (part,)):
+                if mapped not in ignore:
+                    result.append(mapped)
+        return tuple(result)
+
+
+def read_map_file(path):
+    """Return the mapping in a map file, as a dict of token -> replacement text."""
+    mapping = {}
+    with io.open(path, encoding='utf-8') as map_file:
+        for line in map_file:
+            fields = line.split(None, 1)
+            if fields and not fields[0].startswith('#'):
+                mapping[fields[0]] = fields[1].strip() if len(fields) > 1 else ''
+    return mapping
+
+def load_normalizer(path):
+    """Return a Normalizer configured by a JSON file."""
+    import json
+    with io.open(path, encoding='utf-8') as config_file:
+        config = json.load(config_file)
+    return Normalizer.from_config(config, os.path.dirname(os.path.abspath(path)))
@@ -0,0 +1,146 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Memory-mapped transcript files, indexed by utterance ID.
+
+This lets the reference and hypothesis be joined by ID rather than by line
+number, so the hypothesis file can be in any order and can be missing some
+utterances.  Only the byte offsets of each line are kept in memory; lines
+are decoded one at a time as they're needed.
+"""
+import os
+import mmap
+import re
+
+# The first whitespace-delimited token of a line
+_first_token = re.compile(br'\S+')
+_whitespace = b' \t\r\n\v\f'
+
+
+class MappedTranscript(object):
+    """A transcript file mapped into memory, with an index from utterance ID
+    to the byte offsets of its line.  The ID is the first token of each line
+    if head_ids is true (Kaldi format), otherwise the last (Sphinx format)."""
+
+    def __init__(self, transcript_file, head_ids=True, encoding='utf-8'):
+        self.encoding = encoding
+        self.head_ids = head_ids
+        # The offsets of each line, keyed by ID, in file order
+        self.index = {}
+        self.order = []
+        self.duplicates = 0
+        if os.fstat(transcript_file.fileno()).st_size > 0:
+            self.data = mmap.mmap(transcript_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # mmap can't map empty files
+            self.data = b''
+        self.build_index()
+
+    def build_index(self):
+        """Scan the file once for line boundaries and IDs."""
+        data = self.data
+        size = len(data)
+        start = 0
+        while start < size:
+            end = data.find(b'\n', start)
+            if end == -1:
+                end = size
+            utt_id = self.line_id(start, end)
+            if utt_id is not None:
+                if utt_id in self.index:
+                    self.duplicates += 1
+                else:
+                    self.index[utt_id] = (start, end)
+                    self.order.append(utt_id)
+            start = end + 1
+
+    def line_id(self, start, end):
+        """Return the ID of the line between the given offsets, as bytes, or
+        None for a blank line."""
+        data = self.data
+        if self.head_ids:
+            match = _first_token.search(data, start, end)
+            return match.group() if match else None
+        while end > start and data[end - 1:end] in _whitespace:
+            end -= 1
+        if end == start:
+            return None
+        token_start = max(data.rfind(b' ', start, end), data.rfind(b'\t', start, end)) + 1
+        return data[max(token_start, start):end]
+
+    def __contains__(self, utt_id):
+        return utt_id in self.index
+
+    def __len__(self):
+        return len(self.order)
+
+    def line(self, utt_id):
+        """Return the decoded line for an ID."""
+        start, end = self.index[utt_id]
+        return self.data[start:end].decode(self.encoding)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+class JoinStats(object):
+    """Counts of utterances that couldn't be paired up by join_by_id."""
+    __slots__ = ('missing_hyps', 'extra_hyps', 'duplicate_ids')
+
+    def __init__(self):
+        self.missing_hyps = 0
+        self.extra_hyps = 0
+        self.duplicate_ids = 0
+
+
+def join_by_id(ref_file, hyp_file, head_ids=True, stats=None):
+    """Yield (ref line, hyp line) pairs for each utterance in the reference
+    file, in reference order, matched with the hypothesis line with the same
+    ID.  A reference without a hypothesis is paired with an empty hypothesis
+    (just the ID), so it's scored as all deletions.  Hypotheses without a
+    reference are skipped.  If a JoinStats is given, these are counted in it."""
+    for ref_line, (hyp_line,) in join_all_by_id(ref_file, [hyp_file], head_ids, [stats]):
+        yield ref_line, hyp_line
+
+
+def join_all_by_id(ref_file, hyp_files, head_ids=True, stats=None):
+    """Like join_by_id, but for several hypothesis files at once: yield
+    (ref line, [hyp line for each hyp file]) for each utterance in the
+    reference file.  stats is an optional list with a JoinStats (or None)
+    per hypothesis file."""
+    ref = MappedTranscript(ref_file, head_ids, getattr(ref_file, 'encoding', None) or 'utf-8')
+    hyps = [MappedTranscript(hyp_file, head_ids, getattr(hyp_file, 'encoding', None) or 'utf-8')
+            for hyp_file in hyp_files]
+    if stats is None:
+        stats = [None] * len(hyps)
+    stats = [hyp_stats if hyp_stats is not None else JoinStats() for hyp_stats in stats]
+    for hyp, hyp_stats in zip(hyps, stats):
+        hyp_stats.duplicate_ids = ref.duplicates + hyp.duplicates
+        hyp_stats.extra_hyps = sum(1 for utt_id in hyp.order if utt_id not in ref)
+    try:
+        for utt_id in ref.order:
+            hyp_lines = []
+            for hyp, hyp_stats in zip(hyps, stats):
+                if utt_id in hyp:
+                    hyp_lines.append(hyp.line(utt_id))
+                else:
+                    hyp_stats.missing_hyps += 1
+                    hyp_lines.append(utt_id.decode(hyp.encoding))
+            yield ref.line(utt_id), hyp_lines
+    finally:
+        ref.close()
+        for hyp in hyps:
+            hyp.close()
@@ -0,0 +1,217 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rendering of alignments for --print-instances and --print-errors.
+
+A Renderer formats a whole instance (the REF and HYP lines and the counts)
+as one string.  Whether to use color is decided once, the way termcolor
+does (the ANSI_COLORS_DISABLED, NO_COLOR and FORCE_COLOR environment
+variables, then whether the output is a terminal), and the escape
+sequences are looked up once rather than for every token.
+
+An OutputBuffer collects what's printed in large chunks, and can hand them
+to a background thread to write, so writing the output overlaps with
+aligning the next sentences.
+"""
+from __future__ import division
+
+import os
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Characters an OutputBuffer collects before writing them out
+chunk_size = 1 << 16
+
+instance_format = ('{}\n{}\n{}\n'
+                   'Correct          = {:6.1%}  {:3d}   ({:6d})\n'
+                   'Errors           = {:6.1%}  {:3d}   ({:6d})\n')
+
+
+def color_enabled(stream=None):
+    """Return true if colored output should be written to a stream (by
+    default sys.stdout)."""
+    if os.environ.get('ANSI_COLORS_DISABLED') or os.environ.get('NO_COLOR'):
+        return False
+    if os.environ.get('FORCE_COLOR'):
+        return True
+    if os.environ.get('TERM') == 'dumb':
+        return False
+    stream = stream if stream is not None else sys.stdout
+    try:
+        return stream.isatty()
+    except Exception:
+        return False
+
+
+class Renderer(object):
+    """Formats alignments as Sphinx-style diffs, with the errors in red if
+    color is on."""
+    __slots__ = ('red', 'reset')
+
+    def __init__(self, color=False):
+        if color:
+            from termcolor import COLORS, RESET
+            self.red = '\033[{:d}m'.format(COLORS['red'])
+            self.reset = RESET
+        else:
+            self.red = self.reset = ''
+
+    def diff(self, opcodes, ref, hyp, prefix1='REF:', prefix2='HYP:', suffix1=None, suffix2=None):
+        """Return the REF and HYP lines of a diff of two token lists, given
+        their opcodes.  Matching tokens are in lower case and errors in
+        upper case, with stars opposite insertions and deletions."""
+        red = self.red
+        reset = self.reset
+        ref_tokens = [prefix1] if prefix1 else []
+        hyp_tokens = [prefix2] if prefix2 else []
+        ref_append = ref_tokens.append
+        hyp_append = hyp_tokens.append
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                # SequenceMatcher opcodes are one token long
+                if i2 - i1 == 1:
+                    ref_append(ref[i1].lower())
+                    hyp_append(hyp[j1].lower())
+                else:
+                    ref_tokens.extend([token.lower() for token in ref[i1:i2]])
+                    hyp_tokens.extend([token.lower() for token in hyp[j1:j2]])
+            elif tag == 'delete':
+                for token in ref[i1:i2]:
+                    ref_append(red + token.upper() + reset)
+                    hyp_append(red + '*' * len(token) + reset)
+            elif tag == 'insert':
+                for token in hyp[j1:j2]:
+                    ref_append(red + '*' * len(token) + reset)
+                    hyp_append(red + token.upper() + reset)
+            elif tag == 'replace':
+                ref_words = [token.upper() for token in ref[i1:i2]]
+                hyp_words = [token.upper() for token in hyp[j1:j2]]
+                # Pair up words with their substitutions, or fillers of the
+                # same width
+                for k in range(max(len(ref_words), len(hyp_words))):
+                    ref_word = ref_words[k] if k < len(ref_words) else ''
+                    hyp_word = hyp_words[k] if k < len(hyp_words) else ''
+                    width = max(len(ref_word), len(hyp_word))
+                    ref_append(red + (ref_word.ljust(width) if ref_word else '*' * width) + reset)
+                    hyp_append(red + (hyp_word.ljust(width) if hyp_word else '*' * width) + reset)
+        if suffix1:
+            ref_tokens.append(suffix1)
+        if suffix2:
+            hyp_tokens.append(suffix2)
+        return ' '.join(ref_tokens), ' '.join(hyp_tokens)
+
+    def instance(self, ref, hyp, sm, id_=None, counter=0):
+        """Return the printout of one ref/hyp pair, as print_instances prints
+        it.  counter is the number of sentences that came before it."""
+        ref_line, hyp_line = self.diff(sm.get_opcodes(), ref, hyp)
+        matches = sm.matches()
+        errors = sm.distance()
+        # Handle cases where the reference is empty without dying
+        if len(ref) != 0:
+            correct_rate = matches / len(ref)
+            error_rate = errors / len(ref)
+        elif matches == 0:
+            correct_rate = 1.0
+            error_rate = 0.0
+        else:
+            correct_rate = 0.0
+            error_rate = matches
+        if id_:
+            sentence = 'SENTENCE {0:d}  {1!s}'.format(counter + 1, id_)
+        else:
+            sentence = 'SENTENCE {0:d}'.format(counter + 1)
+        return instance_format.format(ref_line, hyp_line, sentence, correct_rate, matches, len(ref),
+                                      error_rate, errors, len(ref))
+
+
+class OutputBuffer(object):
+    """A file-like object that collects writes and passes them on to a
+    stream in chunks of about chunk_size characters.  With threaded=True the
+    chunks are written by a background thread.  close() writes out the rest
+    (and waits for the thread).
+
+    It's meant to stand in for sys.stdout while sentences are scored, so
+    everything printed comes out in order."""
+
+    def __init__(self, stream, threaded=False):
+        self.stream = stream
+        self.parts = []
+        self.size = 0
+        self.queue = None
+        self.thread = None
+        self.error = None
+        if threaded:
+            # A bounded queue, so a slow reader holds up the scoring rather
+            # than the chunks piling up in memory
+            self.queue = queue.Queue(8)
+            self.thread = threading.Thread(target=self.write_chunks)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Pass on what has been collected so far."""
+        if not self.parts:
+            return
+        chunk = ''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        if self.queue is None:
+            self.stream.write(chunk)
+        else:
+            if self.error is not None:
+                raise self.error
+            self.queue.put(chunk)
+
+    def write_chunks(self):
+        """Background thread: write chunks until given None."""
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is None:
+                try:
+                    self.stream.write(chunk)
+                    self.stream.flush()
+                except Exception as error:
+                    # e.g. a closed pipe; raised in the main thread
+                    self.error = error
+
+    def close(self):
+        """Write out everything and stop the thread, if any."""
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            if self.error is not None:
+                raise self.error
+        self.stream.flush()
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def fileno(self):
+        return self.stream.fileno()
@@ -0,0 +1,240 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A long running scoring service, so that callers scoring many small jobs
+don't pay the startup cost of the CLI for each one.
+
+    wer serve --port 8765 --workers 4
+
+Clients connect over TCP and send one JSON request per line.  A request
+has either the line pairs themselves or the paths of a ref and hyp file:
+
+    {"id": 1, "pairs": [["ref line", "hyp line"], ...], "options": {...}}
+    {"id": 2, "ref_file": "ref.txt", "hyp_file": "hyp.txt", "join_ids": false}
+
+The options are head_ids, tail_ids, case_insensitive, remove_empty_refs,
+confusions, confusion_capacity, max_wer, cer and dedup_size, as for
+Evaluation, and
+normalize, a normalization config as in asr_evaluation.normalize (map file
+paths are taken from the service's directory).  With "utterances": true the
+response also has the counts for each utterance.  Each response is one
+line of JSON, with the request's id, the Evaluation result and (with the
+confusions option) the confusion tables, or an "error" message.
+Responses on a connection come back in the order of the requests.
+
+Requests are queued and handed to a pool of worker processes in batches,
+so each round trip to a worker can score several small requests.
+"""
+from __future__ import print_function
+
+import io
+import sys
+import json
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from asr_evaluation.asr_evaluation import Evaluation
+    from asr_evaluation.reader import join_by_id
+    from asr_evaluation.normalize import Normalizer
+except Exception:
+    from asr_evaluation import Evaluation
+    from reader import join_by_id
+    from normalize import Normalizer
+
+# The Evaluation options a request may set
+request_options = ('head_ids', 'tail_ids', 'case_insensitive', 'remove_empty_refs', 'confusions', 'max_wer',
+                   'cer', 'normalize', 'confusion_capacity', 'dedup_size')
+
+
+def score_requests(requests):
+    """Score a batch of requests in a worker process and return their responses."""
+    return [score_request(request) for request in requests]
+
+def score_request(request):
+    """Score one request and return its response as a dict.  Errors in the
+    request are returned as an "error" message rather than raised."""
+    response = {'id': request.get('id')}
+    try:
+        options = dict(request.get('options', {}))
+        unknown = sorted(set(options) - set(request_options))
+        if unknown:
+            raise ValueError('Unknown options: {}'.format(', '.join(unknown)))
+        if 'normalize' in options:
+            options['normalizer'] = Normalizer.from_config(options.pop('normalize'))
+        evaluation = Evaluation(**options)
+        utterances = [] if request.get('utterances') else None
+        for ref_line, hyp_line in request_pairs(request, evaluation):
+            error_count = evaluation.error_count
+            match_count = evaluation.match_count
+            ref_token_count = evaluation.ref_token_count
+            if evaluation.add_pair(ref_line, hyp_line) and utterances is not None:
+                utterances.append({'id': utterance_id(ref_line, evaluation),
+                                   'ref_token_count': evaluation.ref_token_count - ref_token_count,
+                                   'error_count': evaluation.error_count - error_count,
+                                   'match_count': evaluation.match_count - match_count})
+    except Exception as error:
+        response['error'] = '{}: {}'.format(type(error).__name__, error)
+        return response
+    response['result'] = evaluation.result()
+    if utterances is not None:
+        response['utterances'] = utterances
+    if evaluation.confusions:
+        insertions, deletions, substitutions = evaluation.confusion_tables()
+        response['confusions'] = {'insertions': insertions, 'deletions': deletions,
+                                  'substitutions': [[ref, hyp, count] for (ref, hyp), count in substitutions]}
+    return response
+
+def request_pairs(request, evaluation):
+    """Return a list of the (ref line, hyp line) pairs of a request."""
+    if 'pairs' in request:
+        return request['pairs']
+    with io.open(request['ref_file'], encoding='utf-8') as ref_file, \
+            io.open(request['hyp_file'], encoding='utf-8') as hyp_file:
+        if request.get('join_ids'):
+            if not (evaluation.head_ids or evaluation.tail_ids):
+                raise ValueError('join_ids needs the head_ids or tail_ids option')
+            return list(join_by_id(ref_file, hyp_file, evaluation.head_ids))
+        return list(zip(ref_file, hyp_file))
+
+def utterance_id(ref_line, evaluation):
+    """Return the ID of a ref line, or None if the lines don't have IDs."""
+    if evaluation.head_ids:
+        return ref_line.split()[0]
+    if evaluation.tail_ids:
+        return ref_line.split()[-1]
+    return None
+
+
+class Service(object):
+    """Queues requests and scores them in batches on a process pool."""
+
+    def __init__(self, workers=None, max_batch=64):
+        workers = workers or multiprocessing.cpu_count()
+        # Workers are started on demand, so forked ones would inherit (and keep
+        # open) the sockets of whatever connections are open at the time
+        try:
+            context = multiprocessing.get_context('forkserver')
+        except ValueError:
+            context = None
+        self.executor = ProcessPoolExecutor(workers, mp_context=context)
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        # One dispatcher per worker keeps every worker busy
+        self.dispatchers = [asyncio.ensure_future(self.dispatch()) for _ in range(workers)]
+
+    async def score(self, request):
+        """Return the response to a request."""
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def dispatch(self):
+        """Take whatever requests are waiting (up to max_batch) and score them together."""
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                responses = await loop.run_in_executor(self.executor, score_requests,
+                                                       [request for request, _ in batch])
+            except Exception as error:
+                # e.g. a worker process died
+                responses = [{'id': request.get('id'), 'error': '{}: {}'.format(type(error).__name__, error)}
+                             for request, _ in batch]
+            for (_, future), response in zip(batch, responses):
+                future.set_result(response)
+
+    async def handle(self, reader, writer):
+        """Serve one client connection.  Requests are scored concurrently,
+        but the responses are written in request order."""
+        pending = asyncio.Queue()
+
+        async def write_responses():
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                writer.write(json.dumps(await task).encode('utf-8') + b'\n')
+                await writer.drain()
+
+        writer_task = asyncio.ensure_future(write_responses())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    if not isinstance(request, dict):
+                        raise ValueError('expected a JSON object')
+                except ValueError as error:
+                    response = asyncio.get_event_loop().create_future()
+                    response.set_result({'id': None, 'error': 'Bad request: {}'.format(error)})
+                    await pending.put(response)
+                    continue
+                await pending.put(asyncio.ensure_future(self.score(request)))
+        except BaseException:
+            # Cancelled, or the connection was lost
+            writer_task.cancel()
+            writer.close()
+            raise
+        await pending.put(None)
+        await writer_task
+        writer.close()
+
+    def close(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        self.executor.shutdown()
+
+
+async def start(host='127.0.0.1', port=8765, workers=None, max_batch=64):
+    """Start the service and return (the asyncio server, the Service)."""
+    service = Service(workers, max_batch)
+    server = await asyncio.start_server(service.handle, host, port)
+    return server, service
+
+async def serve(args):
+    server, service = await start(args.host, args.port, args.workers, args.max_batch)
+    for sock in server.sockets:
+        print('Listening on {}:{}'.format(*sock.getsockname()[:2]), file=sys.stderr)
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+        service.close()
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='wer serve', description='Run a scoring service (see the README).')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default 127.0.0.1).')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on (default 8765).')
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help='Number of worker processes (default the number of CPUs).')
+    parser.add_argument('--max-batch', type=int, default=64, metavar='N',
+                        help='Most requests to send to a worker at once (default 64).')
+    return parser
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
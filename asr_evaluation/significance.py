@@ -0,0 +1,138 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bootstrap confidence intervals for WER, and significance tests between two
+systems scored on the same references (needs NumPy).
+
+These work from the per-utterance reference lengths and error counts, not
+from the text.  Utterances with the same counts are interchangeable, so
+they're grouped, and a resample is drawn as how many times each distinct
+group is picked (a multinomial draw for the bootstrap, binomial draws for
+approximate randomization).  That's the same distribution as resampling the
+utterances one by one, but the cost grows with the number of distinct
+groups (usually thousands) rather than the number of utterances.
+
+Resamples are drawn in fixed size chunks, each with its own seed, so the
+results depend on the seed but not on how many processes are used.
+"""
+from __future__ import division
+
+import numpy
+
+# Resamples drawn per chunk (and per task when using several processes)
+chunk_size = 500
+
+# Most cells in the (resamples x groups) matrix of one draw
+max_draw_cells = 1 << 22
+
+
+def group_counts(*columns):
+    """Return (the distinct rows of the given per-utterance columns, as a 2D
+    array, and the number of utterances with each)."""
+    columns = [numpy.asarray(column, dtype=numpy.int64) for column in columns]
+    lows = [int(column.min()) if len(column) else 0 for column in columns]
+    sizes = [int(column.max()) - low + 1 if len(column) else 1 for column, low in zip(columns, lows)]
+    if numpy.prod([float(size) for size in sizes]) >= 2 ** 62:
+        return numpy.unique(numpy.stack(columns, axis=1), axis=0, return_counts=True)
+    # Pack each row into one int64, which numpy.unique handles much faster
+    keys = numpy.zeros(len(columns[0]), dtype=numpy.int64)
+    for column, low, size in zip(columns, lows, sizes):
+        keys = keys * size + (column - low)
+    keys, counts = numpy.unique(keys, return_counts=True)
+    values = numpy.empty((len(keys), len(columns)), dtype=numpy.int64)
+    for i in range(len(columns) - 1, -1, -1):
+        keys, values[:, i] = numpy.divmod(keys, sizes[i])
+        values[:, i] += lows[i]
+    return values, counts
+
+def bootstrap_wer(lengths, errors, resamples=1000, confidence=0.95, seed=0, jobs=1):
+    """Return a (low, high) bootstrap percentile interval for the WER of a
+    corpus with the given per-utterance reference lengths and errors."""
+    values, counts = group_counts(lengths, errors)
+    stats = run_chunks('bootstrap', values, counts, resamples, seed, jobs)
+    return percentile_interval(stats, confidence)
+
+def paired_bootstrap(lengths, errors_a, errors_b, resamples=1000, confidence=0.95, seed=0, jobs=1):
+    """Paired bootstrap of the difference in WER (B - A) between two systems.
+    Return (low, high, p value), where the p value is two-sided: twice the
+    fraction of resamples in which the difference is zero or has the other
+    sign from the whole corpus's."""
+    errors_a = numpy.asarray(errors_a, dtype=numpy.int64)
+    errors_b = numpy.asarray(errors_b, dtype=numpy.int64)
+    values, counts = group_counts(lengths, errors_b - errors_a)
+    stats = run_chunks('bootstrap', values, counts, resamples, seed, jobs)
+    observed = (errors_b.sum() - errors_a.sum()) / max(1, numpy.sum(lengths))
+    if observed >= 0:
+        flipped = numpy.count_nonzero(stats <= 0)
+    else:
+        flipped = numpy.count_nonzero(stats >= 0)
+    low, high = percentile_interval(stats, confidence)
+    return low, high, min(1.0, 2 * float(flipped) / len(stats))
+
+def approximate_randomization(errors_a, errors_b, shuffles=1000, seed=0, jobs=1):
+    """Approximate randomization test of the difference in total errors
+    between two systems: each shuffle swaps the two systems' outputs for
+    each utterance with probability 1/2.  Return the p value
+    (1 + shuffles at least as extreme as observed) / (1 + shuffles)."""
+    difference = numpy.asarray(errors_b, dtype=numpy.int64) - numpy.asarray(errors_a, dtype=numpy.int64)
+    values, counts = group_counts(difference)
+    stats = run_chunks('randomization', values, counts, shuffles, seed, jobs)
+    observed = abs(int(difference.sum()))
+    return (1 + int(numpy.count_nonzero(numpy.abs(stats) >= observed))) / (1 + len(stats))
+
+def percentile_interval(stats, confidence):
+    tail = (1 - confidence) / 2 * 100
+    low, high = numpy.percentile(stats, [tail, 100 - tail])
+    return float(low), float(high)
+
+def run_chunks(kind, values, counts, total, seed, jobs):
+    """Draw total resamples of the given kind in chunks, in a pool of jobs
+    processes if jobs > 1, and return their statistics as one array."""
+    sizes = [min(chunk_size, total - start) for start in range(0, total, chunk_size)]
+    seeds = numpy.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(kind, values, counts, size, chunk_seed) for size, chunk_seed in zip(sizes, seeds)]
+    if jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(resample_chunk, tasks)
+        finally:
+            pool.close()
+    else:
+        results = [resample_chunk(task) for task in tasks]
+    return numpy.concatenate(results) if results else numpy.zeros(0)
+
+def resample_chunk(task):
+    """Return the statistics of one chunk of resamples.
+
+    For 'bootstrap', values has columns (reference length, errors) and the
+    statistic is the resampled errors / reference length.  For
+    'randomization', values has one column of error differences and the
+    statistic is the sum of the differences after random swaps."""
+    kind, values, counts, size, seed = task
+    rng = numpy.random.default_rng(seed)
+    total = counts.sum()
+    stats = []
+    step = max(1, max_draw_cells // len(counts))
+    for start in range(0, size, step):
+        draws = min(step, size - start)
+        if kind == 'bootstrap':
+            picks = rng.multinomial(total, counts / total, size=draws)
+            lengths = numpy.dot(picks, values[:, 0])
+            stats.append(numpy.dot(picks, values[:, 1]) / numpy.maximum(lengths, 1))
+        else:
+            swapped = rng.binomial(counts, 0.5, size=(draws, len(counts)))
+            stats.append(numpy.dot(counts - 2 * swapped, values[:, 0]))
+    return numpy.concatenate(stats)
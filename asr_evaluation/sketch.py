@@ -0,0 +1,95 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Approximate counting of the most frequent items in bounded memory, for
+confusion tables on large, noisy corpora.
+"""
+import heapq
+
+
+class SpaceSaving(object):
+    """A Space-Saving summary (Metwally et al., 2005) of item counts that
+    keeps at most capacity items.
+
+    Items are counted in a dict, which is allowed to grow to twice the
+    capacity and is then pruned back to the capacity items with the highest
+    counts, so the cost of pruning is spread over many updates.  floor is
+    the highest count pruned so far: an item that isn't in the table has a
+    true count of at most floor, and a new item starts counting from floor.
+    So counts are upper bounds, over by at most floor, and every item with
+    a true count above floor is in the table.
+
+    It's updated like a defaultdict(int), with table[item] += count.
+    Summaries of different parts of a stream can be combined with merge().
+    """
+    __slots__ = ('capacity', 'counts', 'floor')
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.counts = {}
+        self.floor = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, item):
+        """Return the count of an item, which for one that isn't in the
+        table is floor."""
+        return self.counts.get(item, self.floor)
+
+    def __setitem__(self, item, count):
+        """Set the count of an item, so that table[item] += n works as for
+        a defaultdict(int)."""
+        counts = self.counts
+        is_new = item not in counts
+        counts[item] = count
+        if is_new and len(counts) > 2 * self.capacity:
+            self.prune()
+
+    def prune(self):
+        """Drop all but the capacity items with the highest counts.  The
+        items kept stay in the order they were first seen."""
+        counts = self.counts
+        if len(counts) <= self.capacity:
+            return
+        kept = set(heapq.nlargest(self.capacity, counts, key=counts.get))
+        for item in [item for item in counts if item not in kept]:
+            self.floor = max(self.floor, counts.pop(item))
+
+    def items(self):
+        """Return the (item, count upper bound) pairs of the capacity items
+        with the highest counts."""
+        self.prune()
+        return self.counts.items()
+
+    def merge(self, other, translate=None):
+        """Add the counts of another summary to this one, mapping its items
+        through translate (a function) if given.  Items missing from one
+        summary are counted as that summary's floor, so the counts stay
+        upper bounds over the combined stream."""
+        counts = self.counts
+        other_counts = other.counts
+        if translate is not None:
+            other_counts = dict((translate(item), count) for item, count in other_counts.items())
+        for item in counts:
+            counts[item] += other_counts.get(item, other.floor)
+        for item, count in other_counts.items():
+            if item not in counts:
+                counts[item] = self.floor + count
+        self.floor += other.floor
+        self.prune()
+        return self
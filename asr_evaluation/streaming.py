@@ -0,0 +1,89 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Constant-memory summaries of a stream of per-sentence error rates.
+"""
+from __future__ import division
+
+import random
+
+
+class RunningStats(object):
+    """Running count and sum of a stream of values, with an optional bounded
+    reservoir sample of the values for estimating quantiles.
+
+    This stands in for the per-length lists of error rates in streaming
+    mode.  Within one process the sum is accumulated in the same order as
+    sum() over the list would be, so mean() gives exactly the same number;
+    after merge() it can differ in the last bits of the float.
+    """
+    __slots__ = ('count', 'total', 'reservoir_size', 'reservoir', 'rng')
+
+    def __init__(self, reservoir_size=0):
+        self.count = 0
+        self.total = 0
+        self.reservoir_size = reservoir_size
+        self.reservoir = []
+        # Seeded so that repeated runs report the same quantiles
+        self.rng = random.Random(reservoir_size)
+
+    def add(self, value):
+        """Add a value to the stream."""
+        self.count += 1
+        self.total += value
+        if self.reservoir_size <= 0:
+            return
+        if len(self.reservoir) < self.reservoir_size:
+            self.reservoir.append(value)
+        else:
+            # Algorithm R: keep each value with probability size / count
+            k = self.rng.randrange(self.count)
+            if k < self.reservoir_size:
+                self.reservoir[k] = value
+
+    def merge(self, other):
+        """Add the values summarized by another RunningStats to this one.
+        The merged reservoir takes from each side in proportion to its count."""
+        if self.reservoir_size > 0 and other.count > 0:
+            if len(self.reservoir) + len(other.reservoir) <= self.reservoir_size:
+                self.reservoir.extend(other.reservoir)
+            else:
+                mine = list(self.reservoir)
+                theirs = list(other.reservoir)
+                left = [self.count, other.count]
+                merged = []
+                while len(merged) < self.reservoir_size and (mine or theirs):
+                    if mine and (not theirs or self.rng.randrange(left[0] + left[1]) < left[0]):
+                        side, source = 0, mine
+                    else:
+                        side, source = 1, theirs
+                    merged.append(source.pop(self.rng.randrange(len(source))))
+                    left[side] -= 1
+                self.reservoir = merged
+        self.count += other.count
+        self.total += other.total
+        return self
+
+    def mean(self):
+        """Return the mean of the values, or nan if there aren't any."""
+        return float(self.total) / self.count if self.count > 0 else float('nan')
+
+    def quantile(self, q):
+        """Return an estimate of the q-th quantile (0 <= q <= 1) from the
+        reservoir, or nan if there is no sample."""
+        if not self.reservoir:
+            return float('nan')
+        values = sorted(self.reservoir)
+        return values[min(len(values) - 1, int(q * len(values)))]
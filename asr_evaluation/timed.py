@@ -0,0 +1,155 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scoring of time-aligned hypotheses (CTM) against segmented references
+(STM), as NIST sclite does, by turning them into ID'd line pairs for the
+usual scoring.
+
+STM lines are "file channel speaker begin end [<label>] words...", and CTM
+lines are "file channel start duration word [confidence]"; lines starting
+with ";;" are comments.  Each hypothesis word is assigned to the reference
+segment of the same file and channel that contains the middle of the word.
+Words that fall between segments are scored as insertions, in a pair with
+an empty reference for each gap, and words in segments whose transcript is
+IGNORE_TIME_SEGMENT_IN_SCORING are dropped.
+
+The words and segments of each file and channel are sorted by time and
+swept together, so assigning m words to n segments takes
+O((n + m) log n), however long the recording.
+"""
+import heapq
+from collections import namedtuple
+
+Segment = namedtuple('Segment', ['file', 'channel', 'speaker', 'begin', 'end', 'words'])
+
+ignore_segment = 'ignore_time_segment_in_scoring'
+
+
+def read_stm(lines):
+    """Return the Segments in the lines of an STM file, in order."""
+    segments = []
+    for line in lines:
+        if line.startswith(';;'):
+            continue
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) < 5:
+            raise ValueError('Bad STM line: {!r}'.format(line))
+        words = fields[5:]
+        if words and words[0].startswith('<') and words[0].endswith('>'):
+            words = words[1:]
+        segments.append(Segment(fields[0], fields[1], fields[2], float(fields[3]), float(fields[4]), words))
+    return segments
+
+def read_ctm(lines):
+    """Return a dict of (file, channel) -> list of (start time, middle
+    time, word) for the words in the lines of a CTM file, and a list of the
+    (file, channel) keys in the order they first appear."""
+    words = {}
+    order = []
+    for line in lines:
+        if line.startswith(';;'):
+            continue
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) < 5:
+            raise ValueError('Bad CTM line: {!r}'.format(line))
+        key = (fields[0], fields[1])
+        if key not in words:
+            words[key] = []
+            order.append(key)
+        start = float(fields[2])
+        words[key].append((start, start + float(fields[3]) / 2, fields[4]))
+    return words, order
+
+def assign_words(segments, words):
+    """Assign words, a list of (start, middle, word), to the segments (of
+    one file and channel) that contain their middles.  Return (a list of the
+    words of each segment, and a list of (index of the segment before the
+    gap or -1, gap words) for the words in no segment).  Words are kept in
+    the order of their middles, and a word in overlapping segments goes to
+    the one that ends first."""
+    order = sorted(range(len(segments)), key=lambda i: segments[i].begin)
+    assigned = [[] for _ in segments]
+    gaps = []
+    active = []
+    next_segment = 0
+    # The segment that most recently began, for placing gaps
+    last_begun = -1
+    for start, middle, word in sorted(words, key=lambda item: (item[1], item[0])):
+        while next_segment < len(order) and segments[order[next_segment]].begin <= middle:
+            index = order[next_segment]
+            heapq.heappush(active, (segments[index].end, index))
+            last_begun = index
+            next_segment += 1
+        while active and active[0][0] <= middle:
+            heapq.heappop(active)
+        if active:
+            assigned[active[0][1]].append(word)
+        elif gaps and gaps[-1][0] == last_begun:
+            gaps[-1][1].append(word)
+        else:
+            gaps.append((last_begun, [word]))
+    return assigned, gaps
+
+def timed_pairs(stm_lines, ctm_lines):
+    """Yield (ref line, hyp line) pairs with the segment ID as the first
+    token, for scoring with head_ids: one for each reference segment (in
+    STM order, except ignored ones) and one for each gap with hypothesis
+    words, after the segment it follows.  Files and channels in the CTM but
+    not the STM come last, with all their words in one gap."""
+    segments = read_stm(stm_lines)
+    words, ctm_order = read_ctm(ctm_lines)
+    # (file, channel) -> indexes of its segments
+    channels = {}
+    for index, segment in enumerate(segments):
+        channels.setdefault((segment.file, segment.channel), []).append(index)
+    assigned = [None] * len(segments)
+    # Index of the segment before a gap (or (file, channel) for a gap before
+    # them all) -> words of the gap
+    gaps_after = {}
+    for key, indexes in channels.items():
+        channel_words, gaps = assign_words([segments[index] for index in indexes], words.get(key, []))
+        for index, segment_words in zip(indexes, channel_words):
+            assigned[index] = segment_words
+        for position, gap_words in gaps:
+            gaps_after[indexes[position] if position >= 0 else key] = gap_words
+    started = set()
+    for index, segment in enumerate(segments):
+        key = (segment.file, segment.channel)
+        if key not in started:
+            started.add(key)
+            if key in gaps_after:
+                yield gap_pair(key, None, gaps_after[key])
+        if not (len(segment.words) == 1 and segment.words[0].lower() == ignore_segment):
+            segment_id = segment_name(segment)
+            yield (segment_id + ' ' + ' '.join(segment.words) + '\n',
+                   segment_id + ' ' + ' '.join(assigned[index]) + '\n')
+        if index in gaps_after:
+            yield gap_pair(key, segment, gaps_after[index])
+    for key in ctm_order:
+        if key not in channels:
+            yield gap_pair(key, None, [word for start, middle, word in sorted(words[key], key=lambda item: item[1])])
+
+def segment_name(segment):
+    return '{}-{}-{:.2f}-{:.2f}'.format(segment.file, segment.channel, segment.begin, segment.end)
+
+def gap_pair(key, segment, gap_words):
+    """Return the pair for hypothesis words in a gap after a segment (or
+    before the first one, if segment is None)."""
+    gap_id = '{}-{}-gap-{:.2f}'.format(key[0], key[1], segment.end if segment is not None else 0.0)
+    return gap_id + '\n', gap_id + ' ' + ' '.join(gap_words) + '\n'
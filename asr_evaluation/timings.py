@@ -0,0 +1,99 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-stage timing and counters for an evaluation.
+"""
+from __future__ import division
+
+import time
+from collections import defaultdict
+
+# time.perf_counter and time.process_time don't exist in Python 2
+wall_clock = getattr(time, 'perf_counter', time.time)
+cpu_clock = getattr(time, 'process_time', time.clock if hasattr(time, 'clock') else time.time)
+
+
+class Timings(object):
+    """Accumulates wall and CPU time per named stage (reading, tokenizing,
+    aligning, ...), and event counters such as lines, tokens and (nominal)
+    dynamic programming cells.
+
+    Pass one to an Evaluation to have it filled in; the CLI does this with
+    --timings.  Timings from worker processes are combined with merge().
+    """
+    __slots__ = ('wall', 'cpu', 'calls', 'counters', 'created')
+
+    def __init__(self):
+        self.wall = defaultdict(float)
+        self.cpu = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.created = wall_clock()
+
+    def start(self):
+        """Return the current (wall, cpu) clock readings, to pass to stop()."""
+        return wall_clock(), cpu_clock()
+
+    def stop(self, stage, start):
+        """Charge the time since start to a stage.  Returns new clock readings,
+        so consecutive stages can be timed with one reading between them."""
+        now = wall_clock(), cpu_clock()
+        self.wall[stage] += now[0] - start[0]
+        self.cpu[stage] += now[1] - start[1]
+        self.calls[stage] += 1
+        return now
+
+    def count(self, counter, n=1):
+        """Add n to a counter."""
+        self.counters[counter] += n
+
+    def timed(self, stage, iterable):
+        """Yield the items of an iterable, charging the time spent getting
+        each one to a stage."""
+        iterator = iter(iterable)
+        while True:
+            start = self.start()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.stop(stage, start)
+                return
+            self.stop(stage, start)
+            yield item
+
+    def merge(self, other):
+        """Add the times and counters of another Timings to this one."""
+        for name, value in other.wall.items():
+            self.wall[name] += value
+        for name, value in other.cpu.items():
+            self.cpu[name] += value
+        for name, value in other.calls.items():
+            self.calls[name] += value
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        return self
+
+    def report(self):
+        """Return the timings as a JSON-serializable dict.  Stage times from
+        worker processes are summed, so they can add up to more than the
+        elapsed time."""
+        stages = {}
+        for stage in self.calls:
+            stages[stage] = {'wall_seconds': self.wall[stage],
+                             'cpu_seconds': self.cpu[stage],
+                             'calls': self.calls[stage]}
+        return {'elapsed_seconds': wall_clock() - self.created,
+                'stages': stages,
+                'counters': dict(self.counters)}
@@ -0,0 +1,92 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Interning of tokens as small integer IDs.
+"""
+from array import array
+
+
+class Vocabulary(object):
+    """Maps each (normalized) token to an integer ID the first time it's seen.
+
+    Sentences are stored as array('i') buffers of IDs, so alignment compares
+    ints and the confusion tables are keyed on ints.  Down-casing for
+    case-insensitive scoring is done once per distinct raw token rather than
+    once per occurrence, and so is normalization with a Normalizer.
+    """
+    __slots__ = ('ids', 'tokens', 'lower_ids', 'normal_ids')
+
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+        # Raw token -> ID of its lower case form
+        self.lower_ids = {}
+        # Raw token -> tuple of the IDs of its normalized tokens
+        self.normal_ids = {}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def intern(self, token):
+        """Return the ID of a token, adding it if it's new."""
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def intern_lower(self, token):
+        """Return the ID of the lower case form of a token."""
+        token_id = self.lower_ids.get(token)
+        if token_id is None:
+            token_id = self.lower_ids[token] = self.intern(token.lower())
+        return token_id
+
+    def intern_normal(self, token, normalizer, lower=False):
+        """Return the tuple of IDs of the tokens a raw token normalizes to."""
+        token_ids = self.normal_ids.get(token)
+        if token_ids is None:
+            normalized = normalizer.normalize(token.lower() if lower else token)
+            token_ids = self.normal_ids[token] = tuple(self.intern(part) for part in normalized)
+        return token_ids
+
+    def encode(self, tokens, lower=False, normalizer=None):
+        """Return an array('i') of the IDs of a list of tokens.  With a
+        Normalizer, tokens are normalized first (and may become several
+        tokens or none).  A vocabulary should only be used with one
+        normalizer."""
+        if normalizer is not None:
+            normal_ids = self.normal_ids
+            try:
+                return array('i', [token_id for token in tokens for token_id in normal_ids[token]])
+            except KeyError:
+                return array('i', [token_id for token in tokens
+                                   for token_id in self.intern_normal(token, normalizer, lower)])
+        ids = self.ids if not lower else self.lower_ids
+        try:
+            # Fast path for when every token has been seen before
+            return array('i', [ids[token] for token in tokens])
+        except KeyError:
+            intern = self.intern if not lower else self.intern_lower
+            return array('i', [intern(token) for token in tokens])
+
+    def decode(self, ids):
+        """Return the list of tokens for a sequence of IDs."""
+        tokens = self.tokens
+        return [tokens[token_id] for token_id in ids]
+
+    def translate(self, other):
+        """Return a list mapping the IDs of another vocabulary to IDs in this one."""
+        return [self.intern(token) for token in other.tokens]
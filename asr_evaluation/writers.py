@@ -0,0 +1,274 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Machine-readable output of the per-utterance results, the summary and the
+confusion tables, for loading into analysis tools.
+
+Each utterance record has the fields in UTTERANCE_FIELDS: its ID (None if
+the files don't have IDs), its sentence number, the reference and
+hypothesis lengths, the errors and matches, the errors by type, and
+whether it was capped by --max-wer (in which case the matches are a lower
+bound and the errors by type aren't known).  With alignments, it also has
+the alignment as one letter per aligned position: e(qual), r(eplace),
+i(nsert) or d(elete) (None for capped utterances).
+
+There are three formats:
+
+jsonl
+    One JSON object per line, with a "type" field: "utterance" for each
+    utterance, then "summary", then "insertion", "deletion" and
+    "substitution" for the confusions (with -c).
+csv
+    The utterances in the file itself, and the summary and confusions in
+    <name>.summary.csv and <name>.confusions.csv next to it.
+columnar
+    A NumPy .npz file with one array per column: utterances.<field>,
+    summary.<field> and confusions.<field>.  Each string column is stored
+    as the UTF-8 bytes of all its values (<column>.data) and the offsets
+    of each value in them (<column>.offsets), so millions of rows load
+    without unpickling.  load_columnar() reads one back.  Needs NumPy.
+
+Records are buffered and written in bulk.
+"""
+import io
+import os
+from array import array
+
+UTTERANCE_FIELDS = ('id', 'sentence', 'ref_length', 'hyp_length', 'errors', 'matches',
+                    'substitutions', 'deletions', 'insertions', 'capped')
+CONFUSION_FIELDS = ('type', 'ref', 'hyp', 'count')
+
+# Records written at a time by the text formats
+buffer_size = 4096
+
+
+def utterance_record(id_, sentence, ref_length, hyp_length, errors, matches, capped=False):
+    """Return the record tuple for an utterance, with the fields of
+    UTTERANCE_FIELDS.  (Records with alignments have it added at the end.)
+    The errors by type are worked out from the counts, so they don't need
+    the alignment."""
+    if capped:
+        return (id_, sentence, ref_length, hyp_length, errors, matches, None, None, None, True)
+    # ref_length = matches + subs + dels, hyp_length = matches + subs + ins
+    substitutions = ref_length + hyp_length - 2 * matches - errors
+    return (id_, sentence, ref_length, hyp_length, errors, matches, substitutions,
+            ref_length - matches - substitutions, hyp_length - matches - substitutions, False)
+
+def confusion_records(evaluation):
+    """Return (type, ref token, hyp token, count) tuples for the confusion
+    tables of an evaluation, with None for the missing side."""
+    insertions, deletions, substitutions = evaluation.confusion_tables()
+    records = [('insertion', None, word, count) for word, count in insertions]
+    records.extend(('deletion', word, None, count) for word, count in deletions)
+    records.extend(('substitution', ref, hyp, count) for (ref, hyp), count in substitutions)
+    return records
+
+def guess_format(path):
+    """Return the format for an output file name: csv for .csv, columnar
+    for .npz, and jsonl otherwise."""
+    extension = os.path.splitext(path)[1].lower()
+    return {'.csv': 'csv', '.npz': 'columnar'}.get(extension, 'jsonl')
+
+def open_writer(path, format=None, alignments=False):
+    """Return a writer of the given format (by default guessed from the path)."""
+    format = format or guess_format(path)
+    writer_class = {'jsonl': JsonlWriter, 'csv': CsvWriter, 'columnar': ColumnarWriter}[format]
+    return writer_class(path, alignments)
+
+
+class RecordWriter(object):
+    """Base class for the writers, which buffers the utterance records added
+    with append() or extend() (so a list can stand in for a writer, e.g. in
+    worker processes).  Each writer defines flush(), which writes out the
+    buffered records, and finish(evaluation), which writes the remaining
+    records, the summary and (if the evaluation has them) the confusions,
+    and closes the output."""
+
+    def __init__(self, path, alignments=False):
+        self.path = path
+        self.alignments = alignments
+        self.fields = UTTERANCE_FIELDS + (('alignment',) if alignments else ())
+        self.buffer = []
+
+    def append(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= buffer_size:
+            self.flush()
+
+    def extend(self, records):
+        self.buffer.extend(records)
+        if len(self.buffer) >= buffer_size:
+            self.flush()
+
+
+class JsonlWriter(RecordWriter):
+
+    def __init__(self, path, alignments=False):
+        super(JsonlWriter, self).__init__(path, alignments)
+        import json
+        self.dumps = json.dumps
+        self.file = io.open(path, 'w', encoding='utf-8')
+        # Only the strings need escaping, so the rest is formatted directly
+        self.template = '{{"type": "utterance", ' + ', '.join(
+            '"{}": {{}}'.format(field) for field in self.fields) + '}}\n'
+
+    def flush(self):
+        dumps = self.dumps
+        template = self.template
+        lines = []
+        for record in self.buffer:
+            values = ['null' if value is None else value for value in record]
+            values[0] = dumps(record[0])
+            values[9] = 'true' if record[9] else 'false'
+            if self.alignments:
+                values[10] = dumps(record[10])
+            lines.append(template.format(*values))
+        self.file.write(''.join(lines))
+        del self.buffer[:]
+
+    def finish(self, evaluation):
+        self.flush()
+        summary = dict(type='summary', **evaluation.result())
+        lines = [self.dumps(summary)]
+        if evaluation.confusions:
+            lines.extend(self.dumps(dict(zip(CONFUSION_FIELDS, record))) for record in confusion_records(evaluation))
+        self.file.write('\n'.join(lines) + '\n')
+        self.file.close()
+
+
+class CsvWriter(RecordWriter):
+
+    def __init__(self, path, alignments=False):
+        super(CsvWriter, self).__init__(path, alignments)
+        import csv
+        self.csv = csv
+        self.file = open_csv(path)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.fields)
+
+    def flush(self):
+        self.writer.writerows(self.buffer)
+        del self.buffer[:]
+
+    def finish(self, evaluation):
+        self.flush()
+        self.file.close()
+        base = self.path[:-4] if self.path.lower().endswith('.csv') else self.path
+        result = evaluation.result()
+        with open_csv(base + '.summary.csv') as summary_file:
+            writer = self.csv.writer(summary_file)
+            writer.writerow(sorted(result))
+            writer.writerow([result[name] for name in sorted(result)])
+        if evaluation.confusions:
+            with open_csv(base + '.confusions.csv') as confusions_file:
+                writer = self.csv.writer(confusions_file)
+                writer.writerow(CONFUSION_FIELDS)
+                writer.writerows(confusion_records(evaluation))
+
+
+def open_csv(path):
+    return io.open(path, 'w', encoding='utf-8', newline='')
+
+
+class ColumnarWriter(RecordWriter):
+    """Keeps each column in a compact array (strings as one UTF-8 buffer
+    with offsets) and saves them all with numpy.savez at the end."""
+
+    def __init__(self, path, alignments=False):
+        super(ColumnarWriter, self).__init__(path, alignments)
+        self.columns = [StringColumn()] + [array('q') for _ in UTTERANCE_FIELDS[1:9]] + [array('b')]
+        if alignments:
+            self.columns.append(StringColumn())
+
+    def flush(self):
+        for column, values in zip(self.columns, zip(*self.buffer)):
+            if isinstance(column, StringColumn):
+                column.extend(values)
+            else:
+                # Unknown errors by type (capped utterances) are stored as -1
+                column.extend([-1 if value is None else value for value in values])
+        del self.buffer[:]
+
+    def finish(self, evaluation):
+        import numpy
+        self.flush()
+        arrays = {}
+        for field, column in zip(self.fields, self.columns):
+            name = 'utterances.' + field
+            if isinstance(column, StringColumn):
+                column.save(arrays, name)
+            elif field == 'capped':
+                arrays[name] = numpy.frombuffer(column, dtype=numpy.int8).astype(bool)
+            else:
+                arrays[name] = numpy.frombuffer(column, dtype=numpy.int64)
+        for name, value in evaluation.result().items():
+            arrays['summary.' + name] = numpy.array([value])
+        if evaluation.confusions:
+            records = confusion_records(evaluation)
+            for i, field in enumerate(CONFUSION_FIELDS[:3]):
+                column = StringColumn()
+                column.extend([record[i] for record in records])
+                column.save(arrays, 'confusions.' + field)
+            arrays['confusions.count'] = numpy.array([record[3] for record in records], dtype=numpy.int64)
+        with open(self.path, 'wb') as output:
+            numpy.savez(output, **arrays)
+
+
+class StringColumn(object):
+    """A column of strings (or None) as UTF-8 bytes and offsets."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('q', [0])
+        self.missing = array('b')
+
+    def extend(self, values):
+        data = self.data
+        offsets = self.offsets
+        for value in values:
+            if value is not None:
+                data += value.encode('utf-8')
+            offsets.append(len(data))
+            self.missing.append(value is None)
+
+    def save(self, arrays, name):
+        import numpy
+        arrays[name + '.data'] = numpy.frombuffer(bytes(self.data), dtype=numpy.uint8)
+        arrays[name + '.offsets'] = numpy.frombuffer(self.offsets, dtype=numpy.int64)
+        arrays[name + '.missing'] = numpy.frombuffer(self.missing, dtype=numpy.int8).astype(bool)
+
+
+def load_columnar(path, decode=True):
+    """Return the columns of a file written in the columnar format, as a
+    dict of name -> NumPy array.  String columns are decoded to lists of
+    str (with None for missing values) unless decode is false, in which
+    case their .data, .offsets and .missing arrays are returned as is."""
+    import numpy
+    with numpy.load(path) as npz:
+        arrays = dict((name, npz[name]) for name in npz.files)
+    if not decode:
+        return arrays
+    columns = {}
+    for name, value in arrays.items():
+        if name.endswith('.data'):
+            column = name[:-len('.data')]
+            data = value.tobytes()
+            offsets = arrays[column + '.offsets']
+            missing = arrays[column + '.missing']
+            columns[column] = [None if missing[i] else data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                               for i in range(len(missing))]
+        elif not name.endswith(('.offsets', '.missing')):
+            columns[name] = value
+    return columns
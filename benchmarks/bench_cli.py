@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark each mode of the wer CLI on synthetic corpora.
+
+Every (corpus, mode) combination runs in a fresh process, and the suite
+reports lines/sec, tokens/sec and the peak resident memory of that process
+(or of the largest of its worker processes, if that's higher).
+Results can be saved as JSON and compared against a saved baseline, exiting
+with status 1 if any combination got slower by more than the tolerance.
+
+    python -m benchmarks.bench_cli --scale 0.5 --save baseline.json
+    python -m benchmarks.bench_cli --scale 0.5 --compare baseline.json
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.corpora import CORPORA, write_corpus
+
+# name: extra CLI arguments
+MODES = [
+    ('default', []),
+    ('case-insensitive', ['-a']),
+    ('wer-vs-length', ['-p']),
+    ('confusions', ['-c']),
+    ('print-errors', ['-r']),
+    ('print-instances', ['-i']),
+    ('streaming', ['-s']),
+    ('jobs', ['-j', '2']),
+    ('batch', ['-b', '256']),
+    ('join-ids', ['--join-ids']),
+]
+
+
+def run_once(argv):
+    """Run the CLI in this process with its output discarded, and print the
+    elapsed time and peak memory as JSON.  Used in the child processes."""
+    import resource
+    from asr_evaluation import __main__
+    sys.argv = ['wer'] + argv
+    stdout = sys.stdout
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            __main__.main()
+        finally:
+            sys.stdout = stdout
+    elapsed = time.time() - start
+    # Modes with worker processes (-j) also count the largest worker, which
+    # getrusage only reports for children that have been waited for; the
+    # workers have all exited by the time main() returns
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    peak_mb = maxrss / (1 << 20) if sys.platform == 'darwin' else maxrss / (1 << 10)
+    print(json.dumps({'seconds': elapsed, 'peak_mb': peak_mb}))
+
+def bench(ref, hyp, extra, repeat):
+    """Run one mode in fresh processes and return the best time and its peak memory."""
+    best = None
+    for _ in range(repeat):
+        command = [sys.executable, '-m', 'benchmarks.bench_cli', '--run-once', '--', ref, hyp, '--head-ids'] + extra
+        output = subprocess.check_output(command)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+def have_numpy():
+    try:
+        import numpy  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark each mode of the wer CLI on synthetic corpora.')
+    parser.add_argument('--corpora', nargs='+', choices=sorted(CORPORA), default=sorted(CORPORA),
+                        help='Corpora to run (default all).')
+    parser.add_argument('--modes', nargs='+', choices=[name for name, _ in MODES],
+                        default=[name for name, _ in MODES], help='CLI modes to run (default all).')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply the corpus sizes by this.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per combination; the fastest is kept.')
+    parser.add_argument('--save', metavar='file', help='Write the results to a JSON file.')
+    parser.add_argument('--compare', metavar='file', help='Compare against results saved with --save.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown relative to --compare before failing (default 0.25).')
+    parser.add_argument('--run-once', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('argv', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_once:
+        run_once(args.argv)
+        return 0
+
+    modes = dict(MODES)
+    if not have_numpy() and 'batch' in args.modes:
+        args.modes.remove('batch')
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    results = {}
+    regressions = []
+    directory = tempfile.mkdtemp()
+    try:
+        print('{0:10s} {1:17s} {2:>12s} {3:>12s} {4:>9s} {5:>9s}'.format(
+            'corpus', 'mode', 'lines/sec', 'tokens/sec', 'peak MB', 'change'))
+        for corpus in args.corpora:
+            ref, hyp, lines, tokens = write_corpus(directory, corpus, args.scale)
+            for mode in args.modes:
+                result = bench(ref, hyp, modes[mode], args.repeat)
+                key = '{}/{}'.format(corpus, mode)
+                results[key] = {'lines_per_sec': lines / result['seconds'],
+                                'tokens_per_sec': tokens / result['seconds'],
+                                'peak_mb': result['peak_mb']}
+                change = ''
+                if key in baseline:
+                    ratio = results[key]['lines_per_sec'] / baseline[key]['lines_per_sec'] - 1
+                    change = '{:+.1%}'.format(ratio)
+                    if ratio < -args.tolerance:
+                        regressions.append(key)
+                print('{0:10s} {1:17s} {2:12.1f} {3:12.1f} {4:9.1f} {5:>9s}'.format(
+                    corpus, mode, results[key]['lines_per_sec'], results[key]['tokens_per_sec'],
+                    results[key]['peak_mb'], change))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+    if regressions:
+        print('Slower than the baseline by more than {:.0%}: {}'.format(args.tolerance, ', '.join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
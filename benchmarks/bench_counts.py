@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the throughput of the counts-only alignment engines with the
+SequenceMatcher path used when opcodes are needed.  The batch aligner is
+included when NumPy is installed.
+
+    python -m benchmarks.bench_counts --lines 2000 --length 20
+"""
+from __future__ import division, print_function
+
+import argparse
+import time
+
+from edit_distance import SequenceMatcher
+
+from asr_evaluation.align import edit_counts, levenshtein_distance
+from asr_evaluation.asr_evaluation import get_error_count, get_match_count
+from benchmarks.corpora import make_pairs
+
+try:
+    from asr_evaluation.batch import align_batch
+except ImportError:
+    align_batch = None
+
+
+def sequence_matcher_counts(ref, hyp):
+    sm = SequenceMatcher(a=ref, b=hyp)
+    return get_error_count(sm), get_match_count(sm)
+
+def bench(name, function, pairs):
+    start = time.time()
+    for ref, hyp in pairs:
+        function(ref, hyp)
+    elapsed = time.time() - start
+    print('{0:24s} {1:10.1f} lines/sec {2:8.3f} s'.format(name, len(pairs) / elapsed, elapsed))
+
+def bench_batch(pairs, batch_size):
+    start = time.time()
+    ids = {}
+    refs = [[ids.setdefault(token, len(ids)) for token in ref] for ref, _ in pairs]
+    hyps = [[ids.setdefault(token, len(ids)) for token in hyp] for _, hyp in pairs]
+    for k in range(0, len(pairs), batch_size):
+        align_batch(refs[k:k + batch_size], hyps[k:k + batch_size])
+    elapsed = time.time() - start
+    print('{0:24s} {1:10.1f} lines/sec {2:8.3f} s'.format('align_batch', len(pairs) / elapsed, elapsed))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--lines', type=int, default=2000, help='Number of line pairs.')
+    parser.add_argument('--length', type=int, default=20, help='Mean reference length in tokens.')
+    parser.add_argument('--error-rate', type=float, default=0.15, help='Approximate error rate.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Batch size for align_batch.')
+    args = parser.parse_args()
+    pairs = make_pairs(args.lines, 1, 2 * args.length, error_rate=args.error_rate)
+    bench('SequenceMatcher', sequence_matcher_counts, pairs)
+    bench('edit_counts', edit_counts, pairs)
+    bench('levenshtein_distance', levenshtein_distance, pairs)
+    if align_batch is not None:
+        bench_batch(pairs, args.batch_size)
+
+if __name__ == '__main__':
+    main()
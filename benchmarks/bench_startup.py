@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the startup cost of the wer CLI: the time to score a one line
+corpus, over the time to start a bare Python interpreter, and which of the
+modules that only some options need were imported anyway.
+
+    python -m benchmarks.bench_startup --budget 0.1
+
+Exits with status 1 if a mode's overhead is over the budget (in seconds).
+"""
+from __future__ import division, print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules that should only be imported by the options that need them
+DEFERRED_MODULES = ['edit_distance', 'termcolor', 'multiprocessing', 'sqlite3', 'asyncio', 'numpy']
+
+# name: extra CLI arguments
+MODES = [
+    ('help', ['--help']),
+    ('default', []),
+    ('wer-vs-length', ['-p']),
+    ('confusions', ['-c']),
+    ('print-instances', ['-i']),
+]
+
+CHILD = '''
+import sys
+from asr_evaluation import __main__
+sys.argv = ['wer'] + sys.argv[1:]
+try:
+    __main__.main()
+except SystemExit:
+    pass
+sys.stdout = sys.__stdout__
+print('deferred: ' + ' '.join(sorted(name for name in {modules!r} if name in sys.modules)))
+'''
+
+
+def run(command):
+    """Return the wall time of a command and the deferred modules it loaded."""
+    start = time.time()
+    output = subprocess.check_output(command)
+    elapsed = time.time() - start
+    lines = output.decode('utf-8').rstrip('\n').splitlines()
+    loaded = lines[-1] if lines else ''
+    return elapsed, loaded[len('deferred: '):] if loaded.startswith('deferred: ') else ''
+
+def best_time(command, repeat):
+    return min(run(command)[0] for _ in range(repeat))
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup cost of the wer CLI.')
+    parser.add_argument('--repeat', type=int, default=10, help='Runs per mode; the fastest is kept.')
+    parser.add_argument('--budget', type=float, default=0.1,
+                        help='Allowed seconds over a bare interpreter start (default 0.1).')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        ref = os.path.join(directory, 'ref.txt')
+        hyp = os.path.join(directory, 'hyp.txt')
+        with open(ref, 'w') as ref_file:
+            ref_file.write('utt1 the cat sat on the mat\n')
+        with open(hyp, 'w') as hyp_file:
+            hyp_file.write('utt1 the cat sat on a mat\n')
+        baseline = best_time([sys.executable, '-c', 'pass'], args.repeat)
+        print('bare interpreter: {:.1f} ms'.format(baseline * 1000))
+        print('{0:17s} {1:>10s} {2:>12s}  {3}'.format('mode', 'ms', 'overhead ms', 'deferred modules loaded'))
+        over_budget = []
+        child = CHILD.format(modules=DEFERRED_MODULES)
+        for mode, extra in MODES:
+            command = [sys.executable, '-c', child, ref, hyp, '--head-ids'] + extra
+            elapsed = best_time(command, args.repeat)
+            loaded = run(command)[1]
+            overhead = elapsed - baseline
+            if overhead > args.budget:
+                over_budget.append(mode)
+            print('{0:17s} {1:10.1f} {2:12.1f}  {3}'.format(mode, elapsed * 1000, overhead * 1000, loaded))
+    finally:
+        shutil.rmtree(directory)
+    if over_budget:
+        print('Over the startup budget of {:.0f} ms: {}'.format(args.budget * 1000, ', '.join(over_budget)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
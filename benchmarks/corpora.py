@@ -0,0 +1,64 @@
+# Copyright 2017-2018 Ben Lambert
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Synthetic, reproducible ref/hyp corpora for the benchmarks.
+"""
+import os
+import random
+
+# name: (lines, min length, max length, vocabulary size, error rate)
+CORPORA = {
+    'commands': (20000, 1, 6, 200, 0.05),
+    'dictation': (2000, 20, 60, 5000, 0.15),
+    'long': (10, 1000, 2000, 5000, 0.10),
+    'noisy': (5000, 10, 30, 1000, 0.50),
+    'clean': (5000, 10, 30, 1000, 0.01),
+}
+
+
+def make_pairs(lines, min_length, max_length, vocab_size=500, error_rate=0.15, seed=0):
+    """Return a list of synthetic (ref, hyp) token lists.  The errors are an
+    even mix of deletions, substitutions and insertions."""
+    rng = random.Random(seed)
+    vocab = ['w{}'.format(i) for i in range(vocab_size)]
+    pairs = []
+    for _ in range(lines):
+        ref = [rng.choice(vocab) for _ in range(rng.randint(min_length, max_length))]
+        hyp = []
+        for token in ref:
+            r = rng.random()
+            if r < error_rate / 3:
+                continue
+            elif r < 2 * error_rate / 3:
+                hyp.append(rng.choice(vocab))
+            elif r < error_rate:
+                hyp.extend([token, rng.choice(vocab)])
+            else:
+                hyp.append(token)
+        pairs.append((ref, hyp))
+    return pairs
+
+def write_corpus(directory, name, scale=1.0, seed=0):
+    """Write one of the CORPORA as Kaldi style (head ID) ref and hyp files.
+    Returns (ref path, hyp path, line count, ref token count)."""
+    lines, min_length, max_length, vocab_size, error_rate = CORPORA[name]
+    pairs = make_pairs(max(1, int(lines * scale)), min_length, max_length, vocab_size, error_rate, seed)
+    ref_path = os.path.join(directory, name + '.ref')
+    hyp_path = os.path.join(directory, name + '.hyp')
+    with open(ref_path, 'w') as ref_file, open(hyp_path, 'w') as hyp_file:
+        for k, (ref, hyp) in enumerate(pairs):
+            ref_file.write('utt{} {}\n'.format(k, ' '.join(ref)))
+            hyp_file.write('utt{} {}\n'.format(k, ' '.join(hyp)))
+    return ref_path, hyp_path, len(pairs), sum(len(ref) for ref, _ in pairs)
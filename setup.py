@@ -9,9 +9,12 @@ setup(
     license='LICENSE.txt',
     description='Evaluating ASR (automatic speech recognition) hypotheses, i.e. computing word error rate.',
     install_requires=['edit_distance', 'termcolor'],
+    extras_require={'batch': ['numpy']},
     test_suite='test.test.TestASREvaluation',
     long_description=open('README.md').read(),
     long_description_content_type="text/markdown",
+    # The scoring service (wer serve) needs Python 3.7 or later; the rest
+    # runs on Python 2.7 and 3.4+
     entry_points={
         'console_scripts': [
             'wer = asr_evaluation.__main__:main'
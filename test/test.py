@@ -17,18 +17,70 @@ Unit tests for asr_evaluation.
 """
 from __future__ import division
 
+import io
+import os
+import json
 import sys
+import random
+import shutil
+import subprocess
+import tempfile
 import unittest
 
 from asr_evaluation import __main__
+from asr_evaluation import asr_evaluation
+from asr_evaluation import align
+from asr_evaluation.streaming import RunningStats
+from edit_distance import SequenceMatcher
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Note these tests aren't checking for correctness.  They are simply
 # exercising all the command line options to make sure we don't get errors
 # simply by running them.
 
+def write_corpus(directory, n=200, seed=0):
+    """Write a random ref/hyp pair of files with Kaldi style IDs and return
+    their paths."""
+    rng = random.Random(seed)
+    words = ['a', 'b', 'c', 'd', 'e', 'f', 'the', 'cat', 'dog']
+    ref_path = os.path.join(directory, 'ref.txt')
+    hyp_path = os.path.join(directory, 'hyp.txt')
+    with open(ref_path, 'w') as ref_file, open(hyp_path, 'w') as hyp_file:
+        for i in range(n):
+            ref = [rng.choice(words) for _ in range(rng.randint(0, 12))]
+            hyp = [w for w in ref if rng.random() > 0.1]
+            hyp = [rng.choice(words) if rng.random() < 0.1 else w for w in hyp]
+            if rng.random() < 0.2:
+                hyp.insert(rng.randint(0, len(hyp)), rng.choice(words))
+            ref_file.write('utt{} {}\n'.format(i, ' '.join(ref)))
+            hyp_file.write('utt{} {}\n'.format(i, ' '.join(hyp)))
+    return ref_path, hyp_path
+
+def run_cli(argv):
+    """Run the CLI with the given arguments and return what it printed."""
+    stdout = sys.stdout
+    sys.stdout = output = io.StringIO()
+    try:
+        sys.argv = ['evaluate.py'] + argv
+        __main__.main()
+    finally:
+        sys.stdout = stdout
+    return output.getvalue()
+
 class TestASREvaluation(unittest.TestCase):
     """..."""
 
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ref, self.hyp = write_corpus(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
     def testing(self):
         """..."""
         self.assertTrue(True)
@@ -65,3 +117,586 @@ class TestASREvaluation(unittest.TestCase):
     def test_cli8(self):
         sys.argv = ['evaluate.py', 'requirements.txt', 'requirements.txt', '-id']
         __main__.main()
+
+    def test_jobs_match_sequential(self):
+        config = os.path.join(self.tmpdir, 'normalize.json')
+        with open(self.ref) as ref_file, open(config, 'w') as config_file:
+            # Ignoring the only word of some references leaves them empty
+            ignore = [line.split()[1] for line in ref_file if len(line.split()) == 2][:1]
+            json.dump({'ignore': ignore}, config_file)
+        asr_evaluation.shard_size = 7
+        try:
+            for extra in ([], ['-i', '-c', '-p', '-m', '0'], ['-r', '-e', '-a'], ['-i', '-e', '--normalize', config]):
+                argv = [self.ref, self.hyp, '--head-ids'] + extra
+                self.assertEqual(run_cli(argv), run_cli(argv + ['-j', '3']))
+        finally:
+            asr_evaluation.shard_size = 1000
+
+    def test_evaluation_merge(self):
+        with open(self.ref) as ref_file, open(self.hyp) as hyp_file:
+            pairs = list(zip(ref_file, hyp_file))
+        whole = asr_evaluation.Evaluation(head_ids=True, confusions=True)
+        first = asr_evaluation.Evaluation(head_ids=True, confusions=True)
+        second = asr_evaluation.Evaluation(head_ids=True, confusions=True)
+        for i, (ref_line, hyp_line) in enumerate(pairs):
+            whole.add_pair(ref_line, hyp_line)
+            (first if i < 50 else second).add_pair(ref_line, hyp_line)
+        merged = first.merge(second)
+        self.assertEqual(whole.result(), merged.result())
+        self.assertEqual(whole.wer_bins, merged.wer_bins)
+        self.assertEqual(whole.confusion_tables(), merged.confusion_tables())
+
+    def test_evaluation_result(self):
+        evaluation = asr_evaluation.Evaluation()
+        evaluation.add_pair('a b c d', 'a x c')
+        evaluation.add_pair('a b', 'a b')
+        result = evaluation.result()
+        self.assertEqual(result['sentence_count'], 2)
+        self.assertEqual(result['error_count'], 2)
+        self.assertEqual(result['match_count'], 4)
+        self.assertEqual(result['ref_token_count'], 6)
+        self.assertAlmostEqual(result['ser'], 0.5)
+
+    def test_edit_counts(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            ref = [rng.choice('abc') for _ in range(rng.randint(0, 12))]
+            hyp = [rng.choice('abc') for _ in range(rng.randint(0, 12))]
+            sm = SequenceMatcher(a=ref, b=hyp)
+            expected = (asr_evaluation.get_error_count(sm), asr_evaluation.get_match_count(sm))
+            self.assertEqual(align.edit_counts(ref, hyp), expected)
+            self.assertEqual(align.levenshtein_distance(ref, hyp), expected[0])
+
+    def test_banded_edit_counts(self):
+        rng = random.Random(3)
+        for _ in range(500):
+            ref = [rng.randrange(4) for _ in range(rng.randint(0, 80))]
+            hyp = [rng.randrange(4) for _ in range(rng.randint(0, 80))]
+            sm = SequenceMatcher(a=ref, b=hyp)
+            band = rng.randint(0, 40)
+            expected = (sm.distance(), sm.matches()) if sm.distance() <= band else None
+            self.assertEqual(align.banded_edit_counts(ref, hyp, band), expected)
+            self.assertEqual(align.long_edit_counts(ref, hyp), (sm.distance(), sm.matches()))
+
+    def test_linear_space_alignment(self):
+        rng = random.Random(4)
+        region_max_cells = align.region_max_cells
+        # Tiny regions, so the divide and conquer goes all the way down
+        align.region_max_cells = 4
+        try:
+            for _ in range(1000):
+                ref = [rng.randrange(3) for _ in range(rng.randint(0, 25))]
+                hyp = [rng.randrange(3) for _ in range(rng.randint(0, 25))]
+                sm = SequenceMatcher(a=ref, b=hyp)
+                alignment = align.linear_space_alignment(ref, hyp)
+                self.assertEqual(alignment.get_opcodes(), sm.get_opcodes())
+                self.assertEqual((alignment.distance(), alignment.matches()), (sm.distance(), sm.matches()))
+        finally:
+            align.region_max_cells = region_max_cells
+
+    def test_cli_linear_space(self):
+        argv = [self.ref, self.hyp, '--head-ids', '-i', '-c']
+        expected = run_cli(argv)
+        linear_space_min_cells = align.linear_space_min_cells
+        align.linear_space_min_cells = 0
+        try:
+            self.assertEqual(run_cli(argv), expected)
+        finally:
+            align.linear_space_min_cells = linear_space_min_cells
+
+    def test_max_wer(self):
+        ref_path = os.path.join(self.tmpdir, 'ref_capped.txt')
+        hyp_path = os.path.join(self.tmpdir, 'hyp_capped.txt')
+        with open(ref_path, 'w') as ref_file:
+            ref_file.write('a b c d\na b c d\na b\n')
+        with open(hyp_path, 'w') as hyp_file:
+            hyp_file.write('a b c d\nw x y z\na b w x y z\n')
+        evaluation = asr_evaluation.Evaluation(max_wer=1.0)
+        with open(ref_path) as ref_file, open(hyp_path) as hyp_file:
+            evaluation.add_batch(zip(ref_file, hyp_file))
+        result = evaluation.result()
+        # Only the last sentence has a WER over 1.0; its errors are still exact
+        self.assertEqual(result['capped_count'], 1)
+        self.assertEqual(result['error_count'], 4 + 4)
+        output = run_cli([ref_path, hyp_path, '--max-wer', '1.0', '-i'])
+        self.assertIn('Capped sentences: 1', output)
+        self.assertEqual(output.count('SENTENCE'), 2)
+        with self.assertRaises(SystemExit):
+            run_cli([ref_path, hyp_path, '--max-wer', '-0.5'])
+        # A WER equal to the maximum isn't capped, however it rounds
+        ref = ' '.join(['a'] * 100)
+        for errors, capped in ((29, 0), (30, 1)):
+            evaluation = asr_evaluation.Evaluation(max_wer=0.29, confusions=True)
+            evaluation.add_pair(ref, ' '.join(['b'] * errors + ['a'] * (100 - errors)))
+            self.assertEqual((evaluation.capped_count, evaluation.error_count), (capped, errors))
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_align_batch(self):
+        from asr_evaluation import batch
+        rng = random.Random(2)
+        refs = [[rng.randrange(4) for _ in range(rng.randint(0, 12))] for _ in range(300)]
+        hyps = [[rng.randrange(4) for _ in range(rng.randint(0, 12))] for _ in range(300)]
+        for ref, hyp, (errors, matches, opcodes) in zip(refs, hyps, batch.align_batch(refs, hyps, backtrace=True)):
+            sm = SequenceMatcher(a=ref, b=hyp)
+            self.assertEqual(opcodes, sm.get_opcodes())
+            self.assertEqual((errors, matches), (sm.distance(), sm.matches()))
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_cli_batch(self):
+        argv = [self.ref, self.hyp, '--head-ids', '-p']
+        self.assertEqual(run_cli(argv), run_cli(argv + ['-b', '16']))
+
+    def test_cli_streaming(self):
+        argv = [self.ref, self.hyp, '--head-ids', '-p']
+        self.assertEqual(run_cli(argv), run_cli(argv + ['-s']))
+        run_cli(argv + ['--reservoir-size', '5', '-j', '2'])
+
+    def test_running_stats(self):
+        values = [random.Random(4).random() for _ in range(100)]
+        stats = RunningStats(reservoir_size=10)
+        other = RunningStats(reservoir_size=10)
+        for i, value in enumerate(values):
+            (stats if i < 30 else other).add(value)
+        stats.merge(other)
+        self.assertEqual(stats.count, 100)
+        self.assertAlmostEqual(stats.mean(), sum(values) / len(values))
+        self.assertEqual(len(stats.reservoir), 10)
+        self.assertTrue(set(stats.reservoir) <= set(values))
+
+    def test_cli_join_ids(self):
+        with open(self.hyp) as hyp_file:
+            lines = hyp_file.readlines()
+        random.Random(0).shuffle(lines)
+        shuffled = os.path.join(self.tmpdir, 'shuffled.txt')
+        with open(shuffled, 'w') as hyp_file:
+            hyp_file.writelines(lines)
+        argv = ['--head-ids', '-c', '-p']
+        self.assertEqual(run_cli([self.ref, self.hyp] + argv), run_cli([self.ref, shuffled, '--join-ids'] + argv))
+
+    def test_join_by_id_tail_ids(self):
+        from asr_evaluation.reader import JoinStats, join_by_id
+        ref_path = os.path.join(self.tmpdir, 'ref_tail.txt')
+        hyp_path = os.path.join(self.tmpdir, 'hyp_tail.txt')
+        with open(ref_path, 'w') as ref_file:
+            ref_file.write('a b c (u1)\nd e (u2)\n\nf (u3)\n')
+        with open(hyp_path, 'w') as hyp_file:
+            hyp_file.write('d x (u2)\t\na b c (u1)\ng (u4)')
+        stats = JoinStats()
+        with open(ref_path) as ref_file, open(hyp_path) as hyp_file:
+            pairs = list(join_by_id(ref_file, hyp_file, head_ids=False, stats=stats))
+        self.assertEqual(pairs, [('a b c (u1)', 'a b c (u1)'), ('d e (u2)', 'd x (u2)\t'), ('f (u3)', '(u3)')])
+        self.assertEqual((stats.missing_hyps, stats.extra_hyps, stats.duplicate_ids), (1, 1, 0))
+
+    def test_cli_cache(self):
+        cache = os.path.join(self.tmpdir, 'cache.db')
+        argv = [self.ref, self.hyp, '--head-ids', '-c', '-i', '-p']
+        expected = run_cli(argv)
+        self.assertEqual(expected, run_cli(argv + ['--cache', cache]))
+        self.assertEqual(expected, run_cli(argv + ['--cache', cache, '--cache-size', '50']))
+        self.assertEqual(run_cli(argv[:3]), run_cli(argv[:3] + ['--cache', cache, '-j', '2']))
+        # Cached pairs over --max-wer are still capped
+        for capped_argv in (argv[:3] + ['--max-wer', '0.3'], argv + ['--max-wer', '0.3']):
+            expected = run_cli(capped_argv)
+            self.assertNotIn('Capped sentences: 0', expected)
+            self.assertEqual(expected, run_cli(capped_argv + ['--cache', cache]))
+        # A cache that can't be opened is a usage error, before any scoring
+        with self.assertRaises(SystemExit):
+            run_cli(argv + ['--cache', os.path.join(self.tmpdir, 'missing', 'cache.db')])
+
+    def test_alignment_cache(self):
+        from asr_evaluation.cache import AlignmentCache
+        cache = AlignmentCache(os.path.join(self.tmpdir, 'cache.db'), max_entries=2)
+        sm = SequenceMatcher(a=['a', 'b', 'c'], b=['a', 'x', 'c', 'd'])
+        cache.put(['a', 'b', 'c'], ['a', 'x', 'c', 'd'], sm.distance(), sm.matches(), sm.get_opcodes())
+        cache.put(['a'], ['b'], 1, 0)
+        self.assertIsNone(cache.get(['a'], ['b'], need_opcodes=True))
+        cached = cache.get(['a', 'b', 'c'], ['a', 'x', 'c', 'd'], need_opcodes=True)
+        self.assertEqual(cached.get_opcodes(), sm.get_opcodes())
+        self.assertEqual((cached.distance(), cached.matches()), (2, 2))
+        cache.put(['c'], ['c'], 0, 1)
+        cache.close()
+        # The least recently used entry is evicted
+        self.assertIsNone(cache.get(['a'], ['b']))
+        self.assertIsNotNone(cache.get(['c'], ['c']))
+        cache.close()
+
+    def test_vocabulary(self):
+        from asr_evaluation.vocab import Vocabulary
+        vocab = Vocabulary()
+        self.assertEqual(list(vocab.encode(['a', 'B', 'a'])), [0, 1, 0])
+        self.assertEqual(list(vocab.encode(['A', 'b', 'c'], lower=True)), [0, 2, 3])
+        self.assertEqual(vocab.decode(vocab.encode(['c', 'B'])), ['c', 'B'])
+        other = Vocabulary()
+        other.encode(['c', 'd'])
+        self.assertEqual(vocab.translate(other), [3, 4])
+
+    def test_cli_timings(self):
+        timings = os.path.join(self.tmpdir, 'timings.json')
+        profile = os.path.join(self.tmpdir, 'profile.out')
+        argv = [self.ref, self.hyp, '--head-ids', '-c']
+        self.assertEqual(run_cli(argv), run_cli(argv + ['--timings', timings, '--profile', profile]))
+        with open(timings) as timings_file:
+            report = json.load(timings_file)
+        self.assertEqual(report['counters']['lines'], 200)
+        self.assertEqual(report['result']['sentence_count'], 200)
+        self.assertTrue({'read', 'tokenize', 'align', 'confusions', 'report'} <= set(report['stages']))
+        self.assertTrue(os.path.exists(profile))
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'the service needs Python 3.7+')
+    def test_server(self):
+        # The server runs in an event loop on another thread, and is called
+        # with a plain socket, so this module has no async syntax for Python 2
+        import asyncio
+        import socket
+        import threading
+        from asr_evaluation import server
+        requests = [{'id': 1, 'ref_file': self.ref, 'hyp_file': self.hyp, 'options': {'head_ids': True}},
+                    {'id': 2, 'pairs': [['a b c', 'a x c']], 'options': {'confusions': True}, 'utterances': True},
+                    {'id': 3, 'pairs': [], 'options': {'print_instances': True}}]
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        tcp_server, service = loop.run_until_complete(server.start(port=0, workers=1))
+        port = tcp_server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            client = socket.create_connection(('127.0.0.1', port))
+            for request in requests:
+                client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            client.shutdown(socket.SHUT_WR)
+            chunks = []
+            chunk = client.recv(65536)
+            while chunk:
+                chunks.append(chunk)
+                chunk = client.recv(65536)
+            client.close()
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            tcp_server.close()
+            loop.run_until_complete(tcp_server.wait_closed())
+            service.close()
+            # Let the cancelled dispatchers finish before closing the loop
+            loop.run_until_complete(asyncio.gather(*service.dispatchers, return_exceptions=True))
+            loop.close()
+            asyncio.set_event_loop(None)
+        responses = [json.loads(line.decode('utf-8')) for line in b''.join(chunks).splitlines()]
+        evaluation = asr_evaluation.Evaluation(head_ids=True)
+        with open(self.ref) as ref_file, open(self.hyp) as hyp_file:
+            evaluation.add_batch(zip(ref_file, hyp_file))
+        self.assertEqual([response['id'] for response in responses], [1, 2, 3])
+        self.assertEqual(responses[0]['result'], evaluation.result())
+        self.assertEqual(responses[1]['utterances'],
+                         [{'id': None, 'ref_token_count': 3, 'error_count': 1, 'match_count': 2}])
+        self.assertEqual(responses[1]['confusions']['substitutions'], [['b', 'x', 1]])
+        self.assertIn('Unknown options: print_instances', responses[2]['error'])
+
+    def test_startup(self):
+        # A plain run shouldn't import the modules only some options need,
+        # and should start well within the budget (in seconds)
+        budget = 1.0
+        code = ('import sys, time\n'
+                'start = time.time()\n'
+                'from asr_evaluation import __main__\n'
+                'sys.argv = ["wer", sys.argv[1], sys.argv[2], "--head-ids"]\n'
+                '__main__.main()\n'
+                'print(time.time() - start)\n'
+                'print(" ".join(name for name in ("edit_distance", "termcolor", "multiprocessing", "sqlite3")\n'
+                '               if name in sys.modules))\n')
+        for _ in range(3):
+            output = subprocess.check_output([sys.executable, '-c', code, self.ref, self.hyp])
+            lines = output.decode('utf-8').splitlines()
+            self.assertEqual(lines[-1], '')
+            if float(lines[-2]) < budget:
+                break
+        else:
+            self.fail('Startup took {} seconds'.format(lines[-2]))
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_significance(self):
+        from asr_evaluation import significance
+        rng = numpy.random.default_rng(0)
+        lengths = rng.integers(1, 20, 300)
+        errors_a = rng.binomial(lengths, 0.2)
+        errors_b = rng.binomial(lengths, 0.3)
+        # Grouping the utterances doesn't change the distribution, so the
+        # interval is close to that of resampling utterances one by one
+        low, high, p_value = significance.paired_bootstrap(lengths, errors_a, errors_b, 4000)
+        picks = rng.integers(0, len(lengths), (4000, len(lengths)))
+        naive = (errors_b[picks].sum(1) - errors_a[picks].sum(1)) / lengths[picks].sum(1)
+        self.assertAlmostEqual(low, numpy.percentile(naive, 2.5), delta=0.005)
+        self.assertAlmostEqual(high, numpy.percentile(naive, 97.5), delta=0.005)
+        self.assertLess(p_value, 0.01)
+        self.assertGreater(significance.approximate_randomization(errors_a, errors_a[::-1], 1000), 0.05)
+        # The processes only change where the chunks are drawn
+        self.assertEqual(significance.bootstrap_wer(lengths, errors_a, 1200),
+                         significance.bootstrap_wer(lengths, errors_a, 1200, jobs=2))
+
+    @unittest.skipIf(numpy is None, 'needs numpy')
+    def test_cli_compare_hyp(self):
+        output = run_cli([self.ref, self.hyp, '--head-ids', '--bootstrap', '200'])
+        self.assertIn('WER 95% CI:', output)
+        output = run_cli([self.ref, self.hyp, '--head-ids', '--compare-hyp', self.hyp])
+        self.assertIn('WER difference: +0.000%', output)
+        self.assertIn('Approximate randomization p-value: 1.0000', output)
+        for bad_option in (['--bootstrap', '-5'], ['--bootstrap', '200', '--confidence', '95']):
+            with self.assertRaises(SystemExit):
+                run_cli([self.ref, self.hyp, '--head-ids'] + bad_option)
+
+    def test_cli_cer(self):
+        ref = os.path.join(self.tmpdir, 'cer_ref.txt')
+        hyp = os.path.join(self.tmpdir, 'cer_hyp.txt')
+        with io.open(ref, 'w', encoding='utf-8') as ref_file, io.open(hyp, 'w', encoding='utf-8') as hyp_file:
+            ref_file.write(u'utt1 \u4eca\u5929\u5929\u6c14\u5f88\u597d\n' * 50 + u'utt2 the cat\n')
+            hyp_file.write(u'utt1 \u4eca\u5929\u6c14\u5f88\u597d\u554a\n' * 50 + u'utt2 th ecat\n')
+        output = run_cli([ref, hyp, '--head-ids', '--cer', '-c'])
+        self.assertEqual(output, run_cli([ref, hyp, '--head-ids', '--cer', '-c', '-j', '2']))
+        # One deletion and one insertion per line, and whitespace is ignored
+        self.assertIn('CER:    32.680% (       100 /        306)', output)
+        self.assertNotIn('WER:', output)
+
+    def test_normalize(self):
+        from asr_evaluation.normalize import Normalizer
+        normalizer = Normalizer.from_config({'lowercase': True, 'ignore': ['<unk>', 'um'],
+                                             'regex': [['[.,!?]', ''], ['-', ' ']],
+                                             'map': {'colour': 'color', 'gonna': 'going to', 'x': ''}})
+        self.assertEqual(normalizer.normalize_all(['The', 'Colour,', '<unk>', 'is', 'well-known', 'UM', 'X', '!']),
+                         ['the', 'color', 'is', 'well', 'known'])
+        self.assertEqual(normalizer.normalize('Gonna'), ('going', 'to'))
+        config = os.path.join(self.tmpdir, 'normalize.json')
+        with open(os.path.join(self.tmpdir, 'map.txt'), 'w') as map_file:
+            map_file.write('theatre theater\n')
+        with open(config, 'w') as config_file:
+            json.dump({'lowercase': True, 'ignore': ['[noise]'], 'map_files': ['map.txt']}, config_file)
+        ref = os.path.join(self.tmpdir, 'norm_ref.txt')
+        hyp = os.path.join(self.tmpdir, 'norm_hyp.txt')
+        with open(ref, 'w') as ref_file, open(hyp, 'w') as hyp_file:
+            ref_file.write('utt1 At the Theater\nutt2 [noise]\n')
+            hyp_file.write('utt1 at the theatre [noise]\nutt2 uh\n')
+        output = run_cli([ref, hyp, '--head-ids', '--normalize', config, '-e'])
+        self.assertEqual(output, run_cli([ref, hyp, '--head-ids', '--normalize', config, '-e', '-j', '2']))
+        self.assertIn('Sentence count: 1', output)
+        self.assertIn('WER:     0.000% (         0 /          3)', output)
+        # Missing and bad configs are usage errors
+        for bad_config in ('{"lowercase": true, "colour": 1}', '{"regex": [["(", ""]]}', '{"lowercase": '):
+            with open(config, 'w') as config_file:
+                config_file.write(bad_config)
+            with self.assertRaises(SystemExit):
+                run_cli([ref, hyp, '--normalize', config])
+        with self.assertRaises(SystemExit):
+            run_cli([ref, hyp, '--normalize', os.path.join(self.tmpdir, 'missing.json')])
+
+    def test_space_saving(self):
+        from asr_evaluation.sketch import SpaceSaving
+        rng = random.Random(0)
+        stream = [min(int(rng.paretovariate(1.0)), 500) for _ in range(20000)]
+        true_counts = {}
+        for item in stream:
+            true_counts[item] = true_counts.get(item, 0) + 1
+        halves = [SpaceSaving(20), SpaceSaving(20)]
+        for i, item in enumerate(stream):
+            halves[i * 2 // len(stream)][item] += 1
+        summary = halves[0].merge(halves[1])
+        counts = dict(summary.items())
+        self.assertLessEqual(len(counts), 20)
+        self.assertGreater(summary.floor, 0)
+        for item, count in true_counts.items():
+            if count > summary.floor:
+                self.assertIn(item, counts)
+        for item, count in counts.items():
+            self.assertLessEqual(true_counts.get(item, 0), count)
+            self.assertLessEqual(count, true_counts.get(item, 0) + summary.floor)
+
+    def test_cli_top_confusions(self):
+        def sections(output):
+            tables = {}
+            lines = []
+            for line in output.splitlines():
+                if line.startswith('Sentence count'):
+                    break
+                if line.startswith(('INSERTIONS:', 'DELETIONS:', 'SUBSTITUTIONS:')):
+                    lines = tables[line.split(':')[0]] = []
+                else:
+                    lines.append(line)
+            return tables
+        exact = sections(run_cli([self.ref, self.hyp, '--head-ids', '-c']))
+        top = sections(run_cli([self.ref, self.hyp, '--head-ids', '-c', '--top-confusions', '3']))
+        self.assertEqual(sorted(top), ['DELETIONS', 'INSERTIONS', 'SUBSTITUTIONS'])
+        for table, lines in top.items():
+            self.assertEqual(lines, exact[table][:3])
+        output = run_cli([self.ref, self.hyp, '--head-ids', '-c', '--confusion-capacity', '4', '-j', '2'])
+        self.assertIn('SUBSTITUTIONS: (approximate', output)
+
+    def test_output(self):
+        jsonl = os.path.join(self.tmpdir, 'out.jsonl')
+        run_cli([self.ref, self.hyp, '--head-ids', '-c', '--output', jsonl, '--output-alignments'])
+        with open(jsonl) as output:
+            records = [json.loads(line) for line in output]
+        utterances = [record for record in records if record['type'] == 'utterance']
+        self.assertEqual(len(utterances), 200)
+        self.assertEqual(records[200]['type'], 'summary')
+        self.assertEqual(sum(record['errors'] for record in utterances), records[200]['error_count'])
+        for record in utterances:
+            alignment = record['alignment']
+            self.assertEqual([record['substitutions'], record['deletions'], record['insertions']],
+                             [alignment.count('r'), alignment.count('d'), alignment.count('i')])
+        self.assertEqual(set(record['type'] for record in records[201:]), {'insertion', 'deletion', 'substitution'})
+        csv_path = os.path.join(self.tmpdir, 'out.csv')
+        run_cli([self.ref, self.hyp, '--head-ids', '--output', csv_path, '-j', '2'])
+        with open(csv_path) as output:
+            rows = output.read().splitlines()
+        self.assertEqual(rows[0].split(',')[:3], ['id', 'sentence', 'ref_length'])
+        self.assertEqual([row.split(',')[4] for row in rows[1:]], [str(record['errors']) for record in utterances])
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'out.summary.csv')))
+        if numpy is not None:
+            from asr_evaluation.writers import load_columnar
+            npz = os.path.join(self.tmpdir, 'out.npz')
+            run_cli([self.ref, self.hyp, '--head-ids', '--output', npz])
+            columns = load_columnar(npz)
+            self.assertEqual(columns['utterances.id'], [record['id'] for record in utterances])
+            self.assertEqual(list(columns['utterances.errors']), [record['errors'] for record in utterances])
+
+    def test_renderer(self):
+        from asr_evaluation.render import Renderer, OutputBuffer
+        ref = 'the cat sat on mat'.split()
+        hyp = 'a cat sat down on the mat'.split()
+        sm = SequenceMatcher(a=ref, b=hyp)
+        ref_line, hyp_line = Renderer().diff(sm.get_opcodes(), ref, hyp)
+        self.assertEqual(ref_line, 'REF: THE cat sat **** on *** mat')
+        self.assertEqual(hyp_line, 'HYP: A   cat sat DOWN on THE mat')
+        colored_lines = Renderer(color=True).diff(sm.get_opcodes(), ref, hyp)
+        self.assertIn('\033[31mTHE\033[0m', colored_lines[0])
+        self.assertEqual(colored_lines[1].replace('\033[31m', '').replace('\033[0m', ''), hyp_line)
+        stream = io.StringIO()
+        output = OutputBuffer(stream, threaded=True)
+        for i in range(20000):
+            output.write('{}\n'.format(i))
+        output.close()
+        self.assertEqual(stream.getvalue(), ''.join('{}\n'.format(i) for i in range(20000)))
+
+    def test_timed(self):
+        stm = os.path.join(self.tmpdir, 'ref.stm')
+        ctm = os.path.join(self.tmpdir, 'hyp.ctm')
+        with open(stm, 'w') as stm_file:
+            stm_file.write(';; comment\n'
+                           'f1 1 spk 3.0 5.0 on the mat\n'
+                           'f1 1 spk 0.0 2.0 <o,f0,male> the cat sat\n'
+                           'f1 1 spk 5.0 6.0 ignore_time_segment_in_scoring\n')
+        with open(ctm, 'w') as ctm_file:
+            # The 'a' at 2.9-3.3 belongs to the second segment by its middle
+            for start, word in [(3.6, 'mat'), (0.1, 'the'), (0.5, 'cat'), (2.2, 'um'), (2.9, 'a'), (5.2, 'noise')]:
+                ctm_file.write('f1 1 {} 0.4 {} 0.9\n'.format(start, word))
+        output = run_cli([stm, ctm, '--timed', '-i'])
+        self.assertIn('SENTENCE 1  f1-1-3.00-5.00', output)
+        self.assertIn('REF: ON THE mat\nHYP: ** A   mat', output)
+        self.assertIn('REF: **\nHYP: UM\nSENTENCE 3  f1-1-gap-2.00', output)
+        self.assertIn('REF: the cat SAT\nHYP: the cat ***', output)
+        self.assertNotIn('NOISE', output)
+        self.assertIn('WER:    66.667% (         4 /          6)', output)
+        self.assertIn('WER:    50.000% (         3 /          6)', run_cli([stm, ctm, '--timed', '-e', '-j', '2']))
+
+    def test_groups(self):
+        metadata = os.path.join(self.tmpdir, 'metadata.tsv')
+        with open(self.ref) as ref_file, open(metadata, 'w') as metadata_file:
+            metadata_file.write('id\tspeaker\n')
+            for i, line in enumerate(ref_file):
+                # Leave some utterances out, to be counted as missing
+                if i % 10:
+                    metadata_file.write('{}\tspk{}\n'.format(line.split()[0], i % 3))
+        output = run_cli([self.ref, self.hyp, '--head-ids', '--groups', metadata])
+        self.assertEqual(output, run_cli([self.ref, self.hyp, '--head-ids', '--groups', metadata, '-j', '2']))
+        evaluation = asr_evaluation.Evaluation(head_ids=True)
+        with open(self.ref) as ref_file, open(self.hyp) as hyp_file:
+            evaluation.add_batch(zip(ref_file, hyp_file))
+        groups = asr_evaluation.Evaluation(head_ids=True, metadata=asr_evaluation.Metadata(metadata))
+        shard = asr_evaluation.Evaluation(**groups.options())
+        with open(self.ref) as ref_file, open(self.hyp) as hyp_file:
+            pairs = list(zip(ref_file, hyp_file))
+        groups.add_batch(pairs[:100])
+        shard.add_batch(pairs[100:])
+        results = groups.merge(shard).group_results()
+        self.assertEqual([(group['column'], group['value']) for group in results][:4],
+                         [('speaker', 'spk0'), ('speaker', 'spk1'), ('speaker', 'spk2'), ('speaker', None)])
+        self.assertEqual(results[3]['sentence_count'], 20)
+        for column in ('speaker', 'length'):
+            column_results = [group for group in results if group['column'] == column]
+            self.assertEqual(sum(group['error_count'] for group in column_results), evaluation.error_count)
+            self.assertEqual(sum(group['sentence_count'] for group in column_results), 200)
+        self.assertIn('speaker         (missing)', output)
+
+    def test_follow(self):
+        from asr_evaluation.follow import Follower
+        with open(self.ref) as ref_file, open(self.hyp) as hyp_file:
+            ref_lines = ref_file.readlines()
+            hyp_lines = hyp_file.readlines()
+        shards = [os.path.join(self.tmpdir, 'shard{}.txt'.format(i)) for i in range(2)]
+        for shard in shards:
+            open(shard, 'w').close()
+        with open(self.ref) as ref_file, open(shards[0]) as shard0, open(shards[1]) as shard1:
+            follower = Follower(ref_file, [shard0, shard1], head_ids=True)
+            self.assertEqual(follower.poll(), [])
+            with open(shards[1], 'a') as output:
+                # The second line is only half written
+                output.write(hyp_lines[3] + hyp_lines[1][:5])
+            self.assertEqual(follower.poll(), [(ref_lines[3].rstrip('\n'), hyp_lines[3])])
+            with open(shards[1], 'a') as output:
+                output.write(hyp_lines[1][5:] + hyp_lines[3] + 'unknown-id x\n')
+            self.assertEqual(follower.poll(), [(ref_lines[1].rstrip('\n'), hyp_lines[1])])
+            self.assertEqual((follower.duplicate_ids, follower.extra_hyps, follower.done()), (1, 1, False))
+        with open(shards[0], 'w') as output:
+            output.writelines(hyp_lines[::2])
+        with open(shards[1], 'a') as output:
+            output.writelines(hyp_lines[5::2])
+        # Every utterance has a hypothesis by now, so it stops right away
+        output = run_cli([self.ref, shards[0], shards[1], '--head-ids', '--follow'])
+        self.assertIn('Hypotheses without a reference (skipped): 1', output)
+        self.assertTrue(output.endswith(run_cli([self.ref, self.hyp, '--head-ids'])))
+
+    def test_dedup(self):
+        with open(self.ref) as ref_file, open(self.hyp) as hyp_file:
+            pairs = list(zip(ref_file, hyp_file))[:20]
+        # Each pair three times, with different IDs
+        pairs = [(' '.join(['x{}'.format(i)] + ref.split()[1:]), ' '.join(['x{}'.format(i)] + hyp.split()[1:]))
+                 for i, (ref, hyp) in enumerate(pairs * 3)]
+        plain = asr_evaluation.Evaluation(head_ids=True, confusions=True)
+        dedup = asr_evaluation.Evaluation(head_ids=True, confusions=True, dedup_size=20)
+        for evaluation in (plain, dedup):
+            for ref_line, hyp_line in pairs:
+                evaluation.add_pair(ref_line, hyp_line)
+        self.assertEqual(dedup.result(), plain.result())
+        self.assertEqual(dedup.confusion_tables(), plain.confusion_tables())
+        self.assertEqual(dict(dedup.wer_bins), dict(plain.wer_bins))
+        self.assertEqual((dedup.memo.hits, dedup.memo.misses), (40, 20))
+        # A worker process keeps its memo across shards, and only sends back
+        # each shard's hits and misses
+        options = dedup.options()
+        try:
+            first = asr_evaluation.process_shard((options, 0, pairs[:20], 0))[0]
+            second = asr_evaluation.process_shard((options, 20, pairs[20:], 0))[0]
+        finally:
+            asr_evaluation.worker_memos.clear()
+        self.assertEqual((first.memo.hits, first.memo.misses), (0, 20))
+        self.assertEqual((second.memo.hits, second.memo.misses), (40, 0))
+        self.assertEqual(len(second.memo.entries), 0)
+        self.assertEqual(first.merge(second).result(), plain.result())
+        if numpy is not None:
+            batch = asr_evaluation.Evaluation(head_ids=True, dedup_size=100)
+            batch.add_batch(pairs)
+            self.assertEqual(batch.result(), plain.result())
+            self.assertEqual((batch.memo.hits, batch.memo.misses), (40, 20))
+
+    def test_cli_systems(self):
+        other = os.path.join(self.tmpdir, 'other.txt')
+        with open(self.hyp) as hyp_file, open(other, 'w') as other_file:
+            for line in hyp_file:
+                other_file.write(line.rstrip('\n') + ' extra\n')
+        output = run_cli([self.ref, self.hyp, other, '--head-ids', '-c'])
+        self.assertEqual(output, run_cli([self.ref, self.hyp, other, '--head-ids', '-c', '-j', '2']))
+        rows = output.splitlines()[-2:]
+        for hyp, row in zip([self.hyp, other], rows):
+            evaluation = asr_evaluation.Evaluation(head_ids=True)
+            with open(self.ref) as ref_file, open(hyp) as hyp_file:
+                evaluation.add_batch(zip(ref_file, hyp_file))
+            result = evaluation.result()
+            self.assertEqual(row.split()[:4], [hyp, '200', str(result['ref_token_count']),
+                                               str(result['error_count'])])